@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多维表格记录快照
+按 app_token/table_id/view_id 保存上次拉取到的全部记录（record_id、修改时间、原始记录 JSON、视图顺序），
+供 pull_bitable.sync_bitable_records 做增量同步：之后只拉取修改过的记录并合并，删除的记录由记录数探测 + ID 扫描发现。
+基于本机 SQLite 文件，同一台机器上的所有 gunicorn worker 共享。
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .sqlite_store import SQLiteStore
+
+
+class BitableSnapshotStore(SQLiteStore):
+    """记录快照存储（接口由 pull_bitable.sync_bitable_records 约定：load / replace / merge / mark_unchanged）"""
+
+    def __init__(self, db_path: str, max_tables: int = 200, min_records: int = 500, max_fetch: int = 50):
+        """
+        Args:
+            db_path: SQLite 文件路径
+            max_tables: 最多保留的表快照数，超过后淘汰最久未同步的表
+            min_records: 记录数少于该值的表直接全量拉取（一两页即可拉完，增量反而多出请求）
+            max_fetch: 一次增量最多逐条读取的记录数，超过后改为全量拉取
+        """
+        super().__init__(db_path)
+        self.max_tables = max_tables
+        self.min_records = min_records
+        self.max_fetch = max_fetch
+        self._lock = threading.Lock()
+        self._full_syncs = 0
+        self._incremental_syncs = 0
+        self._unchanged = 0
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapshot_tables ("
+            " table_key TEXT PRIMARY KEY,"
+            " schema TEXT NOT NULL,"
+            " max_modified REAL,"
+            " record_count INTEGER NOT NULL,"
+            " synced_at REAL NOT NULL)"
+        )
+        # modified 不声明类型：按原值保存（飞书返回毫秒时间戳）
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapshot_records ("
+            " table_key TEXT NOT NULL,"
+            " record_id TEXT NOT NULL,"
+            " position INTEGER NOT NULL,"
+            " modified,"
+            " item TEXT NOT NULL,"
+            " PRIMARY KEY (table_key, record_id))"
+        )
+
+    def load(self, table_key: str) -> Optional[Dict[str, Any]]:
+        """返回 {"schema", "max_modified", "records": {record_id: (modified, item)}, "order": [record_id]}；无快照返回 None"""
+        conn = self._conn()
+        meta = conn.execute(
+            "SELECT schema, max_modified FROM snapshot_tables WHERE table_key = ?", (table_key,)
+        ).fetchone()
+        if meta is None:
+            return None
+        records: Dict[str, Tuple[Any, Dict[str, Any]]] = {}
+        order: List[str] = []
+        for record_id, modified, item in conn.execute(
+            "SELECT record_id, modified, item FROM snapshot_records WHERE table_key = ? ORDER BY position",
+            (table_key,),
+        ):
+            records[record_id] = (modified, json.loads(item))
+            order.append(record_id)
+        return {"schema": meta[0], "max_modified": meta[1], "records": records, "order": order}
+
+    def replace(self, table_key: str, schema: str, records: Iterable[Tuple[str, Any, Dict[str, Any]]]) -> None:
+        """全量同步：用 (record_id, modified, item) 列表（按视图顺序）整体替换该表快照"""
+        rows = [
+            (table_key, record_id, pos, modified, json.dumps(item, ensure_ascii=False))
+            for pos, (record_id, modified, item) in enumerate(records)
+        ]
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM snapshot_records WHERE table_key = ?", (table_key,))
+            conn.executemany(
+                "INSERT INTO snapshot_records(table_key, record_id, position, modified, item) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._write_meta(conn, table_key, schema, len(rows))
+        with self._lock:
+            self._full_syncs += 1
+        self._evict()
+
+    def merge(self, table_key: str, upserts: Iterable[Tuple[str, Any, Dict[str, Any]]],
+              deleted: Iterable[str], order: List[str]) -> None:
+        """增量同步：写入新增/修改的记录，删除已不存在的记录，并按 order 更新视图顺序"""
+        position = {record_id: pos for pos, record_id in enumerate(order)}
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM snapshot_records WHERE table_key = ? AND record_id = ?",
+                [(table_key, record_id) for record_id in deleted],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO snapshot_records(table_key, record_id, position, modified, item)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (table_key, record_id, position.get(record_id, len(order)), modified,
+                     json.dumps(item, ensure_ascii=False))
+                    for record_id, modified, item in upserts
+                ],
+            )
+            conn.executemany(
+                "UPDATE snapshot_records SET position = ? WHERE table_key = ? AND record_id = ? AND position != ?",
+                [(pos, table_key, record_id, pos) for record_id, pos in position.items()],
+            )
+            schema = conn.execute(
+                "SELECT schema FROM snapshot_tables WHERE table_key = ?", (table_key,)
+            ).fetchone()[0]
+            self._write_meta(conn, table_key, schema, len(order))
+        with self._lock:
+            self._incremental_syncs += 1
+
+    def mark_unchanged(self, table_key: str) -> None:
+        """远端无变化：只更新同步时间"""
+        self._conn().execute(
+            "UPDATE snapshot_tables SET synced_at = ? WHERE table_key = ?", (time.time(), table_key)
+        )
+        with self._lock:
+            self._unchanged += 1
+
+    def _write_meta(self, conn: sqlite3.Connection, table_key: str, schema: str, record_count: int) -> None:
+        # 增量筛选的起点：快照中最大的修改时间（非数值的修改时间不参与）
+        max_modified = conn.execute(
+            "SELECT MAX(modified) FROM snapshot_records WHERE table_key = ? AND typeof(modified) IN ('integer', 'real')",
+            (table_key,),
+        ).fetchone()[0]
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshot_tables(table_key, schema, max_modified, record_count, synced_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (table_key, schema, max_modified, record_count, time.time()),
+        )
+
+    def _evict(self) -> None:
+        with self._transaction() as conn:
+            stale = [row[0] for row in conn.execute(
+                "SELECT table_key FROM snapshot_tables ORDER BY synced_at DESC LIMIT -1 OFFSET ?",
+                (self.max_tables,),
+            ).fetchall()]
+            for table_key in stale:
+                conn.execute("DELETE FROM snapshot_records WHERE table_key = ?", (table_key,))
+                conn.execute("DELETE FROM snapshot_tables WHERE table_key = ?", (table_key,))
+
+    def stats(self) -> dict:
+        tables, records = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(record_count), 0) FROM snapshot_tables"
+        ).fetchone()
+        with self._lock:
+            return {
+                "tables": tables,
+                "records": records,
+                "max_tables": self.max_tables,
+                "full_syncs": self._full_syncs,
+                "incremental_syncs": self._incremental_syncs,
+                "unchanged": self._unchanged,
+            }
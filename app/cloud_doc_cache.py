@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+云文档下载缓存（按 file_token + 版本指纹）
+电子表格以 metainfo 中的 revision 作为版本，云空间文件以文件元数据中的最后修改时间作为版本；
+再次收到同一文档时只做一次元数据查询，版本未变就复制已缓存的 Excel，不再读取各 sheet 或重新下载。
+缓存文件放在独立目录中，索引保存在同目录的 SQLite 文件里，所有 gunicorn worker 共享；
+超过条目数或总大小上限时按最近使用时间淘汰。
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from .sqlite_store import SQLiteStore, evict_lru
+
+logger = logging.getLogger(__name__)
+
+
+class CloudDocCache(SQLiteStore):
+    """file_token -> (版本指纹, 文件名, 缓存的 Excel)"""
+
+    def __init__(self, cache_dir: str, max_entries: int = 200, max_bytes: int = 0):
+        """
+        Args:
+            cache_dir: 缓存目录（保存 Excel 副本与索引 index.db）
+            max_entries: 最多缓存的文档数，0 表示不限
+            max_bytes: 缓存文件的总大小上限（字节），0 表示不限
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        super().__init__(os.path.join(cache_dir, "index.db"))
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evicted = 0
+
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS cloud_doc_cache ("
+            " file_token TEXT PRIMARY KEY,"
+            " fingerprint TEXT NOT NULL,"
+            " title TEXT,"
+            " filename TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL)"
+        )
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.cache_dir, filename)
+
+    def get(self, file_token: str, fingerprint: str, output_path: str) -> Tuple[bool, Optional[str]]:
+        """版本一致时把缓存的 Excel 复制到 output_path，返回 (是否命中, 文件名)"""
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT fingerprint, title, filename FROM cloud_doc_cache WHERE file_token = ?", (file_token,)
+        ).fetchone()
+        if row and row[0] == fingerprint:
+            try:
+                shutil.copyfile(self._path(row[2]), output_path)
+            except FileNotFoundError:
+                # 缓存文件已被删除（如被其他 worker 淘汰）：视为未命中
+                conn.execute("DELETE FROM cloud_doc_cache WHERE file_token = ?", (file_token,))
+            else:
+                conn.execute(
+                    "UPDATE cloud_doc_cache SET last_used_at = ? WHERE file_token = ?", (time.time(), file_token)
+                )
+                with self._lock:
+                    self._hits += 1
+                return True, row[1]
+        with self._lock:
+            self._misses += 1
+        return False, None
+
+    def put(self, file_token: str, fingerprint: str, title: Optional[str], src_path: Optional[str],
+            data: Optional[bytes] = None) -> None:
+        """缓存新下载的 Excel（src_path 为文件路径；内存下载时传 data）；先写临时文件再替换，旧版本文件随之删除"""
+        filename = f"{file_token}-{uuid.uuid4().hex[:8]}.xlsx"
+        tmp_path = self._path(filename + ".tmp")
+        try:
+            if data is not None:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+            else:
+                shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, self._path(filename))
+        except OSError as e:
+            logger.warning(f"[云文档缓存] 写入缓存失败: {file_token}, 错误: {e}")
+            return
+        now = time.time()
+        with self._transaction() as conn:
+            old = conn.execute(
+                "SELECT filename FROM cloud_doc_cache WHERE file_token = ?", (file_token,)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO cloud_doc_cache(file_token, fingerprint, title, filename, size, created_at, last_used_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_token, fingerprint, title, filename, os.path.getsize(self._path(filename)), now, now),
+            )
+        if old:
+            self._remove(old[0])
+        self.evict()
+
+    def _remove(self, filename: str) -> None:
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"[云文档缓存] 删除缓存文件失败: {filename}, 错误: {e}")
+
+    def evict(self) -> int:
+        """超过条目数/总大小上限时，按最近使用时间淘汰并删除缓存文件；返回淘汰条数"""
+        if not self.max_entries and not self.max_bytes:
+            return 0
+        with self._transaction() as conn:
+            victims = evict_lru(conn, "cloud_doc_cache", "file_token", self.max_entries, self.max_bytes)
+
+        for _, filename in victims:
+            self._remove(filename)
+        if victims:
+            with self._lock:
+                self._evicted += len(victims)
+            logger.info(f"[云文档缓存] 淘汰 {len(victims)} 个文档")
+        return len(victims)
+
+    def stats(self) -> dict:
+        count, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cloud_doc_cache"
+        ).fetchone()
+        with self._lock:
+            hits, misses, evicted = self._hits, self._misses, self._evicted
+        lookups = hits + misses
+        return {
+            "entries": count,
+            "bytes": total,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "evicted": evicted,
+        }
@@ -5,12 +5,26 @@
 从飞书云文档链接下载 Excel 文件
 """
 
+import io
 import os
 import re
 import json
+import urllib.parse
 import requests
 import pandas as pd
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from .cloud_doc_cache import CloudDocCache
+
+# HTTP 会话：默认使用一个 keep-alive Session；服务端通过 set_http_session 注入带连接池与重试的共享会话
+_http = requests.Session()
+
+
+def set_http_session(session: requests.Session) -> None:
+    """注入共享 HTTP 会话（所有 OpenAPI 调用都经由它发出）"""
+    global _http
+    _http = session
 
 
 def extract_file_token_from_link(doc_link: str) -> str:
@@ -39,17 +53,118 @@ def extract_file_token_from_link(doc_link: str) -> str:
         f"无法从链接中提取 file_token: {doc_link}\n支持的链接格式示例：\n  - https://xxx.feishu.cn/docs/xxx\n  - https://xxx.feishu.cn/sheets/xxx\n  - https://xxx.feishu.cn/file/xxx")
 
 
-def download_sheets_via_read(file_token: str, output_path: str, tenant_token: str, open_base: str) -> tuple[bool, Optional[str], Optional[str]]:
+def sheets_fingerprint(metainfo_data: Dict[str, Any]) -> Optional[str]:
+    """电子表格版本指纹：revision + 各 sheet 的 id/标题/行列数；metainfo 未返回 revision 时返回 None（不缓存）"""
+    revision = (metainfo_data.get("properties") or {}).get("revision")
+    if revision is None:
+        return None
+    sheets = [
+        [s.get("sheetId"), s.get("title"), s.get("rowCount"), s.get("columnCount")]
+        for s in metainfo_data.get("sheets") or []
+    ]
+    return "rev:" + json.dumps([revision, sheets], ensure_ascii=False)
+
+
+def drive_file_fingerprint(file_token: str, tenant_token: str, open_base: str, doc_type: str = "file") -> Optional[str]:
+    """云空间文件版本指纹：文件元数据中的最后修改时间；查询失败时返回 None（不缓存）"""
+    url = f"{open_base}/open-apis/drive/v1/metas/batch_query"
+    headers = {
+        "Authorization": f"Bearer {tenant_token}",
+        "Content-Type": "application/json; charset=utf-8"
+    }
+    body = {"request_docs": [{"doc_token": file_token, "doc_type": doc_type}]}
+    try:
+        r = _http.post(url, headers=headers, json=body, timeout=15).json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    if r.get("code") != 0:
+        return None
+    metas = (r.get("data") or {}).get("metas") or []
+    modified = metas[0].get("latest_modify_time") if metas else None
+    return f"mtime:{modified}" if modified else None
+
+
+# 单次读取的单元格上限：超过时按行分段读取，避免触发接口单次读取上限与超时
+MAX_CHUNK_CELLS = 200_000
+
+
+def _column_letter(n: int) -> str:
+    """列序号（从 1 开始）转 Excel 列名：1 -> A，27 -> AA"""
+    letters = ""
+    while n > 0:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def sheet_read_ranges(sheet: Dict[str, Any], chunk_rows: int = 5000) -> List[str]:
+    """按 metainfo 中的行列数把 sheet 切分为行区间；行数不超过单次上限（或行列数未知）时读取整个 sheet"""
+    sheet_id = sheet.get("sheetId")
+    row_count = sheet.get("rowCount") or 0
+    column_count = sheet.get("columnCount") or 0
+    if chunk_rows <= 0 or not row_count or not column_count:
+        return [sheet_id]
+    rows_per_chunk = max(1, min(chunk_rows, MAX_CHUNK_CELLS // column_count))
+    if row_count <= rows_per_chunk:
+        return [sheet_id]
+    last_column = _column_letter(column_count)
+    return [
+        f"{sheet_id}!A{start}:{last_column}{min(start + rows_per_chunk - 1, row_count)}"
+        for start in range(1, row_count + 1, rows_per_chunk)
+    ]
+
+
+def _trim_empty_tail(values: List[list]) -> List[list]:
+    """去掉分段读取时末尾的空行与右侧的空列（整 sheet 读取时接口只返回有数据的区域）"""
+    def empty(v: Any) -> bool:
+        return v is None or v == ""
+
+    while values and all(empty(v) for v in values[-1]):
+        values.pop()
+    width = max((i + 1 for row in values for i, v in enumerate(row) if not empty(v)), default=0)
+    return [row[:width] for row in values]
+
+
+def _read_sheet_values(file_token: str, sheet_range: str, headers: dict, open_base: str) -> Tuple[Optional[str], Optional[List[list]]]:
+    """读取 sheet（或其中一个区间）的原始单元格，返回 (错误, values)；错误为 permission_denied / file_not_found，
+    其他失败返回 ("skip", None) 表示跳过该 sheet"""
+    read_url = f"{open_base}/open-apis/sheets/v2/spreadsheets/{file_token}/values/{urllib.parse.quote(sheet_range, safe='!:')}"
+    resp = _http.get(read_url, headers=headers, timeout=30)
+
+    if resp.status_code == 403:
+        return "permission_denied", None
+    if resp.status_code == 404:
+        return "file_not_found", None
+    if resp.status_code != 200:
+        # 某个sheet读取失败，跳过
+        return "skip", None
+
+    read_data = resp.json()
+    if read_data.get("code") != 0:
+        # 某个sheet读取失败，跳过
+        return "skip", None
+
+    value_range = read_data.get("data", {}).get("valueRange", {})
+    return None, value_range.get("values", [])
+
+
+def download_sheets_via_read(file_token: str, output_path: str, tenant_token: str, open_base: str,
+                             doc_cache: Optional[CloudDocCache] = None,
+                             sheet_concurrency: int = 4, chunk_rows: int = 5000) -> tuple[bool, Optional[str], Optional[str]]:
     """通过读取接口获取 sheets 数据并转换为 Excel（支持多sheet）
     
     使用 v2/spreadsheets/{token}/metainfo 接口获取所有 sheet_id，
-    然后使用 v2/spreadsheets/{token}/values/{sheet_id} 读取每个sheet的数据。
+    然后使用 v2/spreadsheets/{token}/values/{sheet_id} 读取每个sheet的数据（最多 sheet_concurrency 个并发）。
+    行数较多的 sheet 按 metainfo 中的行列数切分为行区间并发读取，再按顺序拼接。
     
     Args:
         file_token: Sheets 的 file_token
         output_path: 输出文件路径
         tenant_token: tenant_access_token
         open_base: 飞书 API 基础 URL
+        doc_cache: 云文档缓存；metainfo 中的 revision 未变时直接复用缓存的 Excel，不再读取各 sheet
+        sheet_concurrency: 同时进行的读取请求数上限（sheet 或分段）
+        chunk_rows: 单次读取的最大行数，超过时分段读取（0 表示不分段）
     
     Returns:
         tuple[bool, Optional[str], Optional[str]]: (是否成功, 错误信息或 None, 文件名或 None)
@@ -62,7 +177,7 @@ def download_sheets_via_read(file_token: str, output_path: str, tenant_token: st
     try:
         # 步骤1: 使用 v2/metainfo 接口获取表格元数据，获取所有 sheet
         metadata_url = f"{open_base}/open-apis/sheets/v2/spreadsheets/{file_token}/metainfo"
-        resp = requests.get(metadata_url, headers=headers, timeout=30)
+        resp = _http.get(metadata_url, headers=headers, timeout=30)
         
         if resp.status_code == 403:
             return False, "permission_denied", None
@@ -89,42 +204,51 @@ def download_sheets_via_read(file_token: str, output_path: str, tenant_token: st
         sheets = data.get("sheets", [])
         if not sheets:
             return False, "no_sheets", None
+
+        fingerprint = sheets_fingerprint(data) if doc_cache is not None else None
+        if fingerprint is not None:
+            hit, _ = doc_cache.get(file_token, fingerprint, output_path)
+            if hit:
+                return True, None, file_title
         
-        # 步骤2: 读取所有sheet的数据
+        # 步骤2: 读取所有sheet的数据（sheet 与分段并发读取，按 sheet、分段顺序处理结果）
+        sheet_ranges = [(sheet.get("title", f"Sheet{sheet.get('sheetId')}"), sheet_read_ranges(sheet, chunk_rows))
+                        for sheet in sheets if sheet.get("sheetId")]
+        request_count = sum(len(ranges) for _, ranges in sheet_ranges)
         all_sheets_data = {}
-        for sheet in sheets:
-            sheet_id = sheet.get("sheetId")
-            sheet_title = sheet.get("title", f"Sheet{sheet_id}")
-            
-            if not sheet_id:
-                continue
-            
-            # 读取每个sheet的数据
-            read_url = f"{open_base}/open-apis/sheets/v2/spreadsheets/{file_token}/values/{sheet_id}"
-            resp = requests.get(read_url, headers=headers, timeout=30)
-            
-            if resp.status_code == 403:
-                return False, "permission_denied", None
-            if resp.status_code == 404:
-                return False, "file_not_found", None
-            if resp.status_code != 200:
-                # 某个sheet读取失败，跳过
-                continue
-            
-            read_data = resp.json()
-            if read_data.get("code") != 0:
-                # 某个sheet读取失败，跳过
-                continue
-            
-            # 步骤3: 解析数据
-            value_range = read_data.get("data", {}).get("valueRange", {})
-            values = value_range.get("values", [])
-            
-            if values:
-                # 转换为 DataFrame（第一行作为表头）
-                if len(values) > 0:
-                    df = pd.DataFrame(values[1:], columns=values[0] if len(values) > 0 else None)
-                    all_sheets_data[sheet_title] = df
+        # 保留原始单元格：单 sheet 时按无表头格式写出
+        all_sheets_values = {}
+        pool = ThreadPoolExecutor(max_workers=max(1, min(sheet_concurrency, request_count or 1)),
+                                  thread_name_prefix="sheets-read")
+        try:
+            futures = [
+                (sheet_title, [pool.submit(_read_sheet_values, file_token, r, headers, open_base) for r in ranges])
+                for sheet_title, ranges in sheet_ranges
+            ]
+            for sheet_title, chunk_futures in futures:
+                values = []
+                error = None
+                for fut in chunk_futures:
+                    error, chunk = fut.result()
+                    if error is not None:
+                        break
+                    values.extend(chunk or [])
+                if error in ("permission_denied", "file_not_found"):
+                    return False, error, None
+                if error is not None:
+                    # 任一分段读取失败时跳过整个 sheet（不写出残缺数据）
+                    continue
+                if len(chunk_futures) > 1:
+                    values = _trim_empty_tail(values)
+
+                # 步骤3: 解析数据
+                if values:
+                    # 转换为 DataFrame（第一行作为表头）
+                    all_sheets_data[sheet_title] = pd.DataFrame(values[1:], columns=values[0])
+                    all_sheets_values[sheet_title] = values
+        finally:
+            # 出错时取消尚未开始的读取
+            pool.shutdown(wait=True, cancel_futures=True)
         
         if not all_sheets_data:
             return False, "empty_data", None
@@ -133,18 +257,8 @@ def download_sheets_via_read(file_token: str, output_path: str, tenant_token: st
         # 如果只有一个sheet，保持原有行为（无表头，兼容旧格式）
         # 如果有多个sheet，保存为多sheet Excel（有表头）
         if len(all_sheets_data) == 1:
-            # 单sheet：保持原有格式（无表头）
-            df = list(all_sheets_data.values())[0]
-            # 如果没有表头，使用原有逻辑：直接使用values
-            # 这里我们需要重新读取一次，因为DataFrame可能已经丢失了原始数据
-            first_sheet = sheets[0]
-            sheet_id = first_sheet.get("sheetId")
-            read_url = f"{open_base}/open-apis/sheets/v2/spreadsheets/{file_token}/values/{sheet_id}"
-            resp = requests.get(read_url, headers=headers, timeout=30)
-            read_data = resp.json()
-            value_range = read_data.get("data", {}).get("valueRange", {})
-            values = value_range.get("values", [])
-            df = pd.DataFrame(values)
+            # 单sheet：保持原有格式（无表头），直接使用读取到的原始 values
+            df = pd.DataFrame(list(all_sheets_values.values())[0])
             df.to_excel(output_path, index=False, header=False, engine='openpyxl')
         else:
             # 多sheet：保存为多sheet Excel（有表头）
@@ -156,6 +270,8 @@ def download_sheets_via_read(file_token: str, output_path: str, tenant_token: st
         
         # 验证文件是否生成成功
         if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            if fingerprint is not None:
+                doc_cache.put(file_token, fingerprint, file_title, output_path)
             return True, None, file_title
         else:
             return False, "file_write_failed", None
@@ -166,8 +282,66 @@ def download_sheets_via_read(file_token: str, output_path: str, tenant_token: st
         return False, f"unknown_error: {str(e)}", None
 
 
-def download_cloud_doc_to_excel(file_token: str, output_path: str, tenant_token: str, open_base: str, doc_link: str = "") -> tuple[bool, Optional[str], Optional[str]]:
-    """下载飞书云文档为 Excel 文件
+# xlsx（zip）文件头
+XLSX_MAGIC = b'PK\x03\x04'
+
+
+def _receive_xlsx(resp: requests.Response, output_path: Optional[str], chunk_size: int = 256 * 1024,
+                  max_bytes: int = 0) -> Tuple[Optional[str], Optional[bytes]]:
+    """接收文件流：收到首块数据即校验 xlsx 文件头，累计超过 max_bytes 时中止（0 表示不限）。
+
+    output_path 为 None 时在内存中接收并返回内容；否则先写入 {output_path}.part，完成后原子替换为 output_path，
+    校验失败或接收中断（连接断开、读取超时等异常，异常照常抛出）时删除临时文件，
+    output_path 不会出现不完整或无效的文件。
+
+    Returns:
+        (错误信息或 None, 内存模式下的文件内容)
+    """
+    tmp_path = f"{output_path}.part" if output_path is not None else None
+    f = open(tmp_path, 'wb') if tmp_path is not None else io.BytesIO()
+    error = None
+    data = None
+    head = b""
+    received = 0
+    try:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if not chunk:
+                continue
+            # 首块即校验文件头，不是 Excel（如错误页面）时不再继续接收
+            if len(head) < len(XLSX_MAGIC):
+                head += chunk[:len(XLSX_MAGIC) - len(head)]
+                if not XLSX_MAGIC.startswith(head):
+                    error = "invalid_file_format"
+                    break
+            received += len(chunk)
+            if max_bytes and received > max_bytes:
+                error = "file_too_large"
+                break
+            f.write(chunk)
+        else:
+            if head != XLSX_MAGIC:
+                error = "invalid_file_format"
+        if error is None:
+            if tmp_path is None:
+                data = f.getvalue()
+            else:
+                f.close()
+                os.replace(tmp_path, output_path)
+                tmp_path = None  # 已替换为正式文件，无需清理
+    finally:
+        resp.close()
+        f.close()
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return error, data
+
+
+def download_cloud_doc(file_token: str, output_path: str, tenant_token: str, open_base: str, doc_link: str = "",
+                       doc_cache: Optional[CloudDocCache] = None,
+                       sheet_concurrency: int = 4, chunk_rows: int = 5000,
+                       download_chunk_size: int = 256 * 1024, max_bytes: int = 0,
+                       memory_threshold: int = 0) -> tuple[bool, Optional[str], Optional[str], Optional[bytes]]:
+    """下载飞书云文档为 Excel（文件或内存）
 
     Args:
         file_token: 云文档的 file_token
@@ -175,9 +349,16 @@ def download_cloud_doc_to_excel(file_token: str, output_path: str, tenant_token:
         tenant_token: tenant_access_token
         open_base: 飞书 API 基础 URL
         doc_link: 原始文档链接（用于判断类型）
+        doc_cache: 云文档缓存；文档版本未变时复用上次下载的 Excel（每次只做一次元数据查询）
+        sheet_concurrency: sheets 类型同时进行的读取请求数上限
+        chunk_rows: sheets 类型单次读取的最大行数，超过时分段读取
+        download_chunk_size: 直接下载时每次读取的字节数
+        max_bytes: 直接下载的文件大小上限（字节），超过时返回 file_too_large；0 表示不限
+        memory_threshold: 直接下载且 Content-Length 不超过该值（字节）时在内存中接收，不写 output_path；0 表示不使用
 
     Returns:
-        tuple[bool, Optional[str], Optional[str]]: (是否成功, 错误信息或 None, 文件名或 None)
+        tuple[bool, Optional[str], Optional[str], Optional[bytes]]:
+            (是否成功, 错误信息或 None, 文件名或 None, 内存中的文件内容；为 None 时文件已写入 output_path)
     """
     headers = {
         "Authorization": f"Bearer {tenant_token}",
@@ -190,30 +371,43 @@ def download_cloud_doc_to_excel(file_token: str, output_path: str, tenant_token:
     # 如果是 sheets 类型，优先尝试读取接口
     if is_sheets:
         try:
-            success, error, file_title = download_sheets_via_read(file_token, output_path, tenant_token, open_base)
+            success, error, file_title = download_sheets_via_read(
+                file_token, output_path, tenant_token, open_base, doc_cache=doc_cache,
+                sheet_concurrency=sheet_concurrency, chunk_rows=chunk_rows,
+            )
             if success:
-                return True, None, file_title
+                return True, None, file_title, None
             # 如果是权限或文件不存在错误，直接返回
             if error in ["permission_denied", "file_not_found"]:
-                return False, error, None
+                return False, error, None, None
             # 其他错误，继续尝试直接下载接口
         except Exception:
             # 读取接口异常，继续尝试直接下载接口
             pass
 
+    # 文件元数据中的最后修改时间未变时复用缓存
+    fingerprint = None
+    if doc_cache is not None:
+        doc_type = "sheet" if is_sheets else ("doc" if "/docs/" in doc_link else "file")
+        fingerprint = drive_file_fingerprint(file_token, tenant_token, open_base, doc_type)
+        if fingerprint is not None:
+            hit, _ = doc_cache.get(file_token, fingerprint, output_path)
+            if hit:
+                return True, None, None, None
+
     # 直接下载接口（官方标准接口）
     download_url = f"{open_base}/open-apis/drive/v1/files/{file_token}/download"
     
     try:
-        resp = requests.get(download_url, headers=headers, timeout=30, stream=True)
+        resp = _http.get(download_url, headers=headers, timeout=30, stream=True)
         
         # 处理 403 权限错误
         if resp.status_code == 403:
-            return False, "permission_denied", None
+            return False, "permission_denied", None, None
         
         # 处理 404 文件不存在
         if resp.status_code == 404:
-            return False, "file_not_found", None
+            return False, "file_not_found", None, None
         
         # 处理 200 成功
         if resp.status_code == 200:
@@ -221,37 +415,53 @@ def download_cloud_doc_to_excel(file_token: str, output_path: str, tenant_token:
             
             # 排除 HTML 页面
             if 'text/html' in content_type:
-                return False, "invalid_response", None
+                return False, "invalid_response", None, None
             
             # 检查是否是文件流（排除 JSON）
-            if 'text/html' not in content_type and 'application/json' not in content_type:
-                # 保存文件
-                with open(output_path, 'wb') as f:
-                    for chunk in resp.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                
-                file_size = os.path.getsize(output_path)
-                
-                # 验证文件确实是 Excel（检查文件头）
-                with open(output_path, 'rb') as f:
-                    file_header = f.read(4)
-                    if file_header == b'PK\x03\x04':
-                        # Excel 文件头验证通过
-                        # 对于非 Sheets 类型的云文档，无法获取文件名，返回 None
-                        return True, None, None
-                    else:
-                        # 文件头验证失败，删除无效文件
-                        os.remove(output_path)
-                        return False, "invalid_file_format", None
+            if 'application/json' not in content_type:
+                try:
+                    content_length = int(resp.headers.get('Content-Length', ''))
+                except ValueError:
+                    content_length = None
+                if max_bytes and content_length is not None and content_length > max_bytes:
+                    resp.close()
+                    return False, "file_too_large", None, None
+                in_memory = bool(memory_threshold) and content_length is not None and content_length <= memory_threshold
+
+                # 边接收边校验文件头与大小（Excel 文件头验证通过后才落盘/返回）
+                error, content = _receive_xlsx(
+                    resp, None if in_memory else output_path,
+                    chunk_size=download_chunk_size, max_bytes=max_bytes,
+                )
+                if error is not None:
+                    return False, error, None, None
+                if fingerprint is not None:
+                    doc_cache.put(file_token, fingerprint, None, output_path if content is None else None, data=content)
+                # 对于非 Sheets 类型的云文档，无法获取文件名，返回 None
+                return True, None, None, content
         
         # 其他状态码
-        return False, "download_failed", None
+        return False, "download_failed", None, None
         
     except requests.exceptions.RequestException as e:
-        return False, f"network_error: {str(e)}", None
+        return False, f"network_error: {str(e)}", None, None
     except Exception as e:
-        return False, f"unknown_error: {str(e)}", None
+        return False, f"unknown_error: {str(e)}", None, None
+
+
+def download_cloud_doc_to_excel(file_token: str, output_path: str, tenant_token: str, open_base: str, doc_link: str = "",
+                                doc_cache: Optional[CloudDocCache] = None,
+                                sheet_concurrency: int = 4, chunk_rows: int = 5000) -> tuple[bool, Optional[str], Optional[str]]:
+    """下载飞书云文档为 Excel 文件（始终写入 output_path）
+
+    Returns:
+        tuple[bool, Optional[str], Optional[str]]: (是否成功, 错误信息或 None, 文件名或 None)
+    """
+    success, error, file_title, _ = download_cloud_doc(
+        file_token, output_path, tenant_token, open_base, doc_link=doc_link, doc_cache=doc_cache,
+        sheet_concurrency=sheet_concurrency, chunk_rows=chunk_rows,
+    )
+    return success, error, file_title
 
 
 def download_file(download_url: str, output_path: str, headers: dict = None) -> bool:
@@ -266,21 +476,11 @@ def download_file(download_url: str, output_path: str, headers: dict = None) ->
         bool: 是否成功
     """
     try:
-        resp = requests.get(download_url, headers=headers, timeout=30, stream=True)
+        resp = _http.get(download_url, headers=headers, timeout=30, stream=True)
         if resp.status_code == 200:
-            with open(output_path, 'wb') as f:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            # 验证文件头
-            with open(output_path, 'rb') as f:
-                file_header = f.read(4)
-                if file_header == b'PK\x03\x04':
-                    return True
-                else:
-                    os.remove(output_path)
-                    return False
+            # 首块校验文件头，写入临时文件后原子替换
+            error, _ = _receive_xlsx(resp, output_path)
+            return error is None
         return False
     except Exception:
         return False
-
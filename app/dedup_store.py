@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+事件幂等存储
+基于本机 SQLite 文件，同一台机器上的所有 gunicorn worker 共享，重启后仍然有效。
+记录 event_id 与 message_id，带 TTL 与容量上限，过期数据批量清理。
+"""
+
+import threading
+import time
+from typing import Optional
+
+from .sqlite_store import SQLiteStore
+
+
+class DedupStore(SQLiteStore):
+    """跨进程的已处理事件记录
+
+    check_and_mark 在一个写事务内完成“查询 + 标记”，多个 worker 同时收到
+    飞书重试时只有一个能成功标记。
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: int = 86400, max_entries: int = 100000,
+                 purge_every: int = 200):
+        super().__init__(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.purge_every = purge_every
+        self._marks_since_purge = 0
+        self._lock = threading.Lock()
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_keys ("
+            " key TEXT PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_created ON processed_keys(created_at)")
+
+    def check_and_mark(self, message_id: Optional[str] = None, event_id: Optional[str] = None) -> bool:
+        """首次出现返回 True 并记录；任一 ID 已记录过（且未过期）返回 False"""
+        keys = []
+        if event_id:
+            keys.append((f"event:{event_id}", "event"))
+        if message_id:
+            keys.append((f"message:{message_id}", "message"))
+        if not keys:
+            return True
+
+        now = time.time()
+        expire_before = now - self.ttl_seconds
+        with self._transaction() as conn:
+            for key, _ in keys:
+                row = conn.execute(
+                    "SELECT created_at FROM processed_keys WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[0] >= expire_before:
+                    return False
+            conn.executemany(
+                "INSERT OR REPLACE INTO processed_keys(key, kind, created_at) VALUES (?, ?, ?)",
+                [(key, kind, now) for key, kind in keys],
+            )
+
+        with self._lock:
+            self._marks_since_purge += 1
+            need_purge = self._marks_since_purge >= self.purge_every
+            if need_purge:
+                self._marks_since_purge = 0
+        if need_purge:
+            self.purge()
+        return True
+
+    def purge(self) -> int:
+        """批量删除过期记录，并把总量压回 max_entries 以内；返回删除条数"""
+        expire_before = time.time() - self.ttl_seconds
+        with self._transaction() as conn:
+            removed = conn.execute(
+                "DELETE FROM processed_keys WHERE created_at < ?", (expire_before,)
+            ).rowcount
+            total = conn.execute("SELECT COUNT(*) FROM processed_keys").fetchone()[0]
+            overflow = total - self.max_entries
+            if overflow > 0:
+                removed += conn.execute(
+                    "DELETE FROM processed_keys WHERE key IN ("
+                    " SELECT key FROM processed_keys ORDER BY created_at LIMIT ?)",
+                    (overflow,),
+                ).rowcount
+        return removed
+
+    def stats(self) -> dict:
+        total = self._conn().execute("SELECT COUNT(*) FROM processed_keys").fetchone()[0]
+        return {
+            "entries": total,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+        }
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+飞书 OpenAPI 共享 HTTP 会话
+- 连接池 + keep-alive：同一 host 的请求复用 TCP/TLS 连接
+- 幂等请求（GET/HEAD/OPTIONS）遇到 429 / 5xx 或连接错误时按抖动指数退避重试，并遵循 Retry-After
+- POST（发送消息、获取 token）不自动重试，避免重复副作用
+- 配置了 RateLimiter 时，请求先按接口族取令牌；429/飞书频控码由限流层暂停并重发（请求未被执行，POST 也可安全重发）
+- 注入 token 刷新函数后，飞书返回 tenant_access_token 无效/过期时刷新 token 并重发一次（请求同样未被执行）
+由 main.py 创建一次，注入到 pull_bitable / cloud_doc_download 等模块。
+"""
+
+import logging
+import random
+from typing import Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .rate_limiter import FEISHU_RATE_LIMIT_CODES, RateLimiter, classify_endpoint
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+# 飞书鉴权失败错误码：99991661 缺少/格式错误、99991663 token 无效、99991668 token 已过期
+FEISHU_INVALID_TOKEN_CODES = frozenset({99991661, 99991663, 99991668})
+
+
+class OpenAPISession(requests.Session):
+    """飞书 OpenAPI 会话：tenant_access_token 被判定无效时刷新 token 并重发一次"""
+
+    def __init__(self):
+        super().__init__()
+        self.token_refresher: Optional[Callable[[str], str]] = None
+
+    def set_token_refresher(self, refresher: Optional[Callable[[str], str]]) -> None:
+        """注入 token 刷新函数：参数为被拒绝的 token，返回新 token（如 TenantTokenProvider.renew）"""
+        self.token_refresher = refresher
+
+    def request(self, method, url, *args, **kwargs):
+        resp = self._send(method, url, *args, **kwargs)
+        headers = kwargs.get("headers") or {}
+        auth = headers.get("Authorization", "")
+        if self.token_refresher is None or not auth.startswith("Bearer ") or not _is_invalid_token(resp):
+            return resp
+        rejected = auth[len("Bearer "):]
+        logger.warning(f"[token] tenant_access_token 被拒绝，刷新后重试一次: {url}")
+        token = self.token_refresher(rejected)
+        resp.close()
+        kwargs["headers"] = dict(headers, Authorization=f"Bearer {token}")
+        return self._send(method, url, *args, **kwargs)
+
+    def _send(self, method, url, *args, **kwargs):
+        return super().request(method, url, *args, **kwargs)
+
+
+class RateLimitedSession(OpenAPISession):
+    """请求前按接口族取令牌；被服务端限流时暂停该接口族并重发，而不是让调用方失败"""
+
+    def __init__(self, rate_limiter: RateLimiter, max_throttle_retries: int = 5):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+        self.max_throttle_retries = max_throttle_retries
+
+    def _send(self, method, url, *args, **kwargs):
+        family = classify_endpoint(url)
+        bucket = self.rate_limiter.bucket(family)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            resp = super()._send(method, url, *args, **kwargs)
+            wait = _throttle_wait(resp, stream=kwargs.get("stream", False))
+            if wait is None or attempt >= self.max_throttle_retries:
+                return resp
+            attempt += 1
+            wait = wait if wait > 0 else min(30.0, 2 ** attempt) * (0.5 + random.random() / 2)
+            logger.warning(f"[限流] {family} 被服务端限流，暂停 {wait:.1f}s 后重试（第 {attempt} 次）: {url}")
+            bucket.pause(wait)
+            resp.close()
+
+
+def _throttle_wait(resp: requests.Response, stream: bool = False) -> Optional[float]:
+    """未被限流返回 None；被限流返回建议等待秒数（0 表示未给出，由调用方退避）"""
+    throttled = resp.status_code == 429
+    if not throttled and resp.status_code >= 400 and not stream:
+        # 部分接口以 400 + 错误码 99991400 表示频控
+        try:
+            throttled = resp.json().get("code") in FEISHU_RATE_LIMIT_CODES
+        except ValueError:
+            throttled = False
+    if not throttled:
+        return None
+    for header in ("Retry-After", "x-ogw-ratelimit-reset"):
+        value = resp.headers.get(header)
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                continue
+    return 0.0
+
+
+def _is_invalid_token(resp: requests.Response) -> bool:
+    """响应是否为 tenant_access_token 无效/过期（错误响应体很小，流式下载也可直接读取）"""
+    if resp.status_code < 400:
+        return False
+    try:
+        return resp.json().get("code") in FEISHU_INVALID_TOKEN_CODES
+    except ValueError:
+        return False
+
+
+def _build_retry(max_retries: int, backoff_factor: float, backoff_jitter: float,
+                 status_codes=RETRY_STATUS_CODES) -> Retry:
+    kwargs = dict(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        status_forcelist=status_codes,
+        allowed_methods=IDEMPOTENT_METHODS,
+        backoff_factor=backoff_factor,
+        # 由限流层处理 429 时关闭：urllib3 会对带 Retry-After 的 429 无视 status_forcelist 直接重试
+        respect_retry_after_header=429 in status_codes,
+        raise_on_status=False,  # 重试耗尽后返回最后一次响应，由调用方按原逻辑处理状态码
+    )
+    try:
+        return Retry(backoff_jitter=backoff_jitter, **kwargs)
+    except TypeError:
+        # urllib3 < 2.0 不支持 backoff_jitter
+        return Retry(**kwargs)
+
+
+def create_session(pool_connections: int = 10, pool_maxsize: int = 20, max_retries: int = 3,
+                   backoff_factor: float = 0.5, backoff_jitter: float = 0.5,
+                   rate_limiter: Optional[RateLimiter] = None) -> OpenAPISession:
+    """创建带连接池与重试策略的 Session
+
+    Args:
+        pool_connections: 缓存的连接池数量（按 host 划分）
+        pool_maxsize: 每个 host 连接池的最大连接数，应不小于并发请求线程数
+        max_retries: 幂等请求的最大重试次数
+        backoff_factor: 指数退避基数（秒），第 n 次重试前等待约 backoff_factor * 2^(n-1)
+        backoff_jitter: 每次退避额外叠加的随机抖动上限（秒）
+        rate_limiter: 客户端限流器；配置后 429 交由限流层处理，不再由连接层重试
+    """
+    if rate_limiter is not None:
+        session: OpenAPISession = RateLimitedSession(rate_limiter)
+        status_codes = tuple(c for c in RETRY_STATUS_CODES if c != 429)
+    else:
+        session = OpenAPISession()
+        status_codes = RETRY_STATUS_CODES
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=_build_retry(max_retries, backoff_factor, backoff_jitter, status_codes),
+        pool_block=False,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台任务队列
+/feishu/events 只负责校验与入队，拉取、转换、生成桑基图等耗时逻辑由固定数量的工作线程执行。
+队列有最大深度，饱和时 submit 返回 False，由调用方决定如何提示用户。
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """有界任务队列 + 固定大小工作线程池
+
+    工作线程在第一次 submit 时才启动：gunicorn 在 fork 前导入模块时不会产生线程，
+    每个 worker 进程各自拥有一个线程池。
+    """
+
+    def __init__(self, workers: int = 4, max_depth: int = 50, name: str = "sankey-job"):
+        if workers < 1:
+            raise ValueError("workers 必须 >= 1")
+        if max_depth < 1:
+            raise ValueError("max_depth 必须 >= 1")
+        self.workers = workers
+        self.max_depth = max_depth
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_depth)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._started_at: Optional[float] = None
+
+    def _ensure_started(self) -> None:
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker_loop, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._started_at = time.time()
+
+    def submit(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> bool:
+        """提交任务；队列已满时不阻塞，直接返回 False"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def _worker_loop(self) -> None:
+        while True:
+            func, args, kwargs = self._queue.get()
+            with self._lock:
+                self._busy += 1
+            try:
+                func(*args, **kwargs)
+                with self._lock:
+                    self._completed += 1
+            except Exception as e:
+                logger.exception(f"[任务队列] 任务执行失败: {e}")
+                with self._lock:
+                    self._failed += 1
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        """队列深度与工作线程利用率"""
+        with self._lock:
+            busy = self._busy
+            return {
+                "workers": self.workers,
+                "busy_workers": busy,
+                "utilization": round(busy / self.workers, 3),
+                "queue_depth": self._queue.qsize(),
+                "max_depth": self.max_depth,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "failed": self._failed,
+                "started": bool(self._threads),
+            }
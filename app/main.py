@@ -1,12 +1,14 @@
+import io
 import os
 import json
 import time
 import sys
 import urllib.parse
 import socket
+import threading
+import tempfile
 from datetime import datetime, timezone, timedelta
-import requests
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory
 from dotenv import load_dotenv
 from .security import verify_signature
 import pandas as pd
@@ -16,22 +18,40 @@ from typing import Optional
 BEIJING_TZ = timezone(timedelta(hours=8))
 from . import pull_bitable
 from . import cloud_doc_download
-from .multi_sheet_converter import convert_multi_sheet_to_wide_format
+from .multi_sheet_converter import LONG_FORMAT_COLUMNS, convert_multi_sheet_to_wide_format, detect_and_convert_frames
+from .job_queue import JobQueue
+from .dedup_store import DedupStore
+from .token_provider import TenantTokenProvider
+from .http_client import create_session
+from .rate_limiter import RateLimiter, parse_rate_limits
+from .bitable_snapshot import BitableSnapshotStore
+from .metadata_cache import MetadataCache
+from .cloud_doc_cache import CloudDocCache
+from .render_cache import RenderCache
+from .render_pool import (
+    RenderPool, RenderTimeout, init_worker, render_budget_in_worker, render_budget_to_output, render_excel_in_worker,
+)
+from .render_broker import RenderBroker, create_broker
+from . import sankey_page
 import re
 
 # 先加载 .env（如果存在）
 load_dotenv()
 
 # 辅助函数
-def _get_bool(name: str) -> bool:
+def _get_bool(name: str, default: Optional[bool] = None) -> bool:
     v = os.getenv(name)
     if v is None:
+        if default is not None:
+            return default
         raise ValueError(f"环境变量 {name} 未配置，请在 .env 文件中设置")
     return v.lower() in ("1", "true", "yes", "on")
 
-def _get_int(name: str) -> int:
+def _get_int(name: str, default: Optional[int] = None) -> int:
     v = os.getenv(name)
     if v is None:
+        if default is not None:
+            return default
         raise ValueError(f"环境变量 {name} 未配置，请在 .env 文件中设置")
     try:
         return int(v)
@@ -90,12 +110,167 @@ SANKEY_WATCH_DIR = os.getenv("SANKEY_WATCH_DIR")
 if not SANKEY_WATCH_DIR:
     raise ValueError("环境变量 SANKEY_WATCH_DIR 未配置，请在 .env 文件中设置")
 
+# 单个任务中间文件（如多sheet转换出的宽格式 xlsx）的临时目录根路径，每个任务在其下建独立子目录
+SANKEY_SCRATCH_DIR = os.getenv("SANKEY_SCRATCH_DIR") or os.path.join(SANKEY_WATCH_DIR, ".scratch")
+
 SANKEY_LOG_FILE = os.getenv("SANKEY_LOG_FILE")
 if not SANKEY_LOG_FILE:
     raise ValueError("环境变量 SANKEY_LOG_FILE 未配置，请在 .env 文件中设置")
 
 SANKEY_POLL_INTERVAL = _get_int("SANKEY_POLL_INTERVAL")
 
+# ========= 后台任务队列配置 =========
+# 工作线程数（每个 gunicorn worker 进程各自一组）
+JOB_WORKERS = _get_int("JOB_WORKERS", 4)
+# 队列最大深度，超过后回复“服务繁忙”
+JOB_QUEUE_MAX = _get_int("JOB_QUEUE_MAX", 50)
+
+# ========= 事件幂等配置 =========
+# SQLite 文件，同机所有 worker 共享（默认与消息日志同目录）
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH") or os.path.join(
+    os.path.dirname(MESSAGES_LOG_PATH) or ".", "processed_events.db"
+)
+# 已处理记录保留时长（秒）与最大条数
+DEDUP_TTL_SECONDS = _get_int("DEDUP_TTL_SECONDS", 86400)
+DEDUP_MAX_ENTRIES = _get_int("DEDUP_MAX_ENTRIES", 100000)
+
+# ========= tenant_access_token 缓存配置 =========
+# 同机共享的 token 缓存文件（默认与消息日志同目录）
+TENANT_TOKEN_CACHE_PATH = os.getenv("TENANT_TOKEN_CACHE_PATH") or os.path.join(
+    os.path.dirname(MESSAGES_LOG_PATH) or ".", "tenant_token.json"
+)
+# 剩余有效期低于该值（秒）时后台提前刷新
+TENANT_TOKEN_REFRESH_MARGIN = _get_int("TENANT_TOKEN_REFRESH_MARGIN", 300)
+
+# ========= OpenAPI HTTP 连接池配置 =========
+# 每个 host 的最大连接数（应不小于 JOB_WORKERS × 单任务内并发请求数）
+HTTP_POOL_MAXSIZE = _get_int("HTTP_POOL_MAXSIZE", 20)
+# 幂等请求（GET）遇到 429/5xx/连接错误时的最大重试次数
+HTTP_MAX_RETRIES = _get_int("HTTP_MAX_RETRIES", 3)
+# 按接口族的客户端限流（每秒请求数，每个 worker 进程独立计数），如 "bitable_records=10,im_reply=20"
+OPENAPI_RATE_LIMITS = parse_rate_limits(os.getenv("OPENAPI_RATE_LIMITS"))
+
+# ========= 多维表格拉取配置 =========
+# 仅 base 链接（多 table）时同时拉取的 table 数上限
+BITABLE_TABLE_CONCURRENCY = _get_int("BITABLE_TABLE_CONCURRENCY", 4)
+# memory：拉取结果直接在内存中生成桑基图；file：先写 xlsx 再读取（旧流程）
+BITABLE_PIPELINE = os.getenv("BITABLE_PIPELINE", "memory").lower()
+if BITABLE_PIPELINE not in ("memory", "file"):
+    raise ValueError(f"环境变量 BITABLE_PIPELINE 的值 '{BITABLE_PIPELINE}' 无效，应为 memory 或 file")
+# memory 模式下是否在后台写出归档 xlsx 到 OUTPUT_DIR
+BITABLE_ARCHIVE_XLSX = _get_bool("BITABLE_ARCHIVE_XLSX", True)
+# 只拉取的字段（逗号分隔）：默认为多sheet长格式所需的 阶段/项目名称/费用/说明；
+# 只对包含全部这些字段的表生效（其余表如宽格式表仍拉取全部字段）；设为 * 表示始终拉取全部字段
+_field_names = os.getenv("BITABLE_FIELD_NAMES", "").strip()
+if _field_names == "*":
+    BITABLE_FIELD_NAMES = None
+elif _field_names:
+    BITABLE_FIELD_NAMES = [name.strip() for name in _field_names.split(",") if name.strip()]
+else:
+    BITABLE_FIELD_NAMES = list(LONG_FORMAT_COLUMNS)
+# 服务端筛选公式（列表接口 filter 参数），如 CurrentValue.[费用]>0；配置后不使用增量同步
+BITABLE_FILTER = os.getenv("BITABLE_FILTER") or None
+# 增量同步：本地保存记录快照，之后只拉取修改过的记录（表中需有"最后更新时间"字段）
+BITABLE_INCREMENTAL = _get_bool("BITABLE_INCREMENTAL", True)
+# 记录快照 SQLite 文件（同机所有 worker 共享；默认与消息日志同目录）
+BITABLE_SNAPSHOT_DB_PATH = os.getenv("BITABLE_SNAPSHOT_DB_PATH") or os.path.join(
+    os.path.dirname(MESSAGES_LOG_PATH) or ".", "bitable_snapshot.db"
+)
+# 记录数少于该值的表仍全量拉取；一次增量逐条读取超过该条数时改为全量拉取
+BITABLE_INCREMENTAL_MIN_RECORDS = _get_int("BITABLE_INCREMENTAL_MIN_RECORDS", 500)
+BITABLE_INCREMENTAL_MAX_FETCH = _get_int("BITABLE_INCREMENTAL_MAX_FETCH", 50)
+# 元数据缓存：字段定义/类型、视图列布局、table/view 列表、base 名称（同机所有 worker 共享）
+METADATA_CACHE_ENABLED = _get_bool("METADATA_CACHE_ENABLED", True)
+METADATA_CACHE_DB_PATH = os.getenv("METADATA_CACHE_DB_PATH") or os.path.join(
+    os.path.dirname(MESSAGES_LOG_PATH) or ".", "metadata_cache.db"
+)
+METADATA_CACHE_TTL_SECONDS = _get_int("METADATA_CACHE_TTL_SECONDS", 600)
+METADATA_CACHE_MAX_ENTRIES = _get_int("METADATA_CACHE_MAX_ENTRIES", 2000)
+# 使元数据缓存失效的事件：字段变更（携带 table_id）与文档标题变更
+METADATA_INVALIDATING_EVENTS = ("drive.file.bitable_field_changed_v1", "drive.file.title_updated_v1")
+
+# ========= 桑基图渲染缓存配置 =========
+# 相同数据 + 标题已渲染过时直接返回已有 HTML 链接
+RENDER_CACHE_ENABLED = _get_bool("RENDER_CACHE_ENABLED", True)
+# 缓存索引（SQLite，同机所有 worker 共享；默认与消息日志同目录，不放在 SANKEY_OUTPUT_DIR 中）
+RENDER_CACHE_DB_PATH = os.getenv("RENDER_CACHE_DB_PATH") or os.path.join(
+    os.path.dirname(MESSAGES_LOG_PATH) or ".", "render_cache.db"
+)
+# 超过上限时按最近使用时间淘汰，并删除 SANKEY_OUTPUT_DIR 中对应的 HTML，已发出的旧链接随之失效
+# （默认 0 表示不限：不淘汰、不删除任何 HTML）
+RENDER_CACHE_MAX_ENTRIES = _get_int("RENDER_CACHE_MAX_ENTRIES", 0)
+RENDER_CACHE_MAX_MB = _get_int("RENDER_CACHE_MAX_MB", 0)
+
+# ========= 渲染进程池配置 =========
+# Excel 解析、多sheet转换、边表生成与渲染交给预热的子进程执行的进程数（每个 worker 进程独立；0 表示在任务线程中执行）
+RENDER_PROCESSES = _get_int("RENDER_PROCESSES", 2)
+# 每个子进程处理的任务数上限，达到后替换为新进程（限制内存增长；0 表示不替换）
+RENDER_MAX_TASKS_PER_CHILD = _get_int("RENDER_MAX_TASKS_PER_CHILD", 50)
+# 单个渲染任务的超时（秒），超时后终止子进程并提示生成失败
+RENDER_TIMEOUT_SECONDS = _get_int("RENDER_TIMEOUT_SECONDS", 120)
+
+# ========= 分布式渲染配置 =========
+# 拉取→转换→渲染的执行位置：local（本进程，默认）/ broker（提交到任务代理，由渲染 worker 执行）
+RENDER_DISPATCH = os.getenv("RENDER_DISPATCH", "local").lower()
+if RENDER_DISPATCH not in ("local", "broker"):
+    raise ValueError(f"环境变量 RENDER_DISPATCH 的值 '{RENDER_DISPATCH}' 无效，应为 local 或 broker")
+# 任务代理地址：sqlite:///路径.db（默认与消息日志同目录；仅限同一主机，不能放在网络文件系统上）
+# 或 包.模块:类名（自定义 RenderBroker 实现，跨主机部署时使用）
+RENDER_BROKER_URL = os.getenv("RENDER_BROKER_URL") or "sqlite://" + os.path.abspath(
+    os.path.join(os.path.dirname(MESSAGES_LOG_PATH) or ".", "render_broker.db")
+)
+# 事件接收服务等待单个任务结果的最长时间（秒），超时后取消任务并提示生成失败
+RENDER_JOB_TIMEOUT_SECONDS = _get_int("RENDER_JOB_TIMEOUT_SECONDS", 600)
+# 渲染 worker 领取任务后的租约（秒）：执行期间每 1/3 租约心跳续租；worker 失联时，任务在租约到期后由其他 worker 重新执行
+RENDER_JOB_LEASE_SECONDS = _get_int("RENDER_JOB_LEASE_SECONDS", 300)
+if RENDER_JOB_LEASE_SECONDS < 10:
+    raise ValueError(f"环境变量 RENDER_JOB_LEASE_SECONDS 的值 {RENDER_JOB_LEASE_SECONDS} 过小，应不小于 10 秒（心跳间隔为租约的 1/3）")
+# 单个任务最多执行的次数（含 worker 失联后的重试）
+RENDER_JOB_MAX_ATTEMPTS = _get_int("RENDER_JOB_MAX_ATTEMPTS", 2)
+# 已结束任务（含 HTML 产物）在任务代理中的保留时长（秒）
+RENDER_JOB_RETENTION_SECONDS = _get_int("RENDER_JOB_RETENTION_SECONDS", 86400)
+
+# ========= 桑基图页面配置 =========
+# shell（默认）：每张图只保存数据文档 {名称}_桑基图.json，页面为共用外壳，加载本服务托管的 ECharts 后请求数据渲染
+# standalone：每张图生成完整 HTML（内嵌数据，引用 pyecharts 默认的远程 ECharts）
+SANKEY_PAGE_MODE = os.getenv("SANKEY_PAGE_MODE", "shell").lower()
+if SANKEY_PAGE_MODE not in ("shell", "standalone"):
+    raise ValueError(f"环境变量 SANKEY_PAGE_MODE 的值 '{SANKEY_PAGE_MODE}' 无效，应为 shell 或 standalone")
+# 本服务托管的 echarts.min.js 版本（出现在资源 URL 中，升级文件时同时修改，浏览器缓存随之失效）
+ECHARTS_VERSION = os.getenv("ECHARTS_VERSION", "6.0.0")
+# echarts.min.js 文件路径（默认 app/static/echarts.min.js，由 package.sh 打包时下载；文件不存在时回退为 standalone）
+ECHARTS_ASSET_PATH = os.getenv("ECHARTS_ASSET_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "static", "echarts.min.js"
+)
+# 资源 URL 含版本号、内容不变：浏览器缓存一年，且不再校验
+ECHARTS_CACHE_MAX_AGE = 365 * 24 * 3600
+
+# ========= 云文档读取配置 =========
+# 电子表格按 sheet 读取时同时进行的读取请求数上限（sheet 或分段）
+SHEETS_READ_CONCURRENCY = _get_int("SHEETS_READ_CONCURRENCY", 4)
+# 单次读取的最大行数：行数更多的 sheet 按行区间分段并发读取（0 表示不分段）
+SHEETS_READ_CHUNK_ROWS = _get_int("SHEETS_READ_CHUNK_ROWS", 5000)
+
+# 直接下载（/file/ 链接）每次读取的字节数（KB）
+CLOUD_DOC_DOWNLOAD_CHUNK_KB = _get_int("CLOUD_DOC_DOWNLOAD_CHUNK_KB", 256)
+# 直接下载的文件大小上限（MB），超过时中止下载并提示用户；0 表示不限
+CLOUD_DOC_MAX_MB = _get_int("CLOUD_DOC_MAX_MB", 200)
+# 不超过该大小（MB）的下载文件只在内存中接收与解析，不写临时文件；0 表示始终写文件
+CLOUD_DOC_MEMORY_MAX_MB = _get_int("CLOUD_DOC_MEMORY_MAX_MB", 20)
+# 内存接收时是否在后台把原文件归档到 OUTPUT_DIR
+CLOUD_DOC_ARCHIVE_XLSX = _get_bool("CLOUD_DOC_ARCHIVE_XLSX", True)
+
+# ========= 云文档下载缓存配置 =========
+# 文档版本（电子表格 revision / 文件最后修改时间）未变时复用上次下载的 Excel
+CLOUD_DOC_CACHE_ENABLED = _get_bool("CLOUD_DOC_CACHE_ENABLED", True)
+# 缓存目录（含索引 index.db，同机所有 worker 共享；默认与消息日志同目录）
+CLOUD_DOC_CACHE_DIR = os.getenv("CLOUD_DOC_CACHE_DIR") or os.path.join(
+    os.path.dirname(MESSAGES_LOG_PATH) or ".", "cloud_doc_cache"
+)
+# 超过上限时按最近使用时间淘汰（0 表示不限）
+CLOUD_DOC_CACHE_MAX_ENTRIES = _get_int("CLOUD_DOC_CACHE_MAX_ENTRIES", 200)
+CLOUD_DOC_CACHE_MAX_MB = _get_int("CLOUD_DOC_CACHE_MAX_MB", 500)
+
 # 保留但不再使用的配置（兼容性）
 SANKEY_WEBHOOK_URL = os.getenv("SANKEY_WEBHOOK_URL", "")
 SANKEY_HTML_SERVER_PORT = os.getenv("SANKEY_HTML_SERVER_PORT", "")
@@ -135,6 +310,22 @@ except Exception as inner_err:
         traceback.print_exc()
         SankeyService = None
 
+# 数据文档需要桑基图服务支持（外部路径的旧版本服务只能生成完整 HTML）
+if SANKEY_PAGE_MODE == "shell" and not getattr(SankeyService, "SUPPORTS_CHART_DATA", False):
+    print("[WARNING] 桑基图服务不支持数据文档输出，SANKEY_PAGE_MODE 回退为 standalone")
+    SANKEY_PAGE_MODE = "standalone"
+
+ECHARTS_ASSET_AVAILABLE = os.path.isfile(ECHARTS_ASSET_PATH)
+if SANKEY_PAGE_MODE == "shell" and not ECHARTS_ASSET_AVAILABLE:
+    print(f"[WARNING] 未找到 {ECHARTS_ASSET_PATH}（请用 package.sh 打包或按 .env.example 下载），"
+          f"SANKEY_PAGE_MODE 回退为 standalone")
+    SANKEY_PAGE_MODE = "standalone"
+# 数据文档的共用页面外壳（所有图表相同，进程启动时生成一次；standalone 模式下继续用于此前生成的数据文档，
+# 本地 ECharts 缺失时这些页面与完整 HTML 一样引用远程 ECharts）
+SANKEY_PAGE_SHELL = sankey_page.render_shell(
+    sankey_page.echarts_asset_url(ECHARTS_VERSION) if ECHARTS_ASSET_AVAILABLE else sankey_page.ECHARTS_REMOTE_SRC
+) if getattr(SankeyService, "SUPPORTS_CHART_DATA", False) else None
+
 
 def get_local_ip():
     """动态获取本机IP地址"""
@@ -189,21 +380,23 @@ def get_sankey_html_base_url():
     server_ip = "10.77.79.147"  # 固定服务器IP
     return f"http://{server_ip}:{PORT}/sankey"
 
-# 简单的 tenant_access_token 内存缓存
-TENANT_TOKEN_CACHE = {"token": None, "expire_at": 0.0}
+# 所有飞书 OpenAPI 调用共用一个带连接池、重试与客户端限流的 Session
+RATE_LIMITER = RateLimiter(OPENAPI_RATE_LIMITS)
+HTTP_SESSION = create_session(pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=HTTP_MAX_RETRIES,
+                              rate_limiter=RATE_LIMITER)
+pull_bitable.set_http_session(HTTP_SESSION)
+cloud_doc_download.set_http_session(HTTP_SESSION)
+
+# tenant_access_token：同机所有 worker 共享缓存，过期前后台刷新，并发获取时只请求一次
+TOKEN_PROVIDER = TenantTokenProvider(
+    OPEN_BASE, APP_ID, APP_SECRET, TENANT_TOKEN_CACHE_PATH, refresh_margin=TENANT_TOKEN_REFRESH_MARGIN,
+    session=HTTP_SESSION,
+)
+# OpenAPI 返回 token 无效/过期（如被吊销）时作废共享缓存中的 token，刷新后重发一次
+HTTP_SESSION.set_token_refresher(TOKEN_PROVIDER.renew)
 
 def get_tenant_access_token() -> str:
-    now = time.time()
-    if TENANT_TOKEN_CACHE["token"] and TENANT_TOKEN_CACHE["expire_at"] - now > 60:
-        return TENANT_TOKEN_CACHE["token"]
-    url = f"{OPEN_BASE}/open-apis/auth/v3/tenant_access_token/internal"
-    resp = requests.post(url, json={"app_id": APP_ID, "app_secret": APP_SECRET}, timeout=5)
-    data = resp.json()
-    if data.get("code") != 0:
-        raise RuntimeError(f"get_tenant_access_token failed: {data}")
-    TENANT_TOKEN_CACHE["token"] = data["tenant_access_token"]
-    TENANT_TOKEN_CACHE["expire_at"] = now + float(data.get("expire", 7000))
-    return TENANT_TOKEN_CACHE["token"]
+    return TOKEN_PROVIDER.get_token()
 
 def reply_message(message_id: str, text: str) -> dict:
     token = get_tenant_access_token()
@@ -212,34 +405,59 @@ def reply_message(message_id: str, text: str) -> dict:
         "msg_type": "text",
         "content": json.dumps({"text": text}, ensure_ascii=False)
     }
-    r = requests.post(url, headers={"Authorization": f"Bearer {token}"}, json=payload, timeout=5)
+    r = HTTP_SESSION.post(url, headers={"Authorization": f"Bearer {token}"}, json=payload, timeout=5)
     try:
         return r.json()
     except Exception:
         return {"status_code": r.status_code, "text": r.text}
 
 
+def _cached_metadata(kind: str, app_token: str, loader, table_id: str = "", view_id: str = ""):
+    """经元数据缓存获取（未启用缓存时直接调用 loader）；loader 返回 None 表示获取失败，不缓存"""
+    if METADATA_CACHE is None:
+        return loader()
+    return METADATA_CACHE.get_or_load(kind, app_token, loader, table_id=table_id, view_id=view_id)
+
+
 def get_table_name(open_base: str, app_token: str, table_id: str, tenant_token: str) -> str:
     """获取表格名称"""
-    headers = {"Authorization": f"Bearer {tenant_token}"}
-    url = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}"
-    r = requests.get(url, headers=headers, timeout=10).json()
-    if r.get("code") != 0:
-        return f"table_{table_id}"
-    return r.get("data", {}).get("table", {}).get("name", f"table_{table_id}")
+    def load() -> Optional[str]:
+        headers = {"Authorization": f"Bearer {tenant_token}"}
+        url = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}"
+        r = HTTP_SESSION.get(url, headers=headers, timeout=10).json()
+        if r.get("code") != 0:
+            return None
+        return r.get("data", {}).get("table", {}).get("name", f"table_{table_id}")
+
+    return _cached_metadata("table_name", app_token, load, table_id=table_id) or f"table_{table_id}"
 
 
 def get_base_name(open_base: str, app_token: str, tenant_token: str) -> str:
     """获取多维表格（base/app）的名称"""
-    headers = {"Authorization": f"Bearer {tenant_token}"}
-    url = f"{open_base}/open-apis/bitable/v1/apps/{app_token}"
-    r = requests.get(url, headers=headers, timeout=10).json()
-    if r.get("code") != 0:
-        return f"base_{app_token}"
-    # API 返回结构可能是 data.app.name 或 data.name
-    app_data = r.get("data", {})
-    base_name = app_data.get("app", {}).get("name") or app_data.get("name") or f"base_{app_token}"
-    return base_name
+    def load() -> Optional[str]:
+        headers = {"Authorization": f"Bearer {tenant_token}"}
+        url = f"{open_base}/open-apis/bitable/v1/apps/{app_token}"
+        r = HTTP_SESSION.get(url, headers=headers, timeout=10).json()
+        if r.get("code") != 0:
+            return None
+        # API 返回结构可能是 data.app.name 或 data.name
+        app_data = r.get("data", {})
+        return app_data.get("app", {}).get("name") or app_data.get("name") or f"base_{app_token}"
+
+    return _cached_metadata("base_name", app_token, load) or f"base_{app_token}"
+
+
+def list_table_views(open_base: str, app_token: str, table_id: str, tenant_token: str) -> list:
+    """获取表的视图列表（第一页，最多 200 个）；请求失败时返回空列表"""
+    def load() -> Optional[list]:
+        headers = {"Authorization": f"Bearer {tenant_token}"}
+        url = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/views"
+        rv = HTTP_SESSION.get(url, headers=headers, params={"page_size": 200}, timeout=10).json()
+        if rv.get("code") != 0:
+            return None
+        return rv.get("data", {}).get("items") or []
+
+    return _cached_metadata("views", app_token, load, table_id=table_id) or []
 
 
 def get_beijing_timestamp() -> str:
@@ -247,9 +465,10 @@ def get_beijing_timestamp() -> str:
     return datetime.now(BEIJING_TZ).strftime("%Y%m%d_%H%M%S")
 
 
-def detect_and_convert_multi_sheet(excel_file_path: str) -> tuple[bool, Optional[str]]:
+def detect_and_convert_multi_sheet(excel_file_path: str, output_dir: Optional[str] = None) -> tuple[bool, Optional[str]]:
     """
     检测Excel是否为多sheet长格式，如果是则转换为宽格式
+    output_dir: 宽格式文件目录（默认与原文件同目录），文件名为 {原文件名}_宽格式.xlsx
     
     Returns:
         (是否需要转换, 转换后的文件路径或None)
@@ -264,15 +483,17 @@ def detect_and_convert_multi_sheet(excel_file_path: str) -> tuple[bool, Optional
         
         # 检查第一个sheet是否符合长格式（阶段、项目名称、费用、说明）
         first_sheet = list(excel_data.values())[0]
-        required_cols = ['阶段', '项目名称', '费用', '说明']
-        
-        if not all(col in first_sheet.columns for col in required_cols):
+        if not all(col in first_sheet.columns for col in LONG_FORMAT_COLUMNS):
             # 不符合长格式，可能是宽格式，不需要转换
             return False, None
         
         # 符合多sheet长格式，需要转换
         app.logger.info(f"[多sheet检测] 检测到多sheet长格式Excel，开始转换")
-        wide_file_path = convert_multi_sheet_to_wide_format(excel_file_path)
+        output_path = None
+        if output_dir:
+            base_name = os.path.splitext(os.path.basename(excel_file_path))[0]
+            output_path = os.path.join(output_dir, f"{base_name}_宽格式.xlsx")
+        wide_file_path = convert_multi_sheet_to_wide_format(excel_file_path, output_path)
         return True, wide_file_path
         
     except Exception as e:
@@ -280,6 +501,12 @@ def detect_and_convert_multi_sheet(excel_file_path: str) -> tuple[bool, Optional
         return False, None
 
 
+def job_scratch_dir():
+    """单个任务的临时目录（with 语句结束后连同其中文件一起删除），并发任务的中间文件互不覆盖"""
+    os.makedirs(SANKEY_SCRATCH_DIR, exist_ok=True)
+    return tempfile.TemporaryDirectory(prefix="sankey-job-", dir=SANKEY_SCRATCH_DIR)
+
+
 def generate_sankey_and_notify(excel_file_path: str, base_name: str) -> tuple[bool, str]:
     """生成桑基图（支持多sheet长格式自动转换）
     返回: (是否成功, HTML文件路径或错误类型)
@@ -287,171 +514,387 @@ def generate_sankey_and_notify(excel_file_path: str, base_name: str) -> tuple[bo
     """
     app.logger.info(f"[桑基图生成] 开始处理，Excel文件: {excel_file_path}, Base名称: {base_name}")
     
-    # 检测并转换多sheet长格式
-    needs_conversion, converted_file = detect_and_convert_multi_sheet(excel_file_path)
-    converted_file_to_cleanup = None
+    if RENDER_BROKER is not None:
+        if not os.path.exists(excel_file_path):
+            app.logger.error(f"[桑基图生成] 失败：Excel文件不存在 - {excel_file_path}")
+            return False, "file_not_found"
+        with open(excel_file_path, "rb") as f:
+            content = f.read()
+        source_name = os.path.splitext(os.path.basename(excel_file_path))[0]
+        return _dispatch_render_job({"kind": "excel", "source_name": source_name, "base_name": base_name}, content)
     
-    if needs_conversion and converted_file:
-        app.logger.info(f"[桑基图生成] 已转换为宽格式: {converted_file}")
-        # 使用转换后的文件
-        converted_file_to_cleanup = converted_file
-        excel_file_path = converted_file
-        # 更新base_name（用于文件命名）
-        excel_basename = os.path.splitext(os.path.basename(converted_file))[0]
-        base_name = excel_basename.replace("_宽格式", "")
+    if RENDER_POOL is not None:
+        if not os.path.exists(excel_file_path):
+            app.logger.error(f"[桑基图生成] 失败：Excel文件不存在 - {excel_file_path}")
+            return False, "file_not_found"
+        # 读取与多sheet转换在渲染进程中完成，不再写中间的宽格式文件
+        return _generate_sankey_in_pool(excel_file_path, os.path.splitext(os.path.basename(excel_file_path))[0])
     
+    # 多sheet转换生成的宽格式文件写入本任务的临时目录，处理结束后自动删除
+    with job_scratch_dir() as scratch_dir:
+        # 检测并转换多sheet长格式
+        needs_conversion, converted_file = detect_and_convert_multi_sheet(excel_file_path, output_dir=scratch_dir)
+        
+        if needs_conversion and converted_file:
+            app.logger.info(f"[桑基图生成] 已转换为宽格式: {converted_file}")
+            # 使用转换后的文件
+            excel_file_path = converted_file
+        
+        if SankeyService is None:
+            app.logger.error("[桑基图生成] 失败：SankeyService 未初始化，可能是导入失败")
+            return False, "service_error"
+        
+        # 检查 Excel 文件是否存在
+        if not os.path.exists(excel_file_path):
+            app.logger.error(f"[桑基图生成] 失败：Excel文件不存在 - {excel_file_path}")
+            return False, "file_not_found"
+        
+        app.logger.info(f"[桑基图生成] Excel文件验证通过，文件大小: {os.path.getsize(excel_file_path)} bytes")
+        excel_basename = os.path.splitext(os.path.basename(excel_file_path))[0]
+        return _render_sankey(excel_file_path, excel_basename)
+
+
+def generate_sankey_from_frames(frames: dict, source_name: str, base_name: str) -> tuple[bool, str]:
+    """内存数据版 generate_sankey_and_notify：拉取到的 DataFrame 直接用于生成边表与渲染，不经过 xlsx 读写
+    source_name: 与 xlsx 文件名同格式的名称（不含扩展名），用于 HTML 文件名与图表标题，保证与文件流程输出一致
+    """
+    app.logger.info(f"[桑基图生成] 开始处理（内存数据），sheet数: {len(frames)}, Base名称: {base_name}")
     if SankeyService is None:
         app.logger.error("[桑基图生成] 失败：SankeyService 未初始化，可能是导入失败")
         return False, "service_error"
+    if not frames:
+        app.logger.error("[桑基图生成] 失败：没有可用的数据")
+        return False, "format_error"
     
-    # 检查 Excel 文件是否存在
-    if not os.path.exists(excel_file_path):
-        app.logger.error(f"[桑基图生成] 失败：Excel文件不存在 - {excel_file_path}")
-        return False, "file_not_found"
-    
-    app.logger.info(f"[桑基图生成] Excel文件验证通过，文件大小: {os.path.getsize(excel_file_path)} bytes")
-    
-    edges_file_path = None
+    needs_conversion, budget_df = detect_and_convert_frames(frames)
+    if needs_conversion:
+        app.logger.info("[桑基图生成] 已转换为宽格式（内存）")
+        source_name = f"{source_name}_宽格式"
+    return _render_sankey(budget_df, source_name)
+
+
+def generate_sankey_from_bytes(content: bytes, source_name: str, base_name: str) -> tuple[bool, str]:
+    """内存版 generate_sankey_and_notify：下载到内存的 Excel 直接解析为 DataFrame，不经过临时文件
+    source_name: 与 xlsx 文件名同格式的名称（不含扩展名），保证与文件流程输出一致
+    """
+    if RENDER_BROKER is not None:
+        return _dispatch_render_job({"kind": "excel", "source_name": source_name, "base_name": base_name}, content)
+    if RENDER_POOL is not None:
+        # Excel 解析与多sheet转换也在渲染进程中完成
+        return _generate_sankey_in_pool(content, source_name)
+    try:
+        frames = pd.read_excel(io.BytesIO(content), sheet_name=None, header=0)
+    except Exception as e:
+        app.logger.exception(f"[桑基图生成] 失败：解析 Excel 内容出错 - {e}")
+        return False, "format_error"
+    return generate_sankey_from_frames(frames, source_name, base_name)
+
+
+def _generate_sankey_in_pool(source, source_name: str) -> tuple[bool, str]:
+    """在渲染进程中用一个任务完成 Excel（文件路径或内容）解析、多sheet转换、渲染缓存查询与渲染
+    经过多sheet转换时 source_name 追加 _宽格式（见 render_excel_to_output）
+    """
+    app.logger.info(f"[桑基图生成] 在渲染进程中解析并生成桑基图: {source_name}")
+    try:
+        result = RENDER_POOL.run(render_excel_in_worker, source, source_name, SANKEY_OUTPUT_DIR,
+                                 SANKEY_PAGE_MODE == "shell")
+    except RenderTimeout as e:
+        app.logger.error(f"[桑基图生成] 失败：{e} - {source_name}")
+        return False, "桑基图生成失败"
+    except Exception as e:
+        app.logger.exception(f"[桑基图生成] 失败：渲染进程池执行出错 - {e}")
+        return False, "桑基图生成失败"
+    return _sankey_render_result(result, pooled=True)
+
+
+def _archive_bytes(content: bytes, outfile: str) -> None:
+    """后台写出下载到内存的原文件（先写临时文件再替换），不阻塞桑基图生成"""
+    tmp_path = f"{outfile}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, outfile)
+        app.logger.info(f"[归档] 云文档已写出: {outfile}")
+    except Exception as e:
+        app.logger.warning(f"[归档] 写出云文档失败: {outfile}, 错误: {e}")
+
+
+def _archive_frames(frames: dict, outfile: str) -> None:
+    """后台写出归档 xlsx（与文件流程生成的 Excel 内容一致），不阻塞桑基图生成"""
     try:
-        # 创建桑基图服务实例（不启动轮询，只用于单次生成）
-        app.logger.info(f"[桑基图生成] 创建服务实例，watch_dir={SANKEY_WATCH_DIR}, output_dir={SANKEY_OUTPUT_DIR}")
-        sankey_service = SankeyService(
-            watch_dir=SANKEY_WATCH_DIR,
-            output_dir=SANKEY_OUTPUT_DIR,
-            log_file=SANKEY_LOG_FILE,
-            poll_interval=SANKEY_POLL_INTERVAL
+        with pd.ExcelWriter(outfile, engine='openpyxl') as writer:
+            for sheet_name, df in frames.items():
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
+        app.logger.info(f"[归档] 多维表格数据已写出: {outfile}")
+    except Exception as e:
+        app.logger.warning(f"[归档] 写出多维表格 xlsx 失败: {outfile}, 错误: {e}")
+
+
+def pull_bitable_and_generate(app_token: str, table_id: Optional[str], view_id: Optional[str],
+                              token: str, base_name: str, file_stem: str) -> tuple[bool, str]:
+    """拉取多维表格并生成桑基图；失败时使该多维表格的元数据缓存失效（下次重新获取字段与视图）
+    RENDER_DISPATCH=broker 时整个任务交给渲染 worker（worker 自行获取 token，任务中不携带凭证）
+    """
+    if RENDER_BROKER is not None:
+        return _dispatch_render_job({
+            "kind": "bitable", "app_token": app_token, "table_id": table_id, "view_id": view_id,
+            "base_name": base_name, "file_stem": file_stem,
+        })
+    try:
+        success, result = _pull_bitable_and_generate(app_token, table_id, view_id, token, base_name, file_stem)
+    except Exception:
+        _invalidate_metadata(app_token)
+        raise
+    if not success:
+        _invalidate_metadata(app_token)
+    return success, result
+
+
+def _invalidate_metadata(app_token: str, table_id: Optional[str] = None) -> None:
+    if METADATA_CACHE is None:
+        return
+    removed = METADATA_CACHE.invalidate(app_token, table_id)
+    app.logger.info(f"[元数据缓存] 已失效: app_token={app_token}, table_id={table_id}, 条目数={removed}")
+
+
+def _pull_bitable_and_generate(app_token: str, table_id: Optional[str], view_id: Optional[str],
+                               token: str, base_name: str, file_stem: str) -> tuple[bool, str]:
+    """拉取多维表格并生成桑基图
+    - BITABLE_PIPELINE=memory（默认）：记录直接构建 DataFrame 用于边表与渲染；归档 xlsx 可选，在后台线程写出
+    - BITABLE_PIPELINE=file：拉取写 xlsx，再由 generate_sankey_and_notify 读取
+    file_stem: 输出文件名（不含扩展名），格式为 多维表格名-发送者ID-时间戳
+    """
+    outfile = os.path.join(OUTPUT_DIR, f"{file_stem}.xlsx")
+    if BITABLE_PIPELINE == "file":
+        result = pull_bitable.pull_to_files(
+            OPEN_BASE, APP_ID, APP_SECRET, app_token, table_id, view_id, outfile,
+            tenant_token=token, table_concurrency=BITABLE_TABLE_CONCURRENCY,
+            snapshot_store=BITABLE_SNAPSHOT_STORE,
+            field_names=BITABLE_FIELD_NAMES, record_filter=BITABLE_FILTER,
         )
-        app.logger.info("[桑基图生成] 服务实例创建成功")
-        
-        # 步骤1: 将预算文件转换为边表文件
-        app.logger.info(f"[桑基图生成] 步骤1：开始转换预算文件为边表 - {os.path.basename(excel_file_path)}")
-        try:
-            edges_file_path = sankey_service.convert_budget_to_edges(excel_file_path)
-        except KeyError as e:
-            app.logger.exception(f"[桑基图生成] 步骤1失败：缺少必要的列 - {e}")
-            return False, "format_error"
-        except IndexError as e:
-            app.logger.exception(f"[桑基图生成] 步骤1失败：数据行不完整 - {e}")
-            return False, "format_error"
-        except Exception as convert_err:
-            app.logger.exception(f"[桑基图生成] 步骤1失败：转换预算文件时出错 - {convert_err}")
-            return False, "format_error"
-        
-        if not edges_file_path:
-            app.logger.error("[桑基图生成] 步骤1失败：convert_budget_to_edges 返回 None")
-            return False, "format_error"
-        
-        if not os.path.exists(edges_file_path):
-            app.logger.error(f"[桑基图生成] 步骤1失败：边表文件不存在 - {edges_file_path}")
-            return False, "桑基图生成失败"
-        
-        app.logger.info(f"[桑基图生成] 步骤1成功：边表文件已生成 - {os.path.basename(edges_file_path)}, 文件大小: {os.path.getsize(edges_file_path)} bytes")
-        
-        # 步骤2: 生成HTML文件名
-        excel_basename = os.path.splitext(os.path.basename(excel_file_path))[0]
-        html_filename = f"{excel_basename}_桑基图.html"
-        html_output_path = os.path.join(SANKEY_OUTPUT_DIR, html_filename)
-        app.logger.info(f"[桑基图生成] 步骤2：HTML输出路径 - {html_output_path}")
-        
-        # 步骤3: 生成桑基图
-        app.logger.info(f"[桑基图生成] 步骤3：开始生成桑基图HTML，边表文件: {edges_file_path}, 预算文件: {excel_file_path}")
-        try:
-            success = sankey_service.generate_sankey_chart(
-                edges_path=edges_file_path,           # 转换后的边表文件
-                output_html_path=html_output_path,
-                budget_path=excel_file_path            # 原始预算文件（用于加载节点描述）
-            )
-        except Exception as chart_err:
-            app.logger.exception(f"[桑基图生成] 步骤3失败：生成桑基图时出错 - {chart_err}")
-            # 清理临时文件
-            try:
-                if edges_file_path and os.path.exists(edges_file_path):
-                    os.remove(edges_file_path)
-                    app.logger.info(f"[桑基图生成] 已清理临时边表文件: {os.path.basename(edges_file_path)}")
-            except Exception as cleanup_err:
-                app.logger.warning(f"[桑基图生成] 清理临时文件失败: {cleanup_err}")
-            return False, "桑基图生成失败"
-        
-        # 步骤4: 生成完成后清理临时边表文件
-        if success:
-            app.logger.info(f"[桑基图生成] 步骤3成功：桑基图HTML已生成 - {html_output_path}")
-            
-            # 验证HTML文件是否存在
-            if not os.path.exists(html_output_path):
-                app.logger.error(f"[桑基图生成] 失败：HTML文件未生成 - {html_output_path}")
-                # 清理临时文件
-                try:
-                    if edges_file_path and os.path.exists(edges_file_path):
-                        os.remove(edges_file_path)
-                except Exception:
-                    pass
-                return False, "桑基图生成失败"
-            
-            app.logger.info(f"[桑基图生成] HTML文件验证通过，文件大小: {os.path.getsize(html_output_path)} bytes")
-            
-            # 清理临时边表文件
-            try:
-                if edges_file_path and os.path.exists(edges_file_path):
-                    os.remove(edges_file_path)
-                    app.logger.info(f"[桑基图生成] 已删除临时边表文件: {os.path.basename(edges_file_path)}")
-            except Exception as e:
-                app.logger.warning(f"[桑基图生成] 删除临时边表文件失败: {e}")
-            
-            # 清理转换后的临时文件（如果是多sheet转换生成的）
-            if converted_file_to_cleanup and os.path.exists(converted_file_to_cleanup):
-                try:
-                    os.remove(converted_file_to_cleanup)
-                    app.logger.info(f"[桑基图生成] 已删除临时转换文件: {os.path.basename(converted_file_to_cleanup)}")
-                except Exception as e:
-                    app.logger.warning(f"[桑基图生成] 删除临时转换文件失败: {e}")
-            
-            # 返回可访问的 HTTP URL
-            base_url = get_sankey_html_base_url()
-            html_url = f"{base_url}/{urllib.parse.quote(html_filename)}"
-            app.logger.info(f"[桑基图生成] 生成成功，返回URL: {html_url}")
-            return True, html_url
+        app.logger.info(f"[消息处理] Excel拉取完成: count={result.get('count')}, file={result.get('xlsx')}")
+        app.logger.info(f"[消息处理] 开始生成桑基图，Excel文件: {result.get('xlsx')}, Base名称: {base_name}")
+        return generate_sankey_and_notify(result['xlsx'], base_name)
+
+    result = pull_bitable.pull_to_frames(
+        OPEN_BASE, APP_ID, APP_SECRET, app_token, table_id, view_id,
+        tenant_token=token, table_concurrency=BITABLE_TABLE_CONCURRENCY,
+        snapshot_store=BITABLE_SNAPSHOT_STORE,
+        field_names=BITABLE_FIELD_NAMES, record_filter=BITABLE_FILTER,
+    )
+    frames = result["frames"]
+    app.logger.info(f"[消息处理] 多维表格拉取完成（内存）: count={result.get('count')}, sheets={list(frames)}")
+    if BITABLE_ARCHIVE_XLSX:
+        threading.Thread(target=_archive_frames, args=(frames, outfile), daemon=True).start()
+    app.logger.info(f"[消息处理] 开始生成桑基图，Base名称: {base_name}")
+    return generate_sankey_from_frames(frames, file_stem, base_name)
+
+
+def _sankey_html_url(html_filename: str) -> str:
+    """图表页面链接；数据文档（.json）对应同名 .html 页面（由共用外壳提供）"""
+    return f"{get_sankey_html_base_url()}/{urllib.parse.quote(sankey_page.page_filename(html_filename))}"
+
+
+def sankey_artifact_filename(html_url: str) -> str:
+    """_sankey_html_url 的逆操作：从链接取回 SANKEY_OUTPUT_DIR 中的产物文件名（完整 HTML 或数据文档）"""
+    html_filename = urllib.parse.unquote(html_url.rsplit("/", 1)[-1])
+    if os.path.exists(os.path.join(SANKEY_OUTPUT_DIR, html_filename)):
+        return html_filename
+    return sankey_page.data_filename(html_filename)
+
+
+def run_render_job(job: dict, content: Optional[bytes] = None) -> tuple[bool, str]:
+    """在本进程执行一个渲染任务（渲染 worker 调用）；返回值与 pull_bitable_and_generate 等一致
+    kind=bitable: 拉取多维表格并生成桑基图；kind=excel: content 为 Excel 文件内容
+    """
+    kind = job.get("kind")
+    if kind == "bitable":
+        return pull_bitable_and_generate(
+            job["app_token"], job.get("table_id"), job.get("view_id"),
+            get_tenant_access_token(), job["base_name"], job["file_stem"],
+        )
+    if kind == "excel":
+        return generate_sankey_from_bytes(content, job["source_name"], job["base_name"])
+    raise ValueError(f"未知的渲染任务类型: {kind}")
+
+
+def _dispatch_render_job(job: dict, content: Optional[bytes] = None) -> tuple[bool, str]:
+    """提交渲染任务并等待渲染 worker 完成：产物（HTML 或数据文档）写入 SANKEY_OUTPUT_DIR 后返回页面链接
+    worker 执行时抛出的 RuntimeError（如多维表格权限错误）在这里重新抛出，回复逻辑与本地执行一致
+    """
+    job_id = RENDER_BROKER.submit(job, content)
+    app.logger.info(f"[分布式渲染] 已提交任务: job_id={job_id}, kind={job.get('kind')}")
+    record = RENDER_BROKER.wait(job_id, RENDER_JOB_TIMEOUT_SECONDS)
+    if record is None:
+        RENDER_BROKER.cancel(job_id)
+        app.logger.error(f"[分布式渲染] 等待任务结果超时（{RENDER_JOB_TIMEOUT_SECONDS}s），已取消: job_id={job_id}")
+        return False, "桑基图生成失败"
+    app.logger.info(f"[分布式渲染] 任务结束: job_id={job_id}, status={record['status']}, worker={record['worker']}, "
+                    f"attempts={record['attempts']}")
+    if not record["success"]:
+        if record["error_type"] == "RuntimeError":
+            raise RuntimeError(record["error"])
+        if record["error"]:
+            app.logger.error(f"[分布式渲染] 任务执行出错: job_id={job_id}, 错误: {record['error']}")
+        return False, record["result"] or "桑基图生成失败"
+
+    artifact = RENDER_BROKER.fetch_artifact(job_id)
+    if artifact is None:
+        app.logger.error(f"[分布式渲染] 任务没有 HTML 产物: job_id={job_id}")
+        return False, "桑基图生成失败"
+    html_filename, html = artifact
+    html_filename = os.path.basename(html_filename)
+    html_output_path = os.path.join(SANKEY_OUTPUT_DIR, html_filename)
+    tmp_path = f"{html_output_path}.{job_id}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(html)
+    os.replace(tmp_path, html_output_path)
+    html_url = _sankey_html_url(html_filename)
+    app.logger.info(f"[分布式渲染] HTML已写入: {html_output_path}, 文件大小: {len(html)} bytes, URL: {html_url}")
+    return True, html_url
+
+
+_sankey_service = None
+_sankey_service_lock = threading.Lock()
+
+
+def get_sankey_service():
+    """每个 worker 进程一个桑基图服务实例（首次使用时创建），各任务线程共用"""
+    global _sankey_service
+    if _sankey_service is None:
+        with _sankey_service_lock:
+            if _sankey_service is None:
+                app.logger.info(f"[桑基图生成] 创建服务实例，watch_dir={SANKEY_WATCH_DIR}, output_dir={SANKEY_OUTPUT_DIR}")
+                _sankey_service = SankeyService(
+                    watch_dir=SANKEY_WATCH_DIR,
+                    output_dir=SANKEY_OUTPUT_DIR,
+                    log_file=SANKEY_LOG_FILE,
+                    poll_interval=SANKEY_POLL_INTERVAL
+                )
+    return _sankey_service
+
+
+def _render_sankey(budget, source_name: str) -> tuple[bool, str]:
+    """边表转换 + 渲染 HTML；budget 为宽格式预算文件路径或 DataFrame，source_name 决定 HTML 文件名
+    边表只在内存中生成并直接用于渲染，不再写 *_edges.xlsx
+    SANKEY_PAGE_MODE=shell 时只写出同名数据文档（.json），返回的仍是 .html 页面链接
+    相同数据 + 标题已渲染过（渲染缓存命中）时直接返回已有 HTML 的链接
+    """
+    # 步骤1-3: 查询渲染缓存，预算数据转换为内存边表并生成桑基图（配置了渲染进程池时在子进程中执行）
+    app.logger.info(f"[桑基图生成] 开始转换边表并生成桑基图HTML，预算数据: {source_name}, "
+                    f"执行方式: {'渲染进程池' if RENDER_POOL is not None else '任务线程'}")
+    try:
+        if RENDER_POOL is not None:
+            result = RENDER_POOL.run(render_budget_in_worker, budget, source_name, SANKEY_OUTPUT_DIR,
+                                     SANKEY_PAGE_MODE == "shell")
         else:
-            app.logger.error(f"[桑基图生成] 步骤3失败：generate_sankey_chart 返回 False，HTML文件可能未生成 - {html_output_path}")
-            # 即使生成失败，也尝试清理临时文件
-            try:
-                if edges_file_path and os.path.exists(edges_file_path):
-                    os.remove(edges_file_path)
-                    app.logger.info(f"[桑基图生成] 已删除临时边表文件: {os.path.basename(edges_file_path)}")
-            except Exception as e:
-                app.logger.warning(f"[桑基图生成] 删除临时边表文件失败: {e}")
-            
-            # 清理转换后的临时文件（如果是多sheet转换生成的）
-            if converted_file_to_cleanup and os.path.exists(converted_file_to_cleanup):
-                try:
-                    os.remove(converted_file_to_cleanup)
-                    app.logger.info(f"[桑基图生成] 已删除临时转换文件: {os.path.basename(converted_file_to_cleanup)}")
-                except Exception as e:
-                    app.logger.warning(f"[桑基图生成] 删除临时转换文件失败: {e}")
-            
-            return False, "桑基图生成失败"
-            
+            # 本 worker 共享的桑基图服务实例（不启动轮询，只用于单次生成）
+            result = render_budget_to_output(get_sankey_service(), RENDER_CACHE, budget, source_name,
+                                             SANKEY_OUTPUT_DIR, SANKEY_PAGE_MODE == "shell")
+    except RenderTimeout as timeout_err:
+        app.logger.error(f"[桑基图生成] 失败：{timeout_err} - {source_name}")
+        return False, "桑基图生成失败"
     except Exception as e:
         app.logger.exception(f"[桑基图生成] 异常：生成桑基图时发生未捕获的异常 - {e}")
-        import traceback
-        app.logger.error(f"[桑基图生成] 异常堆栈：\n{traceback.format_exc()}")
-        # 出错时也尝试清理临时文件
-        try:
-            if edges_file_path and os.path.exists(edges_file_path):
-                os.remove(edges_file_path)
-                app.logger.info(f"[桑基图生成] 已删除临时边表文件: {os.path.basename(edges_file_path)}")
-        except Exception as cleanup_error:
-            app.logger.warning(f"[桑基图生成] 清理临时文件时出错: {cleanup_error}")
         return False, "桑基图生成失败"
+    return _sankey_render_result(result, pooled=RENDER_POOL is not None)
+
+
+def _sankey_render_result(result: tuple, pooled: bool) -> tuple[bool, str]:
+    """把 render_budget_to_output 的结果转换为 (是否成功, URL 或错误类型)
+    pooled: 结果来自渲染进程（渲染缓存查询发生在子进程中，由此处计入本进程的命中统计）
+    """
+    status, detail, html_filename = result
+    if pooled and RENDER_CACHE is not None and status in ("cached", "ok"):
+        RENDER_CACHE.record_lookup(hit=status == "cached")
+    if status == "cached":
+        html_url = _sankey_html_url(html_filename)
+        app.logger.info(f"[桑基图生成] 渲染缓存命中，复用已有HTML: {html_filename}, URL: {html_url}")
+        return True, html_url
+    if status == "format_error":
+        app.logger.error(f"[桑基图生成] 失败：解析预算数据或转换为边表时出错 - {detail}")
+        return False, "format_error"
+    if status != "ok":
+        app.logger.error(f"[桑基图生成] 失败：生成桑基图时出错，HTML文件可能未生成 - {detail}")
+        return False, "桑基图生成失败"
+
+    html_output_path = os.path.join(SANKEY_OUTPUT_DIR, html_filename)
+    app.logger.info(f"[桑基图生成] 边表已生成，边数: {detail}；桑基图HTML已生成 - {html_output_path}")
+    # 验证HTML文件是否存在
+    if not os.path.exists(html_output_path):
+        app.logger.error(f"[桑基图生成] 失败：HTML文件未生成 - {html_output_path}")
+        return False, "桑基图生成失败"
+    app.logger.info(f"[桑基图生成] HTML文件验证通过，文件大小: {os.path.getsize(html_output_path)} bytes")
+
+    # 返回可访问的 HTTP URL
+    html_url = _sankey_html_url(html_filename)
+    app.logger.info(f"[桑基图生成] 生成成功，返回URL: {html_url}")
+    return True, html_url
 
 app = Flask(__name__)
 
-# 幂等性检查：记录已处理的消息 ID（内存中，重启后清空）
-PROCESSED_MESSAGE_IDS = set()
+# 幂等性检查：记录已处理的 event_id / message_id（SQLite，跨 worker 共享，重启后保留）
+DEDUP_STORE = DedupStore(DEDUP_DB_PATH, ttl_seconds=DEDUP_TTL_SECONDS, max_entries=DEDUP_MAX_ENTRIES)
+
+# 后台任务队列：事件回调只入队，耗时处理在工作线程中完成
+JOB_QUEUE = JobQueue(workers=JOB_WORKERS, max_depth=JOB_QUEUE_MAX)
+
+# 多维表格记录快照：增量同步用（BITABLE_INCREMENTAL=false 时不启用）
+BITABLE_SNAPSHOT_STORE = BitableSnapshotStore(
+    BITABLE_SNAPSHOT_DB_PATH,
+    min_records=BITABLE_INCREMENTAL_MIN_RECORDS, max_fetch=BITABLE_INCREMENTAL_MAX_FETCH,
+) if BITABLE_INCREMENTAL else None
+
+# 多维表格元数据缓存：重复任务不再请求字段、视图、table 列表与 base 名称（METADATA_CACHE_ENABLED=false 时不启用）
+METADATA_CACHE = MetadataCache(
+    METADATA_CACHE_DB_PATH, ttl_seconds=METADATA_CACHE_TTL_SECONDS, max_entries=METADATA_CACHE_MAX_ENTRIES,
+) if METADATA_CACHE_ENABLED else None
+pull_bitable.set_metadata_cache(METADATA_CACHE)
+
+# 桑基图渲染缓存：按宽格式数据指纹 + 标题 + 模板版本复用已生成的 HTML
+RENDER_CACHE = RenderCache(
+    RENDER_CACHE_DB_PATH, SANKEY_OUTPUT_DIR,
+    max_entries=RENDER_CACHE_MAX_ENTRIES, max_bytes=RENDER_CACHE_MAX_MB * 1024 * 1024,
+) if RENDER_CACHE_ENABLED else None
+
+
+# 渲染进程池：子进程在第一次渲染时启动（RENDER_PROCESSES=0 或桑基图服务导入失败时不启用）
+RENDER_POOL = RenderPool(
+    workers=RENDER_PROCESSES, max_tasks_per_child=RENDER_MAX_TASKS_PER_CHILD, timeout=RENDER_TIMEOUT_SECONDS,
+    initializer=init_worker,
+    initargs=(SankeyService.__module__, SANKEY_SERVICE_PATH, dict(
+        watch_dir=SANKEY_WATCH_DIR, output_dir=SANKEY_OUTPUT_DIR,
+        log_file=SANKEY_LOG_FILE, poll_interval=SANKEY_POLL_INTERVAL,
+    ), dict(
+        # 渲染缓存在子进程中查询与登记（与本进程共用同一个 SQLite 索引）
+        db_path=RENDER_CACHE_DB_PATH, output_dir=SANKEY_OUTPUT_DIR,
+        max_entries=RENDER_CACHE_MAX_ENTRIES, max_bytes=RENDER_CACHE_MAX_MB * 1024 * 1024,
+    ) if RENDER_CACHE_ENABLED else None),
+) if RENDER_PROCESSES > 0 and SankeyService is not None else None
+
+
+def create_render_broker() -> RenderBroker:
+    """按 RENDER_BROKER_URL 创建任务代理（事件接收服务与渲染 worker 共用同一配置）"""
+    return create_broker(
+        RENDER_BROKER_URL, lease_seconds=RENDER_JOB_LEASE_SECONDS, max_attempts=RENDER_JOB_MAX_ATTEMPTS,
+        retention_seconds=RENDER_JOB_RETENTION_SECONDS,
+    )
+
+
+# 渲染任务代理：RENDER_DISPATCH=broker 时拉取、转换与渲染交给渲染 worker（python -m app.render_worker）执行
+RENDER_BROKER = create_render_broker() if RENDER_DISPATCH == "broker" else None
+
+
+# 云文档下载缓存：按 file_token + 文档版本复用已下载的 Excel
+CLOUD_DOC_CACHE = CloudDocCache(
+    CLOUD_DOC_CACHE_DIR,
+    max_entries=CLOUD_DOC_CACHE_MAX_ENTRIES, max_bytes=CLOUD_DOC_CACHE_MAX_MB * 1024 * 1024,
+) if CLOUD_DOC_CACHE_ENABLED else None
 
 
 @app.get("/sankey/<path:filename>")
 def serve_sankey_html(filename: str):
-    """提供桑基图 HTML 的只读访问。"""
+    """提供桑基图 HTML 与数据文档（.json）的只读访问；只有数据文档的图表，页面返回共用外壳。"""
     try:
         decoded = urllib.parse.unquote(filename)
         file_path = os.path.join(SANKEY_OUTPUT_DIR, decoded)
@@ -459,18 +902,396 @@ def serve_sankey_html(filename: str):
         if not os.path.abspath(file_path).startswith(os.path.abspath(SANKEY_OUTPUT_DIR)):
             return jsonify({"error": "无效的文件路径"}), 403
         if not os.path.exists(file_path):
+            data_path = os.path.join(SANKEY_OUTPUT_DIR, sankey_page.data_filename(decoded))
+            if SANKEY_PAGE_SHELL is not None and data_path != file_path and os.path.exists(data_path):
+                # 外壳与图表无关，可能随 ECharts 版本变化：每次校验
+                return Response(SANKEY_PAGE_SHELL, mimetype="text/html", headers={"Cache-Control": "no-cache"})
             return jsonify({"error": "文件不存在"}), 404
+        if decoded.endswith(sankey_page.DATA_SUFFIX):
+            return send_from_directory(SANKEY_OUTPUT_DIR, decoded, mimetype="application/json")
         return send_from_directory(SANKEY_OUTPUT_DIR, decoded, mimetype="text/html")
     except Exception as e:
         app.logger.exception(f"serve sankey html error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.get("/assets/echarts/<version>/echarts.min.js")
+def serve_echarts(version: str):
+    """本服务托管的固定版本 ECharts（URL 含版本号，内容不变，允许浏览器长期缓存）"""
+    if version != ECHARTS_VERSION or not ECHARTS_ASSET_AVAILABLE:
+        return jsonify({"error": "文件不存在"}), 404
+    response = send_file(ECHARTS_ASSET_PATH, mimetype="application/javascript", max_age=ECHARTS_CACHE_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={ECHARTS_CACHE_MAX_AGE}, immutable"
+    return response
+
+
 @app.get("/healthz")
 def healthz():
     return jsonify({"status": "ok"})
 
 
+@app.get("/jobs/stats")
+def job_stats():
+    """任务队列、幂等存储与各接口族限流令牌（当前 worker 进程）"""
+    return jsonify({
+        "pid": os.getpid(),
+        "job_queue": JOB_QUEUE.stats(),
+        "dedup": DEDUP_STORE.stats(),
+        "render_cache": RENDER_CACHE.stats() if RENDER_CACHE is not None else None,
+        "render_pool": RENDER_POOL.stats() if RENDER_POOL is not None else None,
+        "render_broker": RENDER_BROKER.stats() if RENDER_BROKER is not None else None,
+        "sankey_page": {"mode": SANKEY_PAGE_MODE, "echarts_version": ECHARTS_VERSION,
+                        "echarts_local": ECHARTS_ASSET_AVAILABLE},
+        "cloud_doc_cache": CLOUD_DOC_CACHE.stats() if CLOUD_DOC_CACHE is not None else None,
+        "bitable_snapshot": BITABLE_SNAPSHOT_STORE.stats() if BITABLE_SNAPSHOT_STORE is not None else None,
+        "metadata_cache": METADATA_CACHE.stats() if METADATA_CACHE is not None else None,
+        "rate_limits": RATE_LIMITER.snapshot(),
+    })
+
+
+def _reply_busy(message_id: str) -> None:
+    try:
+        reply_message(message_id, "当前请求较多，服务繁忙，请稍后再试")
+    except Exception as e:
+        app.logger.exception(f"[任务队列] 发送繁忙提示失败，message_id: {message_id}, 错误: {e}")
+
+
+def process_message_job(message_id: Optional[str], text, sender_id: str) -> None:
+    """后台任务：识别链接类型 -> 拉取/下载 -> 生成桑基图 -> 回复用户"""
+    # 检查链接类型
+    is_bitable_link = isinstance(text, str) and "/base/" in text
+    is_cloud_doc_link = isinstance(text, str) and (
+        "/file/" in text or "/docs/" in text or "/sheets/" in text
+    )
+    is_link = isinstance(text, str) and (
+        text.startswith("http://") or text.startswith("https://")
+    )
+
+    app.logger.info(f"[消息处理] 链接类型检查: is_bitable={is_bitable_link}, is_cloud_doc={is_cloud_doc_link}, is_link={is_link}, text={text[:100]}")
+
+    # 场景 1 和 2：不支持的链接类型或非链接消息
+    if not is_bitable_link and not is_cloud_doc_link:
+        if message_id:
+            try:
+                if not is_link:
+                    # 场景 2：非链接消息
+                    reply_message(message_id, "该内容不能进行桑基图生成，\n\n请发送多维表格链接或云文档链接")
+                    app.logger.info(f"[消息处理] 场景2：非链接消息，已回复，message_id: {message_id}")
+                else:
+                    # 场景 1：不支持的链接类型
+                    reply_message(message_id, "该内容不能进行桑基图生成，\n\n请发送多维表格链接（/base/）或云文档链接（/file/、/docs/、/sheets/）")
+                    app.logger.info(f"[消息处理] 场景1：不支持的链接类型，已回复，message_id: {message_id}")
+            except Exception as e:
+                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {e}")
+        return
+
+    # 处理云文档链接
+    if is_cloud_doc_link:
+        app.logger.info(f"[消息处理] 检测到云文档链接，开始处理，message_id: {message_id}")
+        try:
+            token = get_tenant_access_token()
+
+            # 提取 file_token
+            try:
+                file_token = cloud_doc_download.extract_file_token_from_link(text)
+                app.logger.info(f"[消息处理] 提取到 file_token: {file_token}")
+            except ValueError as e:
+                app.logger.error(f"[消息处理] 云文档链接格式错误，message_id: {message_id}, 错误: {e}")
+                reply_message(message_id, "云文档链接格式错误，请检查链接是否正确")
+                return
+
+            # 下载云文档（先下载，获取文件名后再重命名）
+            ts = get_beijing_timestamp()
+            temp_outfile = os.path.join(OUTPUT_DIR, f"temp-{sender_id}-{ts}.xlsx")
+
+            app.logger.info(f"[消息处理] 开始下载云文档，file_token: {file_token}, 临时文件: {temp_outfile}")
+            download_success, download_error, file_title, content = cloud_doc_download.download_cloud_doc(
+                file_token, temp_outfile, token, OPEN_BASE, doc_link=text, doc_cache=CLOUD_DOC_CACHE,
+                sheet_concurrency=SHEETS_READ_CONCURRENCY, chunk_rows=SHEETS_READ_CHUNK_ROWS,
+                download_chunk_size=CLOUD_DOC_DOWNLOAD_CHUNK_KB * 1024,
+                max_bytes=CLOUD_DOC_MAX_MB * 1024 * 1024,
+                memory_threshold=CLOUD_DOC_MEMORY_MAX_MB * 1024 * 1024,
+            )
+
+            if not download_success:
+                # 场景 3：下载失败（权限错误）
+                app.logger.error(f"[消息处理] 场景3：云文档下载失败，message_id: {message_id}, 错误类型: {download_error}")
+                if download_error == "permission_denied" or download_error == "file_not_found":
+                    reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
+                elif download_error == "file_too_large":
+                    reply_message(message_id, f"云文档文件过大（超过 {CLOUD_DOC_MAX_MB} MB），无法生成桑基图")
+                else:
+                    reply_message(message_id, "云文档下载失败，请检查链接是否正确")
+                return
+
+            # 生成最终文件名（使用实际文件名或默认名称）
+            if file_title:
+                # 清理文件名（去除特殊字符）
+                safe_name = re.sub(r'[<>:"/\\|?*]', '_', file_title)
+                outfile = os.path.join(OUTPUT_DIR, f"{safe_name}-{sender_id}-{ts}.xlsx")
+                base_name = file_title
+            else:
+                # 如果没有获取到文件名，使用默认名称
+                outfile = os.path.join(OUTPUT_DIR, f"云文档-{sender_id}-{ts}.xlsx")
+                base_name = "云文档"
+
+            if content is not None:
+                # 内存接收：直接解析生成桑基图，原文件按需在后台归档
+                app.logger.info(f"[消息处理] 云文档已下载到内存，大小: {len(content)} bytes, 文件名: {base_name}")
+                if CLOUD_DOC_ARCHIVE_XLSX:
+                    threading.Thread(target=_archive_bytes, args=(content, outfile), daemon=True).start()
+                source_name = os.path.splitext(os.path.basename(outfile))[0]
+                sankey_success, sankey_result = generate_sankey_from_bytes(content, source_name, base_name)
+            else:
+                # 如果文件名不同，重命名文件
+                if temp_outfile != outfile:
+                    try:
+                        os.rename(temp_outfile, outfile)
+                        app.logger.info(f"[消息处理] 文件已重命名: {temp_outfile} -> {outfile}")
+                    except Exception as e:
+                        app.logger.warning(f"[消息处理] 文件重命名失败，使用临时文件名: {e}")
+                        outfile = temp_outfile
+
+                app.logger.info(f"[消息处理] 云文档下载成功，文件: {outfile}, 文件名: {base_name}")
+
+                # 生成桑基图
+                app.logger.info(f"[消息处理] 开始生成桑基图，Excel文件: {outfile}, Base名称: {base_name}")
+                sankey_success, sankey_result = generate_sankey_and_notify(outfile, base_name)
+
+            # 只返回一次消息
+            if sankey_success:
+                app.logger.info(f"[消息处理] 桑基图生成成功，回复链接给用户，message_id: {message_id}")
+                reply_message(message_id, f"桑基图链接：{sankey_result}")
+            else:
+                # 场景 4：Excel 格式不对
+                if sankey_result == "format_error":
+                    app.logger.error(f"[消息处理] 场景4：Excel格式不符合要求，message_id: {message_id}")
+                    reply_message(message_id, "Excel 文件格式不符合要求，请确保文件包含：\n\n1. 第一列为时间列\n\n2. 后续列为成对的项目列和描述列\n\n3. 最后一列为总预算\n\n4. 数据行完整")
+                else:
+                    app.logger.error(f"[消息处理] 桑基图生成失败，回复错误消息给用户，message_id: {message_id}, 结果: {sankey_result}")
+                    reply_message(message_id, "桑基图生成失败，请联系服务管理员")
+
+            return
+
+        except ValueError as e:
+            # 链接格式错误
+            app.logger.error(f"[消息处理] 云文档链接格式错误，message_id: {message_id}, 错误: {e}")
+            reply_message(message_id, "云文档链接格式错误，请检查链接是否正确")
+            return
+        except Exception as e:
+            # 其他异常
+            app.logger.exception(f"[消息处理] 处理云文档失败，message_id: {message_id}, 错误: {e}")
+            reply_message(message_id, "桑基图生成失败，请联系服务管理员")
+            return
+
+    # 是多维表格链接，进行处理
+    app.logger.info(f"[消息处理] 检测到多维表格链接，开始处理，message_id: {message_id}")
+    try:
+        # 带 table 参数的链接
+        if "?table=" in text:
+            # 解析 app_token / table_id / view_id
+            app_token = None
+            table_id = None
+            view_id = None
+            # app_token：位于 /base/<token>
+            m = re.search(r"/base/([A-Za-z0-9]+)", text)
+            if m:
+                app_token = m.group(1)
+            m = re.search(r"[?&]table=([A-Za-z0-9]+)", text)
+            if m:
+                table_id = m.group(1)
+            m = re.search(r"[?&]view=([A-Za-z0-9]+)", text)
+            if m:
+                view_id = m.group(1)
+
+            if app_token and table_id:
+                try:
+                    token = get_tenant_access_token()
+                    # 获取多维表格（base）名称
+                    base_name = get_base_name(OPEN_BASE, app_token, token)
+                    # 清理文件名（去除特殊字符）
+                    safe_name = re.sub(r'[<>:"/\\|?*]', '_', base_name)
+                    # 生成北京时间戳
+                    ts = get_beijing_timestamp()
+                    # 文件命名：多维表格名-发送者ID-时间戳.xlsx
+                    file_stem = f"{safe_name}-{sender_id}-{ts}"
+                    # 拉取并生成桑基图
+                    sankey_success, sankey_result = pull_bitable_and_generate(
+                        app_token, table_id, view_id, token, base_name, file_stem
+                    )
+
+                    # 只返回一次消息
+                    if sankey_success:
+                        app.logger.info(f"[消息处理] 桑基图生成成功，回复链接给用户，message_id: {message_id}")
+                        reply_message(message_id, f"桑基图链接：{sankey_result}")  # 成功：返回标注后的链接
+                    else:
+                        # 场景 4：Excel 格式不对
+                        if sankey_result == "format_error":
+                            app.logger.error(f"[消息处理] 场景4：Excel格式不符合要求，message_id: {message_id}")
+                            reply_message(message_id, "Excel 文件格式不符合要求，请确保文件包含：\n\n1. 第一列为时间列\n\n2. 后续列为成对的项目列和描述列\n\n3. 最后一列为总预算\n\n4. 数据行完整")
+                        else:
+                            app.logger.error(f"[消息处理] 桑基图生成失败，回复错误消息给用户，message_id: {message_id}, 结果: {sankey_result}")
+                            reply_message(message_id, "桑基图生成失败，请联系服务管理员")
+                except RuntimeError as e:
+                    # 场景 3：权限错误或 API 错误
+                    error_msg = str(e)
+                    app.logger.exception(f"[消息处理] 场景3：多维表格访问失败，message_id: {message_id}, 错误: {e}")
+                    try:
+                        if "code" in error_msg or "permission" in error_msg.lower() or "access" in error_msg.lower():
+                            reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
+                        else:
+                            reply_message(message_id, "多维表格拉取失败，请检查链接是否正确")
+                        app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
+                    except Exception as reply_err:
+                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
+                except Exception as e:
+                    # 其他异常
+                    app.logger.exception(f"[消息处理] 拉取多维表格失败，message_id: {message_id}, 错误: {e}")
+                    try:
+                        reply_message(message_id, "桑基图生成失败，请联系服务管理员")
+                        app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
+                    except Exception as reply_err:
+                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
+            else:
+                # app_token 或 table_id 解析失败
+                app.logger.warning(f"[消息处理] app_token 或 table_id 解析失败，message_id: {message_id}, text: {text}")
+                if message_id:
+                    try:
+                        reply_message(message_id, "多维表格链接格式错误，请检查链接是否正确")
+                        app.logger.info(f"[消息处理] 已发送错误消息（解析失败），message_id: {message_id}")
+                    except Exception as reply_err:
+                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
+            return
+
+        # 仅 base 链接：自动取第一张表与第一视图
+        else:
+            print("[INFO] 处理仅 base 链接（无 table 参数）")
+            m = re.search(r"/base/([A-Za-z0-9]+)", text)
+            app_token = m.group(1) if m else None
+            print(f"[INFO] 解析得到 app_token: {app_token}")
+            if app_token:
+                try:
+                    token = get_tenant_access_token()
+                    headers = {"Authorization": f"Bearer {token}"}
+                    # 列表表（命中元数据缓存时不再请求）
+                    tables = METADATA_CACHE.get("tables", app_token) if METADATA_CACHE is not None else None
+                    if tables is None:
+                        url_tables = f"{OPEN_BASE}/open-apis/bitable/v1/apps/{app_token}/tables"
+                        params = {"page_size": 200}
+                        rt = HTTP_SESSION.get(url_tables, headers=headers, params=params, timeout=10).json()
+                        if rt.get("code") != 0:
+                            # 场景 3：权限错误
+                            error_code = rt.get("code")
+                            error_msg = rt.get("msg", "")
+                            app.logger.error(f"[消息处理] 场景3：多维表格API错误，code: {error_code}, msg: {error_msg}")
+                            if error_code in [99991672, 99992354] or "permission" in error_msg.lower() or "access" in error_msg.lower():
+                                reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
+                            else:
+                                reply_message(message_id, "多维表格拉取失败，请检查链接是否正确")
+                            return
+                        tables = rt.get("data", {}).get("items") or []
+                        # 完整列表写入缓存，与 pull_bitable.list_all_tables 共用同一条目（多 table 拉取时不再重复列表）
+                        if METADATA_CACHE is not None and not rt["data"].get("has_more"):
+                            METADATA_CACHE.put("tables", app_token, tables)
+
+                    if not tables:
+                        app.logger.error(f"[消息处理] 多维表格中没有表，message_id: {message_id}")
+                        reply_message(message_id, "多维表格中没有可用的表，请检查链接是否正确")
+                        return
+                    # 如果只有一个table，使用原有逻辑；如果有多个table，拉取所有table
+                    if len(tables) == 1:
+                        table_id = tables[0]["table_id"]
+                    else:
+                        # 多个table：设置为None，让pull_to_files拉取所有table
+                        table_id = None
+
+                    # 尝试第一视图（可选，仅在指定table_id时）
+                    view_id = None
+                    if table_id:  # 只有在指定table_id时才获取view_id
+                        try:
+                            views = list_table_views(OPEN_BASE, app_token, table_id, token)
+                            if views:
+                                if BASE_AUTO_PICK == "first" or not BASE_PREFERRED_VIEW:
+                                    view_id = views[0]["view_id"]
+                                else:
+                                    for v in views:
+                                        if v.get("name") == BASE_PREFERRED_VIEW:
+                                            view_id = v["view_id"]
+                                            break
+                                    if not view_id:
+                                        view_id = views[0]["view_id"]
+                        except Exception:
+                            pass
+
+                    # 获取多维表格（base）名称
+                    base_name = get_base_name(OPEN_BASE, app_token, token)
+                    # 清理文件名（去除特殊字符）
+                    safe_name = re.sub(r'[<>:"/\\|?*]', '_', base_name)
+                    # 生成北京时间戳
+                    ts = get_beijing_timestamp()
+                    # 文件命名：多维表格名-发送者ID-时间戳.xlsx
+                    file_stem = f"{safe_name}-{sender_id}-{ts}"
+                    print(f"[INFO] 开始拉取: table_id={table_id}, view_id={view_id}, file_stem={file_stem}")
+                    # 拉取并生成桑基图
+                    sankey_success, sankey_result = pull_bitable_and_generate(
+                        app_token, table_id, view_id, token, base_name, file_stem
+                    )
+                    app.logger.info(f"[消息处理] 桑基图生成结果: success={sankey_success}, result={sankey_result}")
+
+                    # 只返回一次消息
+                    if sankey_success:
+                        app.logger.info(f"[消息处理] 桑基图生成成功，回复链接给用户，message_id: {message_id}")
+                        reply_message(message_id, f"桑基图链接：{sankey_result}")  # 成功：返回标注后的链接
+                    else:
+                        # 场景 4：Excel 格式不对
+                        if sankey_result == "format_error":
+                            app.logger.error(f"[消息处理] 场景4：Excel格式不符合要求，message_id: {message_id}")
+                            reply_message(message_id, "Excel 文件格式不符合要求，请确保文件包含：\n\n1. 第一列为时间列\n\n2. 后续列为成对的项目列和描述列\n\n3. 最后一列为总预算\n\n4. 数据行完整")
+                        else:
+                            app.logger.error(f"[消息处理] 桑基图生成失败，回复错误消息给用户，message_id: {message_id}, 结果: {sankey_result}")
+                            reply_message(message_id, "桑基图生成失败，请联系服务管理员")
+                except RuntimeError as e:
+                    # 场景 3：权限错误或 API 错误
+                    error_msg = str(e)
+                    app.logger.exception(f"[消息处理] 场景3：多维表格访问失败，message_id: {message_id}, 错误: {e}")
+                    try:
+                        if "code" in error_msg or "permission" in error_msg.lower() or "access" in error_msg.lower():
+                            reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
+                        else:
+                            reply_message(message_id, "多维表格拉取失败，请检查链接是否正确")
+                        app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
+                    except Exception as reply_err:
+                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
+                except Exception as e:
+                    # 其他异常
+                    app.logger.exception(f"[消息处理] 自动拉取多维表格失败，message_id: {message_id}, 错误: {e}")
+                    try:
+                        reply_message(message_id, "桑基图生成失败，请联系服务管理员")
+                        app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
+                    except Exception as reply_err:
+                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
+            else:
+                # app_token 解析失败
+                app.logger.warning(f"[消息处理] app_token 解析失败，message_id: {message_id}, text: {text}")
+                if message_id:
+                    try:
+                        reply_message(message_id, "多维表格链接格式错误，请检查链接是否正确")
+                        app.logger.info(f"[消息处理] 已发送错误消息（解析失败），message_id: {message_id}")
+                    except Exception as reply_err:
+                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
+            return
+
+    except Exception as e:
+        app.logger.exception(f"[消息处理] 解析多维表格链接失败，message_id: {message_id}, 错误: {e}")
+        # 解析链接失败，也要返回错误消息
+        if message_id:
+            try:
+                reply_message(message_id, "多维表格链接格式错误，请检查链接是否正确")
+                app.logger.info(f"[消息处理] 已发送错误消息（解析链接失败），message_id: {message_id}")
+            except Exception as reply_err:
+                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
+        return
+
 @app.post("/feishu/events")
 def feishu_events():
     # 原始数据用于签名校验
@@ -526,11 +1347,18 @@ def feishu_events():
         if not ok:
             return ("invalid signature", 401)
 
-    # 4) 业务处理（尽快 200；耗时逻辑异步）
+    # 4) 业务处理（尽快 200；耗时逻辑交给后台任务队列）
     event = body.get("event") or {}
     event_type = header.get("event_type") or event.get("type")
     app.logger.info(f"Received event: {event_type}")
 
+    # 多维表格字段变更 / 文档标题变更：使对应的元数据缓存失效
+    if event_type in METADATA_INVALIDATING_EVENTS:
+        file_token = event.get("file_token")
+        if file_token:
+            _invalidate_metadata(file_token, event.get("table_id"))
+        return jsonify({"ok": "received"}), 200
+
     # 如果是“接收消息”事件，打印并落盘
     # 常见事件名：im.message.receive_v1（不同版本命名可能略有差异）
     try:
@@ -552,16 +1380,12 @@ def feishu_events():
             message_id = message.get("message_id")
             print(f"[MESSAGE] id={message_id} text={text}")
 
-            # 幂等性检查：如果该消息已处理过，直接返回 200（避免飞书重试）
-            if message_id and message_id in PROCESSED_MESSAGE_IDS:
+            # 幂等性检查：查询与标记在同一事务内完成（在处理开始前）
+            # 飞书重试即使落到其他 worker 上，也只会被处理一次
+            if not DEDUP_STORE.check_and_mark(message_id=message_id, event_id=header.get("event_id")):
                 app.logger.info(f"Message {message_id} already processed, skipping")
                 return jsonify({"ok": "already processed"}), 200
-
-            # 立即记录 message_id，防止重复处理（在处理开始前）
-            # 这样可以避免飞书重试时重复处理同一消息
-            if message_id:
-                PROCESSED_MESSAGE_IDS.add(message_id)
-                app.logger.info(f"Marking message {message_id} as processed")
+            app.logger.info(f"Marking message {message_id} as processed")
 
             # 提取发送者与会话信息，并记录详细ID到日志
             sender = event.get("sender", {})
@@ -588,329 +1412,15 @@ def feishu_events():
                     f"{json.dumps(content, ensure_ascii=False)}\n"
                 )
 
-            # 检查链接类型
-            is_bitable_link = isinstance(text, str) and "/base/" in text
-            is_cloud_doc_link = isinstance(text, str) and (
-                "/file/" in text or "/docs/" in text or "/sheets/" in text
-            )
-            is_link = isinstance(text, str) and (
-                text.startswith("http://") or text.startswith("https://")
-            )
-            
-            app.logger.info(f"[消息处理] 链接类型检查: is_bitable={is_bitable_link}, is_cloud_doc={is_cloud_doc_link}, is_link={is_link}, text={text[:100]}")
-            
-            # 场景 1 和 2：不支持的链接类型或非链接消息
-            if not is_bitable_link and not is_cloud_doc_link:
-                if message_id:
-                    try:
-                        if not is_link:
-                            # 场景 2：非链接消息
-                            reply_message(message_id, "该内容不能进行桑基图生成，\n\n请发送多维表格链接或云文档链接")
-                            app.logger.info(f"[消息处理] 场景2：非链接消息，已回复，message_id: {message_id}")
-                        else:
-                            # 场景 1：不支持的链接类型
-                            reply_message(message_id, "该内容不能进行桑基图生成，\n\n请发送多维表格链接（/base/）或云文档链接（/file/、/docs/、/sheets/）")
-                            app.logger.info(f"[消息处理] 场景1：不支持的链接类型，已回复，message_id: {message_id}")
-                    except Exception as e:
-                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {e}")
-                return jsonify({"ok": "received"}), 200
-            
-            # 处理云文档链接
-            if is_cloud_doc_link:
-                app.logger.info(f"[消息处理] 检测到云文档链接，开始处理，message_id: {message_id}")
-                try:
-                    token = get_tenant_access_token()
-                    
-                    # 提取 file_token
-                    try:
-                        file_token = cloud_doc_download.extract_file_token_from_link(text)
-                        app.logger.info(f"[消息处理] 提取到 file_token: {file_token}")
-                    except ValueError as e:
-                        app.logger.error(f"[消息处理] 云文档链接格式错误，message_id: {message_id}, 错误: {e}")
-                        reply_message(message_id, "云文档链接格式错误，请检查链接是否正确")
-                        return jsonify({"ok": "received"}), 200
-                    
-                    # 下载云文档（先下载，获取文件名后再重命名）
-                    ts = get_beijing_timestamp()
-                    temp_outfile = os.path.join(OUTPUT_DIR, f"temp-{sender_id}-{ts}.xlsx")
-                    
-                    app.logger.info(f"[消息处理] 开始下载云文档，file_token: {file_token}, 临时文件: {temp_outfile}")
-                    download_success, download_error, file_title = cloud_doc_download.download_cloud_doc_to_excel(
-                        file_token, temp_outfile, token, OPEN_BASE, doc_link=text
-                    )
-                    
-                    if not download_success:
-                        # 场景 3：下载失败（权限错误）
-                        app.logger.error(f"[消息处理] 场景3：云文档下载失败，message_id: {message_id}, 错误类型: {download_error}")
-                        if download_error == "permission_denied" or download_error == "file_not_found":
-                            reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
-                        else:
-                            reply_message(message_id, "云文档下载失败，请检查链接是否正确")
-                        return jsonify({"ok": "received"}), 200
-                    
-                    # 生成最终文件名（使用实际文件名或默认名称）
-                    if file_title:
-                        # 清理文件名（去除特殊字符）
-                        safe_name = re.sub(r'[<>:"/\\|?*]', '_', file_title)
-                        outfile = os.path.join(OUTPUT_DIR, f"{safe_name}-{sender_id}-{ts}.xlsx")
-                        base_name = file_title
-                    else:
-                        # 如果没有获取到文件名，使用默认名称
-                        outfile = os.path.join(OUTPUT_DIR, f"云文档-{sender_id}-{ts}.xlsx")
-                        base_name = "云文档"
-                    
-                    # 如果文件名不同，重命名文件
-                    if temp_outfile != outfile:
-                        try:
-                            os.rename(temp_outfile, outfile)
-                            app.logger.info(f"[消息处理] 文件已重命名: {temp_outfile} -> {outfile}")
-                        except Exception as e:
-                            app.logger.warning(f"[消息处理] 文件重命名失败，使用临时文件名: {e}")
-                            outfile = temp_outfile
-                    
-                    app.logger.info(f"[消息处理] 云文档下载成功，文件: {outfile}, 文件名: {base_name}")
-                    
-                    # 生成桑基图
-                    app.logger.info(f"[消息处理] 开始生成桑基图，Excel文件: {outfile}, Base名称: {base_name}")
-                    sankey_success, sankey_result = generate_sankey_and_notify(outfile, base_name)
-                    
-                    # 只返回一次消息
-                    if sankey_success:
-                        app.logger.info(f"[消息处理] 桑基图生成成功，回复链接给用户，message_id: {message_id}")
-                        reply_message(message_id, f"桑基图链接：{sankey_result}")
-                    else:
-                        # 场景 4：Excel 格式不对
-                        if sankey_result == "format_error":
-                            app.logger.error(f"[消息处理] 场景4：Excel格式不符合要求，message_id: {message_id}")
-                            reply_message(message_id, "Excel 文件格式不符合要求，请确保文件包含：\n\n1. 第一列为时间列\n\n2. 后续列为成对的项目列和描述列\n\n3. 最后一列为总预算\n\n4. 数据行完整")
-                        else:
-                            app.logger.error(f"[消息处理] 桑基图生成失败，回复错误消息给用户，message_id: {message_id}, 结果: {sankey_result}")
-                            reply_message(message_id, "桑基图生成失败，请联系服务管理员")
-                    
-                    return jsonify({"ok": "received"}), 200
-                    
-                except ValueError as e:
-                    # 链接格式错误
-                    app.logger.error(f"[消息处理] 云文档链接格式错误，message_id: {message_id}, 错误: {e}")
-                    reply_message(message_id, "云文档链接格式错误，请检查链接是否正确")
-                    return jsonify({"ok": "received"}), 200
-                except Exception as e:
-                    # 其他异常
-                    app.logger.exception(f"[消息处理] 处理云文档失败，message_id: {message_id}, 错误: {e}")
-                    reply_message(message_id, "桑基图生成失败，请联系服务管理员")
-                    return jsonify({"ok": "received"}), 200
-            
-            # 是多维表格链接，进行处理
-            app.logger.info(f"[消息处理] 检测到多维表格链接，开始处理，message_id: {message_id}")
-            try:
-                # 带 table 参数的链接
-                if "?table=" in text:
-                    # 解析 app_token / table_id / view_id
-                    app_token = None
-                    table_id = None
-                    view_id = None
-                    # app_token：位于 /base/<token>
-                    m = re.search(r"/base/([A-Za-z0-9]+)", text)
-                    if m:
-                        app_token = m.group(1)
-                    m = re.search(r"[?&]table=([A-Za-z0-9]+)", text)
-                    if m:
-                        table_id = m.group(1)
-                    m = re.search(r"[?&]view=([A-Za-z0-9]+)", text)
-                    if m:
-                        view_id = m.group(1)
-
-                    if app_token and table_id:
-                        try:
-                            token = get_tenant_access_token()
-                            # 获取多维表格（base）名称
-                            base_name = get_base_name(OPEN_BASE, app_token, token)
-                            # 清理文件名（去除特殊字符）
-                            safe_name = re.sub(r'[<>:"/\\|?*]', '_', base_name)
-                            # 生成北京时间戳
-                            ts = get_beijing_timestamp()
-                            # 文件命名：多维表格名-发送者ID-时间戳.xlsx
-                            outfile = os.path.join(OUTPUT_DIR, f"{safe_name}-{sender_id}-{ts}.xlsx")
-                            result = pull_bitable.pull_to_files(
-                                OPEN_BASE, APP_ID, APP_SECRET, app_token, table_id, view_id, outfile
-                            )
-                            
-                            # 生成桑基图
-                            app.logger.info(f"[消息处理] 开始生成桑基图，Excel文件: {result.get('xlsx')}, Base名称: {base_name}")
-                            sankey_success, sankey_result = generate_sankey_and_notify(result['xlsx'], base_name)
-                            
-                            # 只返回一次消息
-                            if sankey_success:
-                                app.logger.info(f"[消息处理] 桑基图生成成功，回复链接给用户，message_id: {message_id}")
-                                reply_message(message_id, f"桑基图链接：{sankey_result}")  # 成功：返回标注后的链接
-                            else:
-                                # 场景 4：Excel 格式不对
-                                if sankey_result == "format_error":
-                                    app.logger.error(f"[消息处理] 场景4：Excel格式不符合要求，message_id: {message_id}")
-                                    reply_message(message_id, "Excel 文件格式不符合要求，请确保文件包含：\n\n1. 第一列为时间列\n\n2. 后续列为成对的项目列和描述列\n\n3. 最后一列为总预算\n\n4. 数据行完整")
-                                else:
-                                    app.logger.error(f"[消息处理] 桑基图生成失败，回复错误消息给用户，message_id: {message_id}, 结果: {sankey_result}")
-                                    reply_message(message_id, "桑基图生成失败，请联系服务管理员")
-                        except RuntimeError as e:
-                            # 场景 3：权限错误或 API 错误
-                            error_msg = str(e)
-                            app.logger.exception(f"[消息处理] 场景3：多维表格访问失败，message_id: {message_id}, 错误: {e}")
-                            try:
-                                if "code" in error_msg or "permission" in error_msg.lower() or "access" in error_msg.lower():
-                                    reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
-                                else:
-                                    reply_message(message_id, "多维表格拉取失败，请检查链接是否正确")
-                                app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
-                            except Exception as reply_err:
-                                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
-                        except Exception as e:
-                            # 其他异常
-                            app.logger.exception(f"[消息处理] 拉取多维表格失败，message_id: {message_id}, 错误: {e}")
-                            try:
-                                reply_message(message_id, "桑基图生成失败，请联系服务管理员")
-                                app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
-                            except Exception as reply_err:
-                                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
-                    else:
-                        # app_token 或 table_id 解析失败
-                        app.logger.warning(f"[消息处理] app_token 或 table_id 解析失败，message_id: {message_id}, text: {text}")
-                        if message_id:
-                            try:
-                                reply_message(message_id, "多维表格链接格式错误，请检查链接是否正确")
-                                app.logger.info(f"[消息处理] 已发送错误消息（解析失败），message_id: {message_id}")
-                            except Exception as reply_err:
-                                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
-                    return jsonify({"ok": "received"}), 200
-
-                # 仅 base 链接：自动取第一张表与第一视图
-                else:
-                    print("[INFO] 处理仅 base 链接（无 table 参数）")
-                    m = re.search(r"/base/([A-Za-z0-9]+)", text)
-                    app_token = m.group(1) if m else None
-                    print(f"[INFO] 解析得到 app_token: {app_token}")
-                    if app_token:
-                        try:
-                            token = get_tenant_access_token()
-                            headers = {"Authorization": f"Bearer {token}"}
-                            # 列表表
-                            url_tables = f"{OPEN_BASE}/open-apis/bitable/v1/apps/{app_token}/tables"
-                            params = {"page_size": 200}
-                            rt = requests.get(url_tables, headers=headers, params=params, timeout=10).json()
-                            if rt.get("code") != 0:
-                                # 场景 3：权限错误
-                                error_code = rt.get("code")
-                                error_msg = rt.get("msg", "")
-                                app.logger.error(f"[消息处理] 场景3：多维表格API错误，code: {error_code}, msg: {error_msg}")
-                                if error_code in [99991672, 99992354] or "permission" in error_msg.lower() or "access" in error_msg.lower():
-                                    reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
-                                else:
-                                    reply_message(message_id, "多维表格拉取失败，请检查链接是否正确")
-                                return jsonify({"ok": "received"}), 200
-                            
-                            if not rt.get("data", {}).get("items"):
-                                app.logger.error(f"[消息处理] 多维表格中没有表，message_id: {message_id}")
-                                reply_message(message_id, "多维表格中没有可用的表，请检查链接是否正确")
-                                return jsonify({"ok": "received"}), 200
-                            tables = rt["data"]["items"]
-                            # 如果只有一个table，使用原有逻辑；如果有多个table，拉取所有table
-                            if len(tables) == 1:
-                                table_id = tables[0]["table_id"]
-                            else:
-                                # 多个table：设置为None，让pull_to_files拉取所有table
-                                table_id = None
-
-                            # 尝试第一视图（可选，仅在指定table_id时）
-                            view_id = None
-                            if table_id:  # 只有在指定table_id时才获取view_id
-                                try:
-                                    url_views = f"{OPEN_BASE}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/views"
-                                    rv = requests.get(url_views, headers=headers, params={"page_size": 200}, timeout=10).json()
-                                    if rv.get("code") == 0 and rv.get("data", {}).get("items"):
-                                        views = rv["data"]["items"]
-                                        if BASE_AUTO_PICK == "first" or not BASE_PREFERRED_VIEW:
-                                            view_id = views[0]["view_id"]
-                                        else:
-                                            for v in views:
-                                                if v.get("name") == BASE_PREFERRED_VIEW:
-                                                    view_id = v["view_id"]
-                                                    break
-                                            if not view_id:
-                                                view_id = views[0]["view_id"]
-                                except Exception:
-                                    pass
-
-                            # 获取多维表格（base）名称
-                            base_name = get_base_name(OPEN_BASE, app_token, token)
-                            # 清理文件名（去除特殊字符）
-                            safe_name = re.sub(r'[<>:"/\\|?*]', '_', base_name)
-                            # 生成北京时间戳
-                            ts = get_beijing_timestamp()
-                            # 文件命名：多维表格名-发送者ID-时间戳.xlsx
-                            outfile = os.path.join(OUTPUT_DIR, f"{safe_name}-{sender_id}-{ts}.xlsx")
-                            print(f"[INFO] 开始拉取Excel: table_id={table_id}, view_id={view_id}, outfile={outfile}")
-                            result = pull_bitable.pull_to_files(
-                                OPEN_BASE, APP_ID, APP_SECRET, app_token, table_id, view_id, outfile
-                            )
-                            print(f"[INFO] Excel拉取完成: count={result.get('count')}, file={result.get('xlsx')}")
-                            
-                            # 生成桑基图
-                            app.logger.info(f"[消息处理] 开始生成桑基图，Excel文件: {result.get('xlsx')}, Base名称: {base_name}")
-                            sankey_success, sankey_result = generate_sankey_and_notify(result['xlsx'], base_name)
-                            app.logger.info(f"[消息处理] 桑基图生成结果: success={sankey_success}, result={sankey_result}")
-                            
-                            # 只返回一次消息
-                            if sankey_success:
-                                app.logger.info(f"[消息处理] 桑基图生成成功，回复链接给用户，message_id: {message_id}")
-                                reply_message(message_id, f"桑基图链接：{sankey_result}")  # 成功：返回标注后的链接
-                            else:
-                                # 场景 4：Excel 格式不对
-                                if sankey_result == "format_error":
-                                    app.logger.error(f"[消息处理] 场景4：Excel格式不符合要求，message_id: {message_id}")
-                                    reply_message(message_id, "Excel 文件格式不符合要求，请确保文件包含：\n\n1. 第一列为时间列\n\n2. 后续列为成对的项目列和描述列\n\n3. 最后一列为总预算\n\n4. 数据行完整")
-                                else:
-                                    app.logger.error(f"[消息处理] 桑基图生成失败，回复错误消息给用户，message_id: {message_id}, 结果: {sankey_result}")
-                                    reply_message(message_id, "桑基图生成失败，请联系服务管理员")
-                        except RuntimeError as e:
-                            # 场景 3：权限错误或 API 错误
-                            error_msg = str(e)
-                            app.logger.exception(f"[消息处理] 场景3：多维表格访问失败，message_id: {message_id}, 错误: {e}")
-                            try:
-                                if "code" in error_msg or "permission" in error_msg.lower() or "access" in error_msg.lower():
-                                    reply_message(message_id, "文档访问失败，请检查：\n\n1. 链接是否正确\n\n2. 应用是否有访问权限\n\n3. 文件是否已分享给应用")
-                                else:
-                                    reply_message(message_id, "多维表格拉取失败，请检查链接是否正确")
-                                app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
-                            except Exception as reply_err:
-                                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
-                        except Exception as e:
-                            # 其他异常
-                            app.logger.exception(f"[消息处理] 自动拉取多维表格失败，message_id: {message_id}, 错误: {e}")
-                            try:
-                                reply_message(message_id, "桑基图生成失败，请联系服务管理员")
-                                app.logger.info(f"[消息处理] 已发送错误消息给用户，message_id: {message_id}")
-                            except Exception as reply_err:
-                                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
-                    else:
-                        # app_token 解析失败
-                        app.logger.warning(f"[消息处理] app_token 解析失败，message_id: {message_id}, text: {text}")
-                        if message_id:
-                            try:
-                                reply_message(message_id, "多维表格链接格式错误，请检查链接是否正确")
-                                app.logger.info(f"[消息处理] 已发送错误消息（解析失败），message_id: {message_id}")
-                            except Exception as reply_err:
-                                app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
-                    return jsonify({"ok": "received"}), 200
-
-            except Exception as e:
-                app.logger.exception(f"[消息处理] 解析多维表格链接失败，message_id: {message_id}, 错误: {e}")
-                # 解析链接失败，也要返回错误消息
+            # 5) 耗时处理（拉取、转换、生成桑基图、回复）交给后台任务队列，立即返回 200
+            if JOB_QUEUE.submit(process_message_job, message_id, text, sender_id):
+                app.logger.info(f"[任务队列] 已入队，message_id: {message_id}, 队列深度: {JOB_QUEUE.stats()['queue_depth']}")
+            else:
+                # 队列饱和：拒绝本次请求并提示用户稍后重试
+                app.logger.warning(f"[任务队列] 队列已满，拒绝处理，message_id: {message_id}, 状态: {JOB_QUEUE.stats()}")
                 if message_id:
-                    try:
-                        reply_message(message_id, "多维表格链接格式错误，请检查链接是否正确")
-                        app.logger.info(f"[消息处理] 已发送错误消息（解析链接失败），message_id: {message_id}")
-                    except Exception as reply_err:
-                        app.logger.exception(f"[消息处理] 发送错误消息失败，message_id: {message_id}, 错误: {reply_err}")
-                return jsonify({"ok": "received"}), 200
+                    threading.Thread(target=_reply_busy, args=(message_id,), daemon=True).start()
+            return jsonify({"ok": "received"}), 200
     except Exception as e:
         app.logger.exception(f"log message error: {e}")
         # 即使出错也要返回 200，避免飞书重试
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多维表格元数据缓存（TTL + LRU）
+缓存字段定义（顺序与类型）、视图列布局、table/view 列表以及 base/table 名称，
+按 (种类, app_token, table_id, view_id) 寻址；再次处理同一张表时不再请求这些接口。
+条目在 TTL 到期后失效，超过条目数上限时按最近使用时间淘汰；拉取出错或收到字段变更事件时按 app/table 失效。
+索引保存在本机 SQLite 文件中，所有 gunicorn worker 共享（任一 worker 收到变更事件即对全部生效）。
+"""
+
+import json
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from .sqlite_store import SQLiteStore
+
+
+class MetadataCache(SQLiteStore):
+    """(种类, app_token, table_id, view_id) -> JSON 可序列化的元数据"""
+
+    def __init__(self, db_path: str, ttl_seconds: int = 600, max_entries: int = 2000):
+        """
+        Args:
+            db_path: SQLite 文件路径
+            ttl_seconds: 条目有效期（秒）
+            max_entries: 最多缓存的条目数，0 表示不限
+        """
+        super().__init__(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidated = 0
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata_cache ("
+            " kind TEXT NOT NULL,"
+            " app_token TEXT NOT NULL,"
+            " table_id TEXT NOT NULL,"
+            " view_id TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL,"
+            " PRIMARY KEY (kind, app_token, table_id, view_id))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_cache_app ON metadata_cache(app_token, table_id)")
+
+    def get(self, kind: str, app_token: str, table_id: str = "", view_id: str = "") -> Optional[Any]:
+        """未过期时返回缓存的值，否则返回 None"""
+        key = (kind, app_token, table_id or "", view_id or "")
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value FROM metadata_cache"
+            " WHERE kind = ? AND app_token = ? AND table_id = ? AND view_id = ? AND expires_at > ?",
+            key + (now,),
+        ).fetchone()
+        if row is None:
+            with self._lock:
+                self._misses += 1
+            return None
+        conn.execute(
+            "UPDATE metadata_cache SET last_used_at = ?"
+            " WHERE kind = ? AND app_token = ? AND table_id = ? AND view_id = ?",
+            (now,) + key,
+        )
+        with self._lock:
+            self._hits += 1
+        return json.loads(row[0])
+
+    def put(self, kind: str, app_token: str, value: Any, table_id: str = "", view_id: str = "") -> None:
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO metadata_cache(kind, app_token, table_id, view_id, value, expires_at, last_used_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, app_token, table_id or "", view_id or "", json.dumps(value, ensure_ascii=False),
+             now + self.ttl_seconds, now),
+        )
+        self.evict()
+
+    def get_or_load(self, kind: str, app_token: str, loader: Callable[[], Optional[Any]],
+                    table_id: str = "", view_id: str = "") -> Optional[Any]:
+        """未命中时调用 loader 并缓存其结果；loader 返回 None（如接口出错后的兜底）时不缓存"""
+        value = self.get(kind, app_token, table_id, view_id)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.put(kind, app_token, value, table_id, view_id)
+        return value
+
+    def invalidate(self, app_token: str, table_id: Optional[str] = None) -> int:
+        """删除某个 app（指定 table_id 时只删该表）的全部条目；返回删除条数"""
+        if table_id:
+            cur = self._conn().execute(
+                "DELETE FROM metadata_cache WHERE app_token = ? AND table_id = ?", (app_token, table_id)
+            )
+        else:
+            cur = self._conn().execute("DELETE FROM metadata_cache WHERE app_token = ?", (app_token,))
+        with self._lock:
+            self._invalidated += cur.rowcount
+        return cur.rowcount
+
+    def evict(self) -> int:
+        """删除已过期的条目，并在超过条目数上限时按最近使用时间淘汰；返回删除条数"""
+        with self._transaction() as conn:
+            removed = conn.execute("DELETE FROM metadata_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+            if self.max_entries:
+                removed += conn.execute(
+                    "DELETE FROM metadata_cache WHERE rowid IN ("
+                    " SELECT rowid FROM metadata_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+        return removed
+
+    def stats(self) -> dict:
+        count = self._conn().execute("SELECT COUNT(*) FROM metadata_cache").fetchone()[0]
+        with self._lock:
+            hits, misses, invalidated = self._hits, self._misses, self._invalidated
+        lookups = hits + misses
+        return {
+            "entries": count,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "invalidated": invalidated,
+        }
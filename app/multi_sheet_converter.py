@@ -2,13 +2,60 @@
 # -*- coding: utf-8 -*-
 """多sheet长格式Excel转换为宽格式"""
 
+import logging
 import pandas as pd
 import os
-from typing import Optional
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 多sheet长格式每个sheet必需的列（也是多维表格拉取时默认只请求的字段）
+LONG_FORMAT_COLUMNS = ['阶段', '项目名称', '费用', '说明']
 
 def convert_multi_sheet_to_wide_format(excel_path: str, output_path: Optional[str] = None) -> str:
     """
-    将多sheet长格式Excel转换为单sheet宽格式
+    将多sheet长格式Excel转换为单sheet宽格式（文件版，转换逻辑见 convert_frames_to_wide_format）
+
+    Returns:
+        转换后的文件路径
+    """
+    # 读取所有sheet
+    excel_data = pd.read_excel(excel_path, sheet_name=None, header=0)
+    wide_df = convert_frames_to_wide_format(excel_data)
+
+    # 保存转换后的文件
+    if output_path is None:
+        base_name = os.path.splitext(os.path.basename(excel_path))[0]
+        dir_name = os.path.dirname(excel_path)
+        output_path = os.path.join(dir_name, f"{base_name}_宽格式.xlsx")
+    
+    wide_df.to_excel(output_path, index=False, engine='openpyxl')
+    return output_path
+
+
+def detect_and_convert_frames(frames: Dict[str, pd.DataFrame]) -> Tuple[bool, pd.DataFrame]:
+    """检测多sheet长格式并转换：frames 为 {sheet名: DataFrame}
+
+    Returns:
+        (是否经过转换, 用于生成桑基图的预算 DataFrame)
+    """
+    first_sheet = next(iter(frames.values()))
+    # 只有一个sheet，或第一个sheet不符合长格式（阶段、项目名称、费用、说明）：直接作为宽格式使用
+    if len(frames) == 1:
+        return False, first_sheet
+    if not all(col in first_sheet.columns for col in LONG_FORMAT_COLUMNS):
+        return False, first_sheet
+    try:
+        logger.info("[多sheet检测] 检测到多sheet长格式数据，开始转换")
+        return True, convert_frames_to_wide_format(frames)
+    except Exception as e:
+        logger.warning(f"[多sheet检测] 检测失败，使用第一个sheet: {e}")
+        return False, first_sheet
+
+
+def convert_frames_to_wide_format(excel_data: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    将多sheet长格式数据（{sheet名: DataFrame}，与 pd.read_excel(sheet_name=None) 结构相同）转换为单sheet宽格式
     
     输入格式（每个sheet）:
         阶段      项目名称    费用  说明
@@ -19,17 +66,13 @@ def convert_multi_sheet_to_wide_format(excel_path: str, output_path: Optional[st
         25年预算  250   A      250       B          ...  1000
     
     Returns:
-        转换后的文件路径
+        宽格式 DataFrame
     """
-    # 读取所有sheet
-    excel_data = pd.read_excel(excel_path, sheet_name=None, header=0)
-    
     all_wide_data = []
     
     for sheet_name, df in excel_data.items():
         # 检查必需的列
-        required_cols = ['阶段', '项目名称', '费用', '说明']
-        if not all(col in df.columns for col in required_cols):
+        if not all(col in df.columns for col in LONG_FORMAT_COLUMNS):
             continue
         
         # 按阶段分组
@@ -116,14 +159,5 @@ def convert_multi_sheet_to_wide_format(excel_path: str, output_path: Optional[st
     ordered_cols = [col for col in ordered_cols if col in wide_df.columns]
     
     # 重新排列列
-    wide_df = wide_df[ordered_cols]
-    
-    # 保存转换后的文件
-    if output_path is None:
-        base_name = os.path.splitext(os.path.basename(excel_path))[0]
-        dir_name = os.path.dirname(excel_path)
-        output_path = os.path.join(dir_name, f"{base_name}_宽格式.xlsx")
-    
-    wide_df.to_excel(output_path, index=False, engine='openpyxl')
-    return output_path
+    return wide_df[ordered_cols]
 
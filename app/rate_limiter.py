@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+飞书 OpenAPI 客户端限流
+按接口族（多维表格记录、字段、电子表格读取、云空间下载、消息回复等）各维护一个令牌桶：
+- 请求前取令牌，令牌不足时阻塞等待而不是报错
+- 收到 429 或飞书频控错误码时，按 Retry-After / x-ogw-ratelimit-reset 暂停该接口族
+- snapshot() 返回各桶当前令牌数与被限流次数，用于对照真实配额调整并发
+"""
+
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+# 飞书频控错误码：99991400 请求频率超限
+FEISHU_RATE_LIMIT_CODES = frozenset({99991400})
+
+# 默认每秒请求数（按应用维度的官方频控留出余量；多 worker 时按进程数分摊）
+DEFAULT_RATES: Dict[str, float] = {
+    "bitable_records": 10,
+    "bitable_fields": 10,
+    "bitable_meta": 10,
+    "sheets_values": 50,
+    "sheets_meta": 20,
+    "drive_download": 5,
+    "im_reply": 20,
+    "auth": 5,
+    "default": 20,
+}
+
+_FAMILY_PATTERNS = [
+    ("bitable_records", re.compile(r"/open-apis/bitable/v1/apps/[^/]+/tables/[^/]+/records")),
+    ("bitable_fields", re.compile(r"/open-apis/bitable/v1/apps/[^/]+/tables/[^/]+/fields")),
+    ("bitable_meta", re.compile(r"/open-apis/bitable/v1/apps/")),
+    ("sheets_values", re.compile(r"/open-apis/sheets/v\d/spreadsheets/[^/]+/values")),
+    ("sheets_meta", re.compile(r"/open-apis/sheets/v\d/spreadsheets/")),
+    ("drive_download", re.compile(r"/open-apis/drive/v1/(files|medias)/[^/]+/download")),
+    ("im_reply", re.compile(r"/open-apis/im/v1/messages")),
+    ("auth", re.compile(r"/open-apis/auth/")),
+]
+
+
+def classify_endpoint(url: str) -> str:
+    """把请求 URL 归到接口族"""
+    for family, pattern in _FAMILY_PATTERNS:
+        if pattern.search(url):
+            return family
+    return "default"
+
+
+def parse_rate_limits(spec: Optional[str]) -> Dict[str, float]:
+    """解析 "bitable_records=10,im_reply=20" 形式的配置，未配置的接口族使用默认值"""
+    rates = dict(DEFAULT_RATES)
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, value = part.partition("=")
+        try:
+            rate = float(value)
+        except ValueError:
+            rate = 0.0
+        if rate <= 0:
+            raise ValueError(f"限流配置格式错误: '{part}'，应为 接口族=每秒请求数（大于0）")
+        rates[name.strip()] = rate
+    return rates
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.throttled = 0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """取一个令牌，不足时阻塞；返回累计等待秒数"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    if waited:
+                        self.waits += 1
+                    return waited
+                else:
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """服务端限流：暂停该桶 seconds 秒并清空令牌"""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = now
+            self.throttled += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "rate": self.rate,
+                "capacity": self.capacity,
+                "tokens": round(self._tokens, 2),
+                "paused_for": round(max(0.0, self._paused_until - now), 2),
+                "waits": self.waits,
+                "throttled": self.throttled,
+            }
+
+
+class RateLimiter:
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        rates = rates or DEFAULT_RATES
+        self._buckets = {name: TokenBucket(rate) for name, rate in rates.items()}
+        if "default" not in self._buckets:
+            self._buckets["default"] = TokenBucket(DEFAULT_RATES["default"])
+
+    def bucket(self, family: str) -> TokenBucket:
+        return self._buckets.get(family) or self._buckets["default"]
+
+    def acquire(self, url: str) -> str:
+        family = classify_endpoint(url)
+        self.bucket(family).acquire()
+        return family
+
+    def penalize(self, family: str, seconds: float) -> None:
+        self.bucket(family).pause(seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {name: b.snapshot() for name, b in self._buckets.items()}
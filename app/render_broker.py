@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+渲染任务代理（broker）
+事件接收服务把 拉取→转换→渲染 打包为任务提交给代理，由渲染 worker（python -m app.render_worker）领取执行，
+结果以 HTML 产物 + 状态记录的形式写回；接收服务只负责等待结果、落盘 HTML 并回复链接。
+worker 执行任务期间定期心跳续租，租约到期（worker 失联）的任务才会被其他 worker 重新领取。
+RenderBroker 定义代理接口，可按部署接入其他实现（RENDER_BROKER_URL=包.模块:类名）；
+默认的 SQLiteBroker 基于单个 SQLite 文件（WAL 模式），只适用于同一主机上的多进程：
+WAL 依赖共享内存，数据库不能放在 NFS/SMB 等网络文件系统上，跨主机部署需接入其他实现。SQLiteBroker 也用作测试替身。
+"""
+
+import importlib
+import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional, Tuple
+
+from .sqlite_store import SQLiteStore
+
+# 任务状态：queued（待领取）/ running（执行中，租约到期未完成会被重新领取）/ done / failed / cancelled
+FINISHED_STATUSES = frozenset({"done", "failed", "cancelled"})
+
+
+class RenderBroker(ABC):
+    """渲染任务代理接口
+
+    任务 job 为 JSON 可序列化的 dict（如 {"kind": "bitable", ...}），content 为随任务传递的文件内容（可选）。
+    状态记录为 dict：job_id / kind / status / attempts / worker / success / result / error / error_type / html_filename。
+    """
+
+    # 领取后的租约时长（秒）；设置时渲染 worker 在执行任务期间每 1/3 租约调用一次 heartbeat
+    lease_seconds: Optional[float] = None
+
+    @abstractmethod
+    def submit(self, job: Dict[str, Any], content: Optional[bytes] = None) -> str:
+        """提交任务，返回 job_id"""
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> Optional[Tuple[str, Dict[str, Any], Optional[bytes]]]:
+        """领取一个待执行的任务，返回 (job_id, job, content)；没有任务时返回 None"""
+
+    @abstractmethod
+    def complete(self, job_id: str, worker_id: str, success: bool, result: str,
+                 html_filename: Optional[str] = None, html: Optional[bytes] = None,
+                 error: Optional[str] = None, error_type: Optional[str] = None) -> bool:
+        """写回任务结果（HTML 产物 + 状态）；任务已被取消或已转给其他 worker 时返回 False"""
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """续租执行中的任务；任务已被取消或已转给其他 worker 时返回 False（默认实现不使用租约）"""
+        return True
+
+    @abstractmethod
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """任务的状态记录（不含文件内容）；任务不存在时返回 None"""
+
+    @abstractmethod
+    def fetch_artifact(self, job_id: str) -> Optional[Tuple[str, bytes]]:
+        """成功任务的 HTML 产物 (文件名, 内容)"""
+
+    @abstractmethod
+    def cancel(self, job_id: str) -> bool:
+        """取消尚未完成的任务（提交方不再等待时调用）"""
+
+    def wait(self, job_id: str, timeout: float, poll_interval: float = 0.5) -> Optional[Dict[str, Any]]:
+        """轮询等待任务结束，返回最终状态记录；超时返回 None"""
+        deadline = time.monotonic() + timeout
+        while True:
+            record = self.status(job_id)
+            if record is not None and record["status"] in FINISHED_STATUSES:
+                return record
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def stats(self) -> dict:
+        return {}
+
+
+class SQLiteBroker(RenderBroker, SQLiteStore):
+    """基于本机 SQLite 文件的任务代理（领取通过 BEGIN IMMEDIATE 串行化，同一任务只会被一个 worker 领取）"""
+
+    def __init__(self, db_path: str, lease_seconds: int = 600, max_attempts: int = 2,
+                 retention_seconds: int = 86400, purge_every: int = 100):
+        """
+        Args:
+            db_path: SQLite 文件路径（本机文件系统，不支持网络文件系统）
+            lease_seconds: 领取后的租约时长（秒），worker 执行期间心跳续租；到期未续租的任务视为 worker 已失联，可被重新领取
+            max_attempts: 单个任务最多被领取的次数，超过后标记为失败
+            retention_seconds: 已结束任务（含 HTML 产物）的保留时长
+            purge_every: 每提交多少个任务清理一次过期任务
+        """
+        super().__init__(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._submits_since_purge = 0
+        self._submitted = 0
+        self._claimed = 0
+        self._completed = 0
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS render_jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " content BLOB,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " worker TEXT,"
+            " lease_until REAL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " success INTEGER,"
+            " result TEXT,"
+            " error TEXT,"
+            " error_type TEXT,"
+            " html_filename TEXT,"
+            " html BLOB)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_render_jobs_status ON render_jobs(status, created_at)")
+
+    def submit(self, job: Dict[str, Any], content: Optional[bytes] = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO render_jobs(job_id, kind, payload, content, status, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, job.get("kind", ""), json.dumps(job, ensure_ascii=False), content, now, now),
+        )
+        with self._lock:
+            self._submitted += 1
+            self._submits_since_purge += 1
+            need_purge = self._submits_since_purge >= self.purge_every
+            if need_purge:
+                self._submits_since_purge = 0
+        if need_purge:
+            self.purge()
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[Tuple[str, Dict[str, Any], Optional[bytes]]]:
+        now = time.time()
+        with self._transaction() as conn:
+            # 租约到期且已达领取上限的任务不再重试
+            conn.execute(
+                "UPDATE render_jobs SET status = 'failed', success = 0, result = 'worker_lost',"
+                " error = '渲染 worker 未在租约内完成任务', content = NULL, updated_at = ?"
+                " WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT job_id, payload, content FROM render_jobs"
+                " WHERE status = 'queued' OR (status = 'running' AND lease_until < ?)"
+                " ORDER BY created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE render_jobs SET status = 'running', worker = ?, lease_until = ?,"
+                    " attempts = attempts + 1, updated_at = ? WHERE job_id = ?",
+                    (worker_id, now + self.lease_seconds, now, row[0]),
+                )
+        if row is None:
+            return None
+        with self._lock:
+            self._claimed += 1
+        return row[0], json.loads(row[1]), row[2]
+
+    def complete(self, job_id: str, worker_id: str, success: bool, result: str,
+                 html_filename: Optional[str] = None, html: Optional[bytes] = None,
+                 error: Optional[str] = None, error_type: Optional[str] = None) -> bool:
+        updated = self._conn().execute(
+            "UPDATE render_jobs SET status = ?, success = ?, result = ?, error = ?, error_type = ?,"
+            " html_filename = ?, html = ?, content = NULL, updated_at = ?"
+            " WHERE job_id = ? AND worker = ? AND status = 'running'",
+            ("done" if success else "failed", int(success), result, error, error_type,
+             html_filename, html, time.time(), job_id, worker_id),
+        ).rowcount
+        if updated:
+            with self._lock:
+                self._completed += 1
+        return bool(updated)
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        return bool(self._conn().execute(
+            "UPDATE render_jobs SET lease_until = ? WHERE job_id = ? AND worker = ? AND status = 'running'",
+            (time.time() + self.lease_seconds, job_id, worker_id),
+        ).rowcount)
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT job_id, kind, status, attempts, worker, success, result, error, error_type, html_filename"
+            " FROM render_jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ("job_id", "kind", "status", "attempts", "worker", "success", "result", "error", "error_type",
+                "html_filename")
+        record = dict(zip(keys, row))
+        record["success"] = bool(record["success"])
+        return record
+
+    def fetch_artifact(self, job_id: str) -> Optional[Tuple[str, bytes]]:
+        row = self._conn().execute(
+            "SELECT html_filename, html FROM render_jobs WHERE job_id = ? AND status = 'done'", (job_id,)
+        ).fetchone()
+        if row is None or row[1] is None:
+            return None
+        return row[0], row[1]
+
+    def cancel(self, job_id: str) -> bool:
+        return bool(self._conn().execute(
+            "UPDATE render_jobs SET status = 'cancelled', content = NULL, updated_at = ?"
+            " WHERE job_id = ? AND status IN ('queued', 'running')",
+            (time.time(), job_id),
+        ).rowcount)
+
+    def purge(self) -> int:
+        """删除超过保留时长的已结束任务；返回删除条数"""
+        return self._conn().execute(
+            "DELETE FROM render_jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+            (time.time() - self.retention_seconds,),
+        ).rowcount
+
+    def stats(self) -> dict:
+        counts = dict(self._conn().execute(
+            "SELECT status, COUNT(*) FROM render_jobs GROUP BY status"
+        ).fetchall())
+        with self._lock:
+            return {
+                "jobs": counts,
+                "lease_seconds": self.lease_seconds,
+                "max_attempts": self.max_attempts,
+                "submitted": self._submitted,
+                "claimed": self._claimed,
+                "completed": self._completed,
+            }
+
+
+def create_broker(url: str, **kwargs: Any) -> RenderBroker:
+    """按 URL 创建任务代理
+    - sqlite:///绝对路径.db 或 sqlite://相对路径.db：SQLiteBroker（kwargs 传给构造函数；仅限同一主机）
+    - 包.模块:类名：自定义 RenderBroker 实现，以无参方式构造（由实现自行读取配置）
+    """
+    if url.startswith("sqlite://"):
+        return SQLiteBroker(url[len("sqlite://"):], **kwargs)
+    module_name, sep, class_name = url.partition(":")
+    if not sep or not module_name or not class_name:
+        raise ValueError(f"无效的任务代理地址: {url}（应为 sqlite:///路径 或 包.模块:类名）")
+    broker = getattr(importlib.import_module(module_name), class_name)()
+    if not isinstance(broker, RenderBroker):
+        raise TypeError(f"{url} 不是 RenderBroker 的实现")
+    return broker
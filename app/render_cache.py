@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+桑基图渲染缓存（按内容寻址）
+宽格式预算数据 + 图表标题 + 渲染模板版本 计算出缓存键；相同内容已渲染过时直接返回已有 HTML 文件名，
+不再重复渲染。索引保存在本机 SQLite 文件中，所有 gunicorn worker 共享。
+默认不淘汰（HTML 链接已发给用户，应长期有效）；配置了条目数或总大小上限时按最近使用时间淘汰，
+并删除对应的 HTML 文件，被淘汰图表的旧链接随之失效。
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import pandas as pd
+
+from .sqlite_store import SQLiteStore, evict_lru
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint_frame(df: pd.DataFrame) -> str:
+    """宽格式预算数据的内容指纹（列名 + 各行取值，与行索引无关）"""
+    h = hashlib.sha256()
+    h.update("\x1f".join(str(c) for c in df.columns).encode("utf-8"))
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        h.update(row_hashes.tobytes())
+    except TypeError:
+        # 含不可哈希的单元格时退化为文本表示
+        h.update(df.to_csv(index=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+def render_cache_key(fingerprint: str, title: str, template_version: str) -> str:
+    return hashlib.sha256(f"{template_version}\x1f{title}\x1f{fingerprint}".encode("utf-8")).hexdigest()
+
+
+class RenderCache(SQLiteStore):
+    """缓存键 -> 输出目录中的 HTML 文件名"""
+
+    def __init__(self, db_path: str, output_dir: str, max_entries: int = 0, max_bytes: int = 0):
+        """
+        Args:
+            db_path: 索引文件路径（不要放在输出目录中，避免被 /sankey 路由访问到）
+            output_dir: 桑基图 HTML 输出目录，缓存的文件都在该目录下
+            max_entries: 最多缓存的 HTML 个数，0 表示不限（不淘汰、不删除文件）
+            max_bytes: 缓存 HTML 的总大小上限（字节），0 表示不限
+                超过上限时删除被淘汰的 HTML，已发出的对应链接将返回 404
+        """
+        super().__init__(db_path)
+        self.output_dir = output_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evicted = 0
+
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS render_cache ("
+            " key TEXT PRIMARY KEY,"
+            " filename TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_render_cache_used ON render_cache(last_used_at)")
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.output_dir, filename)
+
+    def get(self, key: str) -> Optional[str]:
+        """命中返回 HTML 文件名；文件已被删除的条目视为未命中并移除"""
+        conn = self._conn()
+        row = conn.execute("SELECT filename FROM render_cache WHERE key = ?", (key,)).fetchone()
+        if row and os.path.exists(self._path(row[0])):
+            conn.execute(
+                "UPDATE render_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?", (time.time(), key)
+            )
+            with self._lock:
+                self._hits += 1
+            return row[0]
+        if row:
+            conn.execute("DELETE FROM render_cache WHERE key = ?", (key,))
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def record_lookup(self, hit: bool) -> None:
+        """计入在其他进程（渲染进程池）中完成的一次查询，命中统计按本进程汇总"""
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def put(self, key: str, filename: str) -> None:
+        """登记新渲染的 HTML，并按上限淘汰最久未使用的条目（同一内容并发渲染时以最后一次为准）"""
+        path = self._path(filename)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO render_cache(key, filename, size, created_at, last_used_at, hits)"
+            " VALUES (?, ?, ?, ?, ?, 0)",
+            (key, filename, size, now, now),
+        )
+        self.evict()
+
+    def evict(self) -> int:
+        """超过条目数/总大小上限时，按最近使用时间淘汰并删除 HTML 文件；返回淘汰条数"""
+        if not self.max_entries and not self.max_bytes:
+            return 0
+        with self._transaction() as conn:
+            victims = evict_lru(conn, "render_cache", "key", self.max_entries, self.max_bytes)
+
+        for _, filename in victims:
+            try:
+                os.remove(self._path(filename))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"[渲染缓存] 删除淘汰的 HTML 失败: {filename}, 错误: {e}")
+        if victims:
+            with self._lock:
+                self._evicted += len(victims)
+            logger.info(f"[渲染缓存] 淘汰 {len(victims)} 个 HTML")
+        return len(victims)
+
+    def stats(self) -> dict:
+        count, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM render_cache"
+        ).fetchone()
+        with self._lock:
+            hits, misses, evicted = self._hits, self._misses, self._evicted
+        lookups = hits + misses
+        return {
+            "entries": count,
+            "bytes": total,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "evicted": evicted,
+        }
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+桑基图渲染进程池
+Excel 解析、多sheet转换、边表生成与 pyecharts 渲染都是 CPU 密集型操作，在任务线程中执行时会争用 GIL、互相串行。
+渲染进程池把这些步骤交给预热的子进程（已导入 pandas / openpyxl / pyecharts 并创建好桑基图服务实例）：
+- 一个任务在子进程中完成 解析 → 转换 → 渲染缓存查询 → 渲染 → 登记缓存，参数为 Excel 路径/字节或 DataFrame，
+  返回短元组，预算数据不再回传父进程
+- 每个任务有超时：超时或子进程崩溃时终止并重建进程池（超时会终止全部子进程，同时进行的其他任务重试一次）
+- 子进程处理 max_tasks_per_child 个任务后自动替换，限制内存增长
+子进程以 spawn 方式在第一次提交任务时才启动：不继承 gunicorn worker 的线程与连接，每个 worker 进程各自拥有一个进程池。
+"""
+
+import importlib
+import io
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Set, Tuple, Union
+
+import pandas as pd
+
+from .multi_sheet_converter import detect_and_convert_frames
+from .render_cache import RenderCache, fingerprint_frame, render_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+class RenderTimeout(RuntimeError):
+    """渲染任务超过超时时间（执行该任务的子进程已被终止）"""
+
+
+# ===== 任务函数（任务线程与渲染子进程共用）=====
+def read_budget_excel(source: Union[str, bytes]) -> Tuple[bool, pd.DataFrame]:
+    """读取 Excel 的全部 sheet 并得到预算宽格式数据（多sheet长格式时转换）
+    source: 文件路径或 Excel 文件内容
+    Returns: (是否经过多sheet转换, 预算 DataFrame)
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    frames = pd.read_excel(source, sheet_name=None, header=0)
+    return detect_and_convert_frames(frames)
+
+
+def render_budget(service: Any, budget: Any, source_name: str, output_html_path: str) -> Tuple[str, Any]:
+    """边表转换 + 渲染 HTML
+    budget: 宽格式预算文件路径或 DataFrame；source_name 用于图表标题
+    Returns: ("ok", 边数) / ("format_error", 错误信息) / ("render_error", 错误信息)
+    """
+    try:
+        # 预算数据只解析一次，边表转换与渲染共用
+        model = service.load_budget(budget)
+        edges_df = service.build_edges(model)
+    except Exception as e:
+        logger.exception(f"[渲染] 转换预算数据为边表失败: {source_name}")
+        return "format_error", f"{type(e).__name__}: {e}"
+    try:
+        ok = service.generate_sankey_chart(
+            edges_path=edges_df,
+            output_html_path=output_html_path,
+            budget_path=model,
+            source_name=source_name,
+        )
+    except Exception as e:
+        logger.exception(f"[渲染] 生成桑基图失败: {source_name}")
+        return "render_error", f"{type(e).__name__}: {e}"
+    if not ok:
+        return "render_error", "generate_sankey_chart 返回 False"
+    return "ok", len(edges_df)
+
+
+def render_budget_to_output(service: Any, cache: Optional[RenderCache], budget: Any, source_name: str,
+                            output_dir: str, data_only: bool) -> Tuple[str, Any, Optional[str]]:
+    """渲染缓存查询 + render_budget + 登记缓存；输出文件名由 source_name 决定
+    data_only: 只写数据文档 {source_name}_桑基图.json（SANKEY_PAGE_MODE=shell），否则写完整 HTML
+    Returns: ("cached", None, 文件名) / ("ok", 边数, 文件名) / ("format_error" | "render_error", 错误信息, None)
+    """
+    cache_key = None
+    if cache is not None:
+        try:
+            if not isinstance(budget, pd.DataFrame):
+                budget = pd.read_excel(budget)
+            cache_key = render_cache_key(
+                fingerprint_frame(budget),
+                service.get_chart_title(None, source_name),
+                # 页面模式不同的产物不能互相复用
+                f'{getattr(type(service), "RENDER_TEMPLATE_VERSION", "external")}/{"shell" if data_only else "standalone"}',
+            )
+            cached_filename = cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"[渲染] 查询渲染缓存失败，继续生成: {e}")
+            cached_filename = None
+        if cached_filename:
+            return "cached", None, cached_filename
+
+    filename = f"{source_name}_桑基图{'.json' if data_only else '.html'}"
+    status, detail = render_budget(service, budget, source_name, os.path.join(output_dir, filename))
+    if status != "ok":
+        return status, detail, None
+    if cache_key:
+        try:
+            cache.put(cache_key, filename)
+        except Exception as e:
+            logger.warning(f"[渲染] 登记渲染缓存失败: {e}")
+    return status, detail, filename
+
+
+def render_excel_to_output(service: Any, cache: Optional[RenderCache], source: Union[str, bytes], source_name: str,
+                           output_dir: str, data_only: bool) -> Tuple[str, Any, Optional[str]]:
+    """解析 Excel（多sheet长格式时转换）后执行 render_budget_to_output；只有解析/转换出错才返回 format_error
+    与文件流程的命名一致：经过多sheet转换时 source_name 追加 _宽格式（对应中间文件 {原文件名}_宽格式.xlsx）
+    """
+    try:
+        needs_conversion, budget = read_budget_excel(source)
+    except Exception as e:
+        logger.exception(f"[渲染] 解析 Excel 失败: {source_name}")
+        return "format_error", f"{type(e).__name__}: {e}", None
+    if needs_conversion:
+        source_name = f"{source_name}_宽格式"
+    return render_budget_to_output(service, cache, budget, source_name, output_dir, data_only)
+
+
+# ===== 子进程 =====
+_worker_service = None
+_worker_cache: Optional[RenderCache] = None
+
+
+def init_worker(service_module: str, service_path: Optional[str], service_kwargs: Dict[str, Any],
+                cache_kwargs: Optional[Dict[str, Any]] = None) -> None:
+    """子进程初始化：导入 openpyxl / pyecharts（随桑基图服务模块导入），创建服务实例并编译页面模板
+    cache_kwargs: 渲染缓存的构造参数（为空时不使用渲染缓存）；索引为 SQLite 文件，子进程与父进程共用
+    """
+    global _worker_service, _worker_cache
+    if service_path and service_path not in sys.path:
+        sys.path.insert(0, service_path)
+    import openpyxl  # noqa: F401  预热 Excel 读写
+    module = importlib.import_module(service_module)
+    _worker_service = module.SankeyService(**service_kwargs)
+    if hasattr(module, "get_page_template"):
+        module.get_page_template()
+    _worker_cache = RenderCache(**cache_kwargs) if cache_kwargs else None
+
+
+def _init_process(pid_queue: Any, initializer: Optional[Callable[..., None]], *initargs: Any) -> None:
+    # 先登记本进程 pid：任务超时时父进程据此终止子进程
+    pid_queue.put(os.getpid())
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _warm() -> int:
+    return os.getpid()
+
+
+def render_budget_in_worker(budget: Any, source_name: str, output_dir: str, data_only: bool) -> Tuple[str, Any, Optional[str]]:
+    """在渲染子进程中执行 render_budget_to_output（使用子进程的服务实例与渲染缓存）"""
+    return render_budget_to_output(_worker_service, _worker_cache, budget, source_name, output_dir, data_only)
+
+
+def render_excel_in_worker(source: Union[str, bytes], source_name: str, output_dir: str,
+                           data_only: bool) -> Tuple[str, Any, Optional[str]]:
+    """在渲染子进程中执行 render_excel_to_output"""
+    return render_excel_to_output(_worker_service, _worker_cache, source, source_name, output_dir, data_only)
+
+
+class RenderPool:
+    """预热的渲染子进程池（run 为同步调用，可在多个任务线程中并发使用）
+
+    标准库没有终止单个任务的接口：任务超时时终止全部子进程并重建进程池，
+    同时进行的其他任务会收到 BrokenProcessPool，在新进程池中重试一次。
+    """
+
+    def __init__(self, workers: int = 2, max_tasks_per_child: int = 50, timeout: float = 120,
+                 initializer: Optional[Callable[..., None]] = None, initargs: Tuple = ()):
+        """
+        Args:
+            workers: 子进程数
+            max_tasks_per_child: 每个子进程处理的任务数上限，达到后替换为新进程（0 表示不替换）；
+                Python 3.11 以下没有按子进程替换的接口，改为进程池累计处理 workers × max_tasks_per_child
+                个任务后整体替换（进行中的任务在旧进程中执行完）
+            timeout: 单个任务的超时时间（秒）
+            initializer / initargs: 子进程初始化函数（如 init_worker）及参数
+        """
+        if workers < 1:
+            raise ValueError("workers 必须 >= 1")
+        self.workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # 当前进程池的子进程 pid（子进程启动时经 _pid_queue 登记）
+        self._pid_queue: Any = None
+        self._pids: Set[int] = set()
+        self._executor_tasks = 0
+        self._lock = threading.Lock()
+        # 同时提交的任务数不超过子进程数：任务不在进程池内排队，超时只计算执行时间
+        self._slots = threading.BoundedSemaphore(workers)
+        self._in_flight = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._timeouts = 0
+        self._restarts = 0
+
+    def _ensure_started(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context("spawn")
+                self._pid_queue = context.SimpleQueue()
+                self._pids = set()
+                self._executor_tasks = 0
+                kwargs: Dict[str, Any] = {}
+                if self.max_tasks_per_child and sys.version_info >= (3, 11):
+                    kwargs["max_tasks_per_child"] = self.max_tasks_per_child
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context,
+                    initializer=_init_process,
+                    initargs=(self._pid_queue, self.initializer) + tuple(self.initargs),
+                    **kwargs,
+                )
+                # 预热：同时启动全部子进程并完成导入，之后的任务不再等待进程启动
+                for _ in range(self.workers):
+                    self._executor.submit(_warm)
+            return self._executor
+
+    def warm(self) -> None:
+        """提前启动子进程（可选；不调用时在第一次 run 时启动）"""
+        self._ensure_started()
+
+    def _collect_pids(self) -> None:
+        """读取新启动子进程登记的 pid，并去掉已退出的（调用方持有 self._lock）"""
+        if self._pid_queue is None:
+            return
+        while not self._pid_queue.empty():
+            self._pids.add(self._pid_queue.get())
+        # active_children 只包含本进程仍在运行的子进程，已退出子进程的 pid 即使被复用也不会误杀
+        alive = {process.pid for process in multiprocessing.active_children()}
+        self._pids &= alive
+
+    def _restart(self, executor: ProcessPoolExecutor, kill: bool = False) -> None:
+        """丢弃出错的进程池（kill=True 时终止其全部子进程），下次 run 时重建"""
+        with self._lock:
+            if self._executor is not executor:
+                return  # 其他线程已重建
+            self._collect_pids()
+            pids = set(self._pids)
+            self._executor = None
+            self._pid_queue = None
+            self._restarts += 1
+        if kill:
+            for process in multiprocessing.active_children():
+                if process.pid in pids:
+                    try:
+                        process.terminate()
+                    except Exception:
+                        pass
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _task_done(self, executor: ProcessPoolExecutor) -> None:
+        """Python 3.11 以下按进程池累计任务数整体替换子进程（不终止，进行中的任务照常完成）"""
+        with self._lock:
+            self._completed += 1
+            if self._executor is not executor:
+                return
+            self._collect_pids()
+            self._executor_tasks += 1
+            tasks = self._executor_tasks
+            recycle = (self.max_tasks_per_child and sys.version_info < (3, 11)
+                       and tasks >= self.workers * self.max_tasks_per_child)
+            if recycle:
+                self._executor = None
+                self._pid_queue = None
+                self._restarts += 1
+        if recycle:
+            logger.info(f"[渲染进程池] 已处理 {tasks} 个任务，替换子进程")
+            executor.shutdown(wait=False)
+
+    def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """在子进程中执行 fn(*args) 并返回结果；fn 须为模块级函数，参数与返回值须可 pickle
+        子进程崩溃（含被其他超时任务终止）时在新进程池中重试一次；超时抛出 RenderTimeout
+        """
+        with self._lock:
+            self._submitted += 1
+            self._in_flight += 1
+        self._slots.acquire()
+        try:
+            for attempt in range(2):
+                executor = self._ensure_started()
+                try:
+                    future = executor.submit(fn, *args)
+                except RuntimeError as e:
+                    # 进程池已损坏（BrokenProcessPool）或已被其他线程关闭重建
+                    self._restart(executor)
+                    if attempt:
+                        raise
+                    logger.warning(f"[渲染进程池] 进程池不可用，重建后重试: {e}")
+                    continue
+                try:
+                    result = future.result(timeout=self.timeout)
+                except FutureTimeout:
+                    with self._lock:
+                        self._timeouts += 1
+                    logger.error(f"[渲染进程池] 任务超时（{self.timeout}s），终止并重建进程池: {fn.__name__}")
+                    self._restart(executor, kill=True)
+                    raise RenderTimeout(f"渲染任务超时（{self.timeout}s）")
+                except BrokenProcessPool as e:
+                    self._restart(executor)
+                    if attempt:
+                        raise
+                    logger.warning(f"[渲染进程池] 子进程异常退出，重建后重试: {e}")
+                    continue
+                self._task_done(executor)
+                return result
+        except BaseException:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            self._slots.release()
+            with self._lock:
+                self._in_flight -= 1
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_tasks_per_child": self.max_tasks_per_child,
+                "timeout_seconds": self.timeout,
+                "started": self._executor is not None,
+                "in_flight": self._in_flight,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "timeouts": self._timeouts,
+                "restarts": self._restarts,
+            }
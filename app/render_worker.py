@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+渲染 worker：从任务代理领取 拉取→转换→渲染 任务，在本机执行后把产物（HTML 或数据文档）与状态写回代理
+与事件接收服务使用同一份 .env（飞书凭证、RENDER_BROKER_URL 等），按需启动多个；
+默认的 SQLite 任务代理只支持与事件接收服务同机部署，跨主机部署需配置其他 RenderBroker 实现。
+执行任务期间按租约的 1/3 间隔心跳续租，任务耗时超过租约也不会被其他 worker 重复执行。
+任务总在本进程执行（忽略 RENDER_DISPATCH），本机的渲染进程池、渲染缓存与元数据缓存照常生效。
+
+用法：python -m app.render_worker [--concurrency 2] [--poll-interval 1.0] [--worker-id host-1]
+"""
+
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+from types import ModuleType
+from typing import List, Optional
+
+from .render_broker import RenderBroker
+
+logger = logging.getLogger(__name__)
+
+
+def _keep_lease(broker: RenderBroker, job_id: str, worker_id: str, done: threading.Event) -> None:
+    """任务执行期间定期续租，直到 done 被设置或任务不再属于本 worker"""
+    interval = max(broker.lease_seconds / 3, 1.0)
+    while not done.wait(interval):
+        try:
+            if not broker.heartbeat(job_id, worker_id):
+                logger.warning(f"[渲染worker] 任务已取消或已转给其他 worker，停止续租: job_id={job_id}")
+                return
+        except Exception as e:
+            logger.warning(f"[渲染worker] 续租失败，稍后重试: job_id={job_id}, 错误: {e}")
+
+
+def process_one(service: ModuleType, broker: RenderBroker, worker_id: str) -> bool:
+    """领取并执行一个任务（service 为 app.main 模块）；没有待执行的任务时返回 False"""
+    claimed = broker.claim(worker_id)
+    if claimed is None:
+        return False
+    job_id, job, content = claimed
+    logger.info(f"[渲染worker] 领取任务: job_id={job_id}, kind={job.get('kind')}, worker={worker_id}")
+    html_filename = html = error = error_type = None
+    done = threading.Event()
+    if broker.lease_seconds:
+        threading.Thread(target=_keep_lease, args=(broker, job_id, worker_id, done),
+                         name=f"render-lease-{job_id[:8]}", daemon=True).start()
+    try:
+        success, result = service.run_render_job(job, content)
+        if success:
+            html_filename = service.sankey_artifact_filename(result)
+            with open(os.path.join(service.SANKEY_OUTPUT_DIR, html_filename), "rb") as f:
+                html = f.read()
+    except Exception as e:
+        logger.exception(f"[渲染worker] 任务执行出错: job_id={job_id}, 错误: {e}")
+        success, result = False, "桑基图生成失败"
+        error = str(e)
+        # 事件接收服务据此区分权限/接口错误（RuntimeError）与其他异常，回复不同的提示
+        error_type = "RuntimeError" if isinstance(e, RuntimeError) else type(e).__name__
+    finally:
+        done.set()
+    if broker.complete(job_id, worker_id, success, result, html_filename, html, error, error_type):
+        logger.info(f"[渲染worker] 任务完成: job_id={job_id}, success={success}, result={result}")
+    else:
+        logger.warning(f"[渲染worker] 任务已取消或已转给其他 worker，结果未写回: job_id={job_id}")
+    return True
+
+
+def run(service: ModuleType, broker: RenderBroker, worker_id: str, poll_interval: float,
+        stop: threading.Event) -> None:
+    """循环领取任务，队列为空时每 poll_interval 秒查询一次，直到 stop 被设置"""
+    while not stop.is_set():
+        try:
+            if process_one(service, broker, worker_id):
+                continue
+        except Exception as e:
+            logger.exception(f"[渲染worker] 访问任务代理失败: {e}")
+        stop.wait(poll_interval)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Sankey render worker consuming jobs from the render broker")
+    parser.add_argument("--concurrency", type=int, default=1, help="同时执行的任务数")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="队列为空时的查询间隔（秒）")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # 在 main() 中导入：渲染子进程以 spawn 方式启动时会重新导入本模块，模块级不加载服务配置
+    # 导入前设置 RENDER_DISPATCH：worker 自身不再把任务转交给代理
+    os.environ["RENDER_DISPATCH"] = "local"
+    from . import main as service
+    broker = service.create_render_broker()
+    logger.info(f"[渲染worker] 启动: worker_id={args.worker_id}, concurrency={args.concurrency}, "
+                f"broker={service.RENDER_BROKER_URL}")
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=run, args=(service, broker, f"{args.worker_id}-{i}", args.poll_interval, stop),
+                         name=f"render-worker-{i}", daemon=True)
+        for i in range(args.concurrency)
+    ]
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("[渲染worker] 收到中断，等待进行中的任务结束")
+        stop.set()
+        for t in threads:
+            t.join()
+    if service.RENDER_POOL is not None:
+        service.RENDER_POOL.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+桑基图共用页面外壳
+SANKEY_PAGE_MODE=shell 时每张图只保存数据文档 {名称}_桑基图.json（option + 节点描述），
+页面 /sankey/{名称}_桑基图.html 由所有图表共用的外壳提供：加载本服务托管的固定版本 echarts.min.js，
+再请求同名 .json 渲染图表并绑定节点描述弹窗。ECharts 的 URL 含版本号，浏览器长期缓存，只下载一次。
+"""
+
+import json
+
+# pyecharts 默认引用的远程 ECharts（本地资源缺失时，此前生成的数据文档页面回退引用）
+ECHARTS_REMOTE_SRC = "https://assets.pyecharts.org/assets/v6/echarts.min.js"
+
+PAGE_SUFFIX = ".html"
+DATA_SUFFIX = ".json"
+
+_SHELL_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>动态桑基图</title>
+    <script type="text/javascript" src={ECHARTS_SRC}></script>
+</head>
+<body>
+    <div id="sankey_chart" style="width:100%; height:100vh;"></div>
+{POPUP_MODAL}    <script>
+        (function() {
+            const container = document.getElementById('sankey_chart');
+            const chart = echarts.init(container, 'white', {renderer: 'canvas', locale: 'ZH'});
+            window.addEventListener('resize', function() { chart.resize(); });
+
+            const modal = document.getElementById('descriptionModal');
+            const title = document.getElementById('modalTitle');
+            const body  = document.getElementById('modalDescription');
+            function hide() { modal.style.display = 'none'; }
+            document.querySelector('#descriptionModal .close').onclick = hide;
+            window.addEventListener('click', (e) => { if (e.target === modal) hide(); });
+            window.addEventListener('keydown', (e) => { if (e.key === 'Escape') hide(); });
+
+            function bindDescriptions(descriptions) {
+                chart.on('click', function(params) {
+                    if (params && params.componentType === 'series' && params.dataType === 'node') {
+                        const name = (params.data && (params.data.name || params.name)) || params.name;
+                        const desc = descriptions[name];
+                        title.textContent = name || '未知节点';
+                        if (desc) { body.textContent = desc; body.className = 'modal-description'; }
+                        else { body.textContent = '暂无节点描述信息'; body.className = 'modal-description no-description'; }
+                        modal.style.display = 'block';
+                    }
+                });
+            }
+
+            // 数据文档与页面同名：/sankey/{名称}.html -> /sankey/{名称}.json
+            fetch(location.pathname.replace(/\\.html$/, '.json'))
+                .then(function(resp) {
+                    if (!resp.ok) throw new Error('HTTP ' + resp.status);
+                    return resp.json();
+                })
+                .then(function(doc) {
+                    chart.setOption(doc.option);
+                    if (doc.descriptions && Object.keys(doc.descriptions).length) bindDescriptions(doc.descriptions);
+                })
+                .catch(function(err) {
+                    chart.dispose();
+                    container.textContent = '桑基图数据加载失败：' + err.message;
+                });
+        })();
+    </script>
+</body>
+</html>
+"""
+
+
+def echarts_asset_url(version: str) -> str:
+    """本地 ECharts 的 URL（相对于 /sankey/ 下的页面，服务挂在反向代理子路径下时同样可用）"""
+    return f"../assets/echarts/{version}/echarts.min.js"
+
+
+def render_shell(echarts_src: str) -> bytes:
+    """生成共用页面外壳（进程启动时生成一次）"""
+    # 弹窗结构与样式和完整 HTML 共用；在此导入，文件名换算等函数不依赖 pyecharts
+    from .sankey_service_with_polling import POPUP_MODAL_HTML
+    html = (_SHELL_TEMPLATE
+            .replace("{ECHARTS_SRC}", json.dumps(echarts_src))
+            .replace("{POPUP_MODAL}", POPUP_MODAL_HTML.lstrip("\n")))
+    return html.encode("utf-8")
+
+
+def data_filename(page_filename: str) -> str:
+    """页面文件名对应的数据文档文件名：{名称}.html -> {名称}.json"""
+    if page_filename.endswith(PAGE_SUFFIX):
+        return page_filename[:-len(PAGE_SUFFIX)] + DATA_SUFFIX
+    return page_filename
+
+
+def page_filename(filename: str) -> str:
+    """数据文档对应的页面文件名：{名称}.json -> {名称}.html（完整 HTML 文件名原样返回）"""
+    if filename.endswith(DATA_SUFFIX):
+        return filename[:-len(DATA_SUFFIX)] + PAGE_SUFFIX
+    return filename
@@ -13,8 +13,11 @@
 每2秒检查Excel文件变化，自动生成桑基图
 """
 
+import json
 import os
+import re
 import time
+import numpy as np
 import pandas as pd
 from pyecharts.charts import Sankey
 from pyecharts import options as opts
@@ -22,10 +25,16 @@ import logging
 from datetime import datetime
 import hashlib
 import threading
+import uuid
 import signal
 import sys
 import requests
 import urllib.parse
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
 
 # 颜色调色板
 COLOR_PALETTE = [
@@ -35,7 +44,331 @@ COLOR_PALETTE = [
     "#2b908f", "#f45b5b"
 ]
 
+# 会议别名：按时间列顺序依次使用，超出部分为"第N次"
+MEETING_ALIASES = ["初始", "第一次", "第二次", "第三次", "第四次", "第五次"]
+
+# 阶段别名到节点显示名称前的数字符号（从①开始）
+PHASE_SYMBOLS = MappingProxyType({
+    "初始": "①",
+    "第一次": "②",
+    "第二次": "③",
+    "第三次": "④",
+    "第四次": "⑤",
+    "第五次": "⑥",
+})
+
+# 边表中可作为数值列的列名（按优先级）
+VALUE_COLUMNS = ('value', 'Value', 'VALUE', '数值', '金额', '数量', '流量')
+
+# 资源池节点（灰色）与图表标题中的文件名前缀
+RESOURCE_POOL_RE = re.compile(r'^资源池[一二三四五六七八九十①②③④⑤⑥⑦⑧⑨⑩\d]+$')
+TITLE_PREFIX_RE = re.compile(r'^([^-]+(?:-[^-]+)?)')
+
+# 节点描述弹窗的结构与样式（完整 HTML 与共用页面外壳 app/sankey_page.py 共用）
+POPUP_MODAL_HTML = """
+    <div id="descriptionModal" class="modal">
+        <div class="modal-content">
+            <span class="close">&times;</span>
+            <div class="modal-title" id="modalTitle">项目描述</div>
+            <div class="modal-description" id="modalDescription"></div>
+        </div>
+    </div>
+    <style>
+        #descriptionModal { display:none; position:fixed; z-index:1000; left:0; top:0; width:100%; height:100%; background:rgba(0,0,0,0.5); }
+        .modal-content { background:#fff; margin:5% auto; padding:20px; border-radius:8px; width:80%; max-width:600px; box-shadow:0 4px 20px rgba(0,0,0,.3); position:relative; }
+        .close { color:#aaa; position:absolute; right:15px; top:10px; font-size:28px; font-weight:bold; cursor:pointer; }
+        .close:hover{ color:#000; }
+        .modal-title { font-size:18px; font-weight:bold; margin-bottom:12px; color:#333; border-bottom:2px solid #4CAF50; padding-bottom:8px; }
+        .modal-description { font-size:14px; line-height:1.6; color:#555; white-space:pre-line; }
+        .no-description { color:#999; font-style:italic; }
+    </style>
+"""
+
+# 节点描述弹窗：注入在完整 HTML 的 </body> 之前，{DESC_JSON} 替换为 显示名称 -> 描述 的 JSON
+POPUP_INJECT_HTML = POPUP_MODAL_HTML + """    <script>
+        (function() {
+            const NODE_DESCRIPTIONS = {DESC_JSON};
+            function bind() {
+                if (!window.echarts) return false;
+                const all = document.querySelectorAll('div, canvas');
+                let chart = null;
+                for (const el of all) {
+                    if (!el.id) continue;
+                    try {
+                        const inst = echarts.getInstanceByDom(el);
+                        if (inst) { chart = inst; break; }
+                    } catch(e) {}
+                }
+                if (!chart) return false;
+
+                const modal = document.getElementById('descriptionModal');
+                const title = document.getElementById('modalTitle');
+                const body  = document.getElementById('modalDescription');
+                const closeBtn = document.querySelector('#descriptionModal .close');
+
+                function show(name) {
+                    const desc = NODE_DESCRIPTIONS[name];
+                    title.textContent = name || '未知节点';
+                    if (desc) { body.textContent = desc; body.className = 'modal-description'; }
+                    else { body.textContent = '暂无节点描述信息'; body.className = 'modal-description no-description'; }
+                    modal.style.display = 'block';
+                }
+                function hide() { modal.style.display = 'none'; }
+
+                closeBtn.onclick = hide;
+                window.addEventListener('click', (e) => { if (e.target === modal) hide(); });
+                window.addEventListener('keydown', (e) => { if (e.key === 'Escape') hide(); });
+
+                chart.off('click');
+                chart.on('click', function(params) {
+                    if (params && params.componentType === 'series' && params.dataType === 'node') {
+                        show((params.data && (params.data.name || params.name)) || params.name);
+                    }
+                });
+                return true;
+            }
+            let tries = 0;
+            const timer = setInterval(function() {
+                tries += 1;
+                if (bind() || tries >= 10) clearInterval(timer);
+            }, 300);
+        })();
+    </script>
+"""
+
+# 日志只在进程内配置一次：服务实例可能被多次创建，每次都新建 FileHandler 会累积文件句柄
+_logging_lock = threading.Lock()
+_logging_configured = False
+
+
+@dataclass(frozen=True)
+class BudgetModel:
+    """宽格式预算表解析结果（只解析一次，供边表、节点金额、节点描述、总预算、节点排序共用）
+
+    宽格式：第一列为时间列（会议），之后为 项目列/说明列 成对出现，最后一列为总预算。
+    同一会议出现多行时以第一行为准（与按会议筛选后取 iloc[0] 一致）。
+    金额等按 (会议, 项目) 存为只读矩阵，第 i 行对应 meetings[i]，第 j 列对应 project_cols[j]。
+    """
+    time_col: object
+    total_col: object
+    meetings: Tuple                 # 时间列非空值，按表格顺序
+    aliases: Mapping                # 会议 -> 别名（初始/第一次/...）
+    project_cols: Tuple             # 项目列（索引 1, 3, 5...，不含最后一列）
+    description_cols: Tuple         # 说明列（索引 2, 4, 6...，不含最后一列）
+    amounts: np.ndarray             # (会议数, 项目数) 金额，空值为 0
+    integer_projects: Tuple         # 各项目列是否为整数类型（边表金额保持原类型）
+    descriptions: np.ndarray        # (会议数, 项目数) 说明，空值或无说明列为 None
+    totals: Tuple                   # 各会议总预算列原值
+    total_parts: Optional[np.ndarray] = None  # (会议数, 校验列数) 用于核对总预算的各列金额，空值为 NaN
+    total_part_error: Optional[str] = None    # 校验列无法转换为数值时的错误信息
+
+    @classmethod
+    def from_frame(cls, budget_df: pd.DataFrame) -> "BudgetModel":
+        columns = list(budget_df.columns)
+        time_col = columns[0]
+        total_col = columns[-1]
+        project_cols = tuple(columns[i] for i in range(1, len(columns) - 1, 2))
+        description_cols = tuple(columns[i] for i in range(2, len(columns) - 1, 2))
+
+        # 按会议建一次索引：每个会议取第一行，行顺序与 meetings 一致（重复会议会重复取同一行）
+        time_series = budget_df[time_col]
+        valid = time_series.notna().to_numpy()
+        meetings = tuple(time_series[valid].tolist())
+        first_rows = budget_df[valid].drop_duplicates(subset=[time_col], keep="first")
+        positions = pd.Index(first_rows[time_col]).get_indexer(list(meetings))
+        rows = first_rows.iloc[positions]
+
+        aliases = {}
+        for i, meeting in enumerate(meetings):
+            aliases[meeting] = MEETING_ALIASES[i] if i < len(MEETING_ALIASES) else f"第{i+1}次"
+
+        project_block = rows[list(project_cols)]
+        amounts = project_block.fillna(0).to_numpy(dtype=float).reshape(len(meetings), len(project_cols))
+        integer_projects = tuple(pd.api.types.is_integer_dtype(dtype) for dtype in project_block.dtypes)
+
+        descriptions = np.full((len(meetings), len(project_cols)), None, dtype=object)
+        for j, desc_col in enumerate(description_cols):
+            values = rows[desc_col].to_numpy(dtype=object)
+            notnull = rows[desc_col].notna().to_numpy()
+            for i in np.flatnonzero(notnull):
+                text = str(values[i])
+                if text:
+                    descriptions[i, j] = text
+
+        total_parts = None
+        total_part_error = None
+        try:
+            part_cols = [col for col in columns[1:-1] if not col.endswith('_说明')]
+            total_parts = rows[part_cols].to_numpy(dtype=float).reshape(len(meetings), len(part_cols))
+        except Exception as e:
+            total_part_error = str(e)
+
+        for array in (amounts, descriptions, total_parts):
+            if array is not None:
+                array.flags.writeable = False
+
+        return cls(
+            time_col=time_col,
+            total_col=total_col,
+            meetings=meetings,
+            aliases=MappingProxyType(aliases),
+            project_cols=project_cols,
+            description_cols=description_cols,
+            amounts=amounts,
+            integer_projects=integer_projects,
+            descriptions=descriptions,
+            totals=tuple(rows[total_col].tolist()),
+            total_parts=total_parts,
+            total_part_error=total_part_error,
+        )
+
+    @classmethod
+    def from_path(cls, budget_file_path: str) -> "BudgetModel":
+        return cls.from_frame(pd.read_excel(budget_file_path))
+
+    @staticmethod
+    def meeting_time(meeting) -> str:
+        """会议名中括号内的时间，如 "第一次会议(2025-01)" -> "2025-01"；无括号时返回原值"""
+        return meeting.split('(')[1].split(')')[0] if '(' in meeting else meeting
+
+    def node_name(self, project, meeting) -> str:
+        """节点名称：项目（别名：时间）"""
+        return f"{project}（{self.aliases[meeting]}：{self.meeting_time(meeting)}）"
+
+    @cached_property
+    def node_names(self) -> np.ndarray:
+        """(会议数, 项目数) 节点名称矩阵，首次使用时生成"""
+        names = np.empty((len(self.meetings), len(self.project_cols)), dtype=object)
+        for i, meeting in enumerate(self.meetings):
+            label = f"（{self.aliases[meeting]}：{self.meeting_time(meeting)}）"
+            for j, project in enumerate(self.project_cols):
+                names[i, j] = f"{project}{label}"
+        names.flags.writeable = False
+        return names
+
+
+def build_sankey_chart(nodes, links, title, subtitle, subtitle_font_size):
+    """桑基图的 pyecharts 配置（图表样式只在这里声明；SankeyPageTemplate 据此编译页面模板与 option 骨架）"""
+    return (
+        Sankey(init_opts=opts.InitOpts(width="100%", height="100vh", page_title="动态桑基图"))
+        .add(
+            "预算流向分析",
+            nodes=nodes,
+            links=links,
+            orient="horizontal",
+            node_align="justify",
+            node_gap=15,
+            node_width=15,
+            layout_iterations=0,  # 禁用自动布局优化，让节点按照links数组的顺序排列
+            pos_top="8%",  # 为标题和副标题留出空间
+            linestyle_opt=opts.LineStyleOpts(opacity=0.6, curve=0.5, color="source"),
+            label_opts=opts.LabelOpts(position="right", formatter="{b}", font_size=9),
+            itemstyle_opts=opts.ItemStyleOpts(border_width=1, border_color="#ccc", opacity=0.9)
+        )
+        .set_global_opts(
+            title_opts=opts.TitleOpts(
+                title=title,
+                pos_left="center",
+                title_textstyle_opts=opts.TextStyleOpts(font_size=18),
+                subtitle=subtitle,
+                subtitle_textstyle_opts=opts.TextStyleOpts(font_size=subtitle_font_size)
+            ),
+            tooltip_opts=opts.TooltipOpts(trigger="item", trigger_on="mousemove", formatter="{b}"),
+            legend_opts=opts.LegendOpts(is_show=False)
+        )
+    )
+
+
+def _drop_empty(item: dict) -> dict:
+    """与 pyecharts 输出一致：去掉值为 None 或空字符串的键"""
+    return {k: v for k, v in item.items() if v is not None and v != ""}
+
+
+class SankeyPageTemplate:
+    """桑基图页面模板（每个进程编译一次，只读，可在多个线程间共用）
+
+    编译时用占位数据让 pyecharts 渲染一次，拆出页面的固定片段与 option 骨架；
+    之后每张图只替换节点、连线与标题生成 option JSON，并把页面、option 与弹窗一次顺序写出，
+    不再经过 pyecharts 模板渲染，也不再写出 HTML 后读回注入弹窗。输出与 render + create_html_with_popup 一致。
+    """
+
+    _CHART_ID = "__sankey_chart_id__"
+    _TITLE = "__sankey_title__"
+    _SUBTITLE = "__sankey_subtitle__"
+
+    def __init__(self):
+        chart = build_sankey_chart([], [], self._TITLE, self._SUBTITLE, 12)
+        chart.chart_id = self._CHART_ID
+        html = chart.render_embed()
+        head, tail = html.split(chart.json_contents)
+        body_end = tail.rindex("</body>")
+        self._head = head.split(self._CHART_ID)
+        self._tail = tail[:body_end].split(self._CHART_ID)
+        self._end = tail[body_end:]
+        self._skeleton = json.loads(chart.json_contents)
+
+    def options(self, nodes, links, title, subtitle, subtitle_font_size) -> dict:
+        """图表 option（与 build_sankey_chart(...).get_options() 相同）；骨架中的共享对象不被修改"""
+        option = dict(self._skeleton)
+        series = dict(option["series"][0])
+        series["data"] = [_drop_empty(node) for node in nodes]
+        series["links"] = [_drop_empty(link) for link in links]
+        option["series"] = [series]
+        title_opts = dict(option["title"][0])
+        title_opts["text"] = title
+        if subtitle:
+            title_opts["subtext"] = subtitle
+        else:
+            del title_opts["subtext"]
+        title_opts["subtextStyle"] = dict(title_opts["subtextStyle"], fontSize=subtitle_font_size)
+        option["title"] = [title_opts]
+        return option
+
+    def write(self, output_html_path, option: dict, node_descriptions=None) -> None:
+        """一次写出完整 HTML；node_descriptions（显示名称 -> 描述）非空时在 </body> 前附带弹窗"""
+        chart_id = uuid.uuid4().hex
+        with open(output_html_path, "w", encoding="utf-8") as f:
+            f.write(chart_id.join(self._head))
+            json.dump(option, f, indent=4)
+            f.write(chart_id.join(self._tail))
+            if node_descriptions:
+                f.write(POPUP_INJECT_HTML.replace("{DESC_JSON}", json.dumps(node_descriptions, ensure_ascii=False)))
+                f.write("\n")
+            f.write(self._end)
+
+    @staticmethod
+    def write_data(output_json_path, option: dict, node_descriptions=None) -> None:
+        """只写出数据文档 {"option": ..., "descriptions": 显示名称 -> 描述}，由共用页面外壳加载渲染"""
+        with open(output_json_path, "w", encoding="utf-8") as f:
+            json.dump({"option": option, "descriptions": node_descriptions or {}}, f,
+                      ensure_ascii=False, separators=(",", ":"))
+
+
+_page_template = None
+_page_template_lock = threading.Lock()
+
+
+def get_page_template() -> SankeyPageTemplate:
+    """本进程的页面模板（首次使用时编译）"""
+    global _page_template
+    if _page_template is None:
+        with _page_template_lock:
+            if _page_template is None:
+                _page_template = SankeyPageTemplate()
+    return _page_template
+
+
 class SankeyService:
+    """桑基图生成服务
+    实例只保存配置（目录、轮询间隔）与预算解析缓存；单次生成的参数（边表、预算数据、输出路径、标题）
+    均由调用方传入，因此一个实例可以长期复用，并在多个线程间并发调用。
+    """
+
+    # 渲染模板版本：修改图表配置、HTML 模板或节点命名规则时递增，使渲染缓存中的旧 HTML 失效
+    RENDER_TEMPLATE_VERSION = "1"
+    # 输出路径以 .json 结尾时只写数据文档（见 SankeyPageTemplate.write_data）
+    SUPPORTS_CHART_DATA = True
+
     def __init__(self,
                  watch_dir="/home/cnooc/file/excel",
                  output_dir="/home/cnooc/file/sankey",
@@ -49,6 +382,9 @@ class SankeyService:
         self.log_file = log_file  # 先赋值log_file
         self.running = False
         self.file_hashes = {}  # 记录文件哈希值，用于检测变化
+        self.budget_cache_size = 8  # 已解析的预算文件（BudgetModel）缓存个数
+        self._budget_cache = OrderedDict()
+        self._budget_cache_lock = threading.Lock()
         
         # 确保输出目录存在
         os.makedirs(output_dir, exist_ok=True)
@@ -60,15 +396,19 @@ class SankeyService:
         self.logger.info("桑基图服务初始化完成")
     
     def setup_logging(self):
-        """设置日志"""
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(self.log_file),
-                logging.StreamHandler()
-            ]
-        )
+        """设置日志（幂等：进程内只配置一次）"""
+        global _logging_configured
+        with _logging_lock:
+            if not _logging_configured:
+                logging.basicConfig(
+                    level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[
+                        logging.FileHandler(self.log_file),
+                        logging.StreamHandler()
+                    ]
+                )
+                _logging_configured = True
         self.logger = logging.getLogger(__name__)
     
     def get_file_hash(self, file_path):
@@ -106,74 +446,91 @@ class SankeyService:
         except Exception:
             return False
     
-    def convert_budget_to_edges(self, budget_file_path):
-        """将预算文件转换为边表文件"""
+    def _has_budget(self, budget):
+        if isinstance(budget, (pd.DataFrame, BudgetModel)):
+            return True
+        return bool(budget) and os.path.exists(budget)
+
+    def load_budget(self, budget):
+        """解析预算数据为 BudgetModel
+        budget 可以是预算文件路径、宽格式 DataFrame 或已解析的 BudgetModel（原样返回）。
+        文件按 (路径, 修改时间, 大小) 缓存，轮询模式下边表转换与渲染共用同一次解析。
+        """
+        if isinstance(budget, BudgetModel):
+            return budget
+        if isinstance(budget, pd.DataFrame):
+            return BudgetModel.from_frame(budget)
+        st = os.stat(budget)
+        key = (os.path.abspath(budget), st.st_mtime_ns, st.st_size)
+        with self._budget_cache_lock:
+            model = self._budget_cache.get(key)
+            if model is not None:
+                self._budget_cache.move_to_end(key)
+                return model
+        model = BudgetModel.from_path(budget)
+        with self._budget_cache_lock:
+            self._budget_cache[key] = model
+            while len(self._budget_cache) > self.budget_cache_size:
+                self._budget_cache.popitem(last=False)
+        return model
+
+    def budget_edges(self, model):
+        """由预算模型生成边表记录：相邻会议之间的主流量，以及流入/流出资源池的差额
+        边的顺序：按项目、再按相邻会议，每段先主流量、后资源池
+        """
+        chinese_numerals = ['一', '二', '三', '四', '五', '六', '七', '八', '九', '十']
+        if len(model.meetings) < 2 or not model.project_cols:
+            return []
+        amounts = model.amounts
+        names = model.node_names
+        from_values = amounts[:-1]   # (会议段数, 项目数)
+        to_values = amounts[1:]
+        main_flow = np.minimum(from_values, to_values)
+        change = to_values - from_values  # >0 为流入（资源池 -> 后一次），<0 为流出（前一次 -> 资源池）
+
+        # 先按 (项目, 会议段, 主流量/资源池) 排序，再批量生成
+        main_seg, main_proj = np.nonzero(main_flow > 0)
+        pool_seg, pool_proj = np.nonzero(change != 0)
+        seg = np.concatenate([main_seg, pool_seg])
+        proj = np.concatenate([main_proj, pool_proj])
+        kind = np.concatenate([np.zeros(len(main_seg), dtype=int), np.ones(len(pool_seg), dtype=int)])
+        order = np.lexsort((kind, seg, proj))
+
+        pools = [f"资源池{chinese_numerals[i] if i < len(chinese_numerals) else str(i+1)}"
+                 for i in range(len(model.meetings) - 1)]
+        integer_projects = model.integer_projects
+        edges = []
+        for i, j, k in zip(seg[order].tolist(), proj[order].tolist(), kind[order].tolist()):
+            if k == 0:
+                source, target, value = names[i, j], names[i + 1, j], main_flow[i, j]
+            elif change[i, j] < 0:
+                source, target, value = names[i, j], pools[i], -change[i, j]
+            else:
+                source, target, value = pools[i], names[i + 1, j], change[i, j]
+            value = int(value) if integer_projects[j] else float(value)
+            edges.append({"source": source, "target": target, "value": value})
+        return edges
+
+    def build_edges(self, budget):
+        """由预算数据生成内存边表（source/target/value 三列），可直接传给 generate_sankey_chart
+        budget 可以是预算文件路径、宽格式 DataFrame 或 BudgetModel
+        """
+        model = self.load_budget(budget)
+        return pd.DataFrame(self.budget_edges(model), columns=["source", "target", "value"])
+
+    def convert_budget_to_edges(self, budget_file_path, budget_name=None, output_dir=None):
+        """将预算文件转换为边表文件（需要边表文件时使用；生成桑基图请直接用 build_edges）
+        budget_file_path 也可以是宽格式 DataFrame 或 BudgetModel，此时用 budget_name 命名边表文件
+        output_dir: 边表文件目录，默认 watch_dir
+        """
         try:
-            import pandas as pd
-            import re
-            
-            self.logger.info("开始转换预算文件为边表: {}".format(os.path.basename(budget_file_path)))
-            
-            # 读取预算文件
-            budget_df = pd.read_excel(budget_file_path)
-            
-            # 按照固定模式识别列
-            time_col = budget_df.columns[0]
-            project_cols = [budget_df.columns[i] for i in range(1, len(budget_df.columns) - 1, 2)]
-            description_cols = [budget_df.columns[i] for i in range(2, len(budget_df.columns) - 1, 2)]
+            if budget_name is None:
+                budget_name = os.path.splitext(os.path.basename(budget_file_path))[0]
+            self.logger.info("开始转换预算文件为边表: {}".format(budget_name))
             
-            meetings = budget_df[time_col].dropna().tolist()
-            
-            version_aliases = {}
-            meeting_aliases = ["初始", "第一次", "第二次", "第三次", "第四次", "第五次"]
-            for i, meeting in enumerate(meetings):
-                version_aliases[meeting] = meeting_aliases[i] if i < len(meeting_aliases) else f"第{i+1}次"
-            
-            project_to_description = {}
-            for i, project_col in enumerate(project_cols):
-                if i < len(description_cols):
-                    project_to_description[project_col] = description_cols[i]
-            
-            chinese_numerals = ['一', '二', '三', '四', '五', '六', '七', '八', '九', '十']
-            edges = []
-            for project_col in project_cols:
-                project_name = project_col
-                project_values = {}
-                for meeting in meetings:
-                    value = budget_df[budget_df[time_col] == meeting][project_col].iloc[0]
-                    project_values[meeting] = value if pd.notnull(value) else 0
-                for i in range(len(meetings) - 1):
-                    from_meeting = meetings[i]
-                    to_meeting = meetings[i + 1]
-                    from_alias = version_aliases.get(from_meeting, from_meeting)
-                    to_alias = version_aliases.get(to_meeting, to_meeting)
-                    from_value = project_values[from_meeting]
-                    to_value = project_values[to_meeting]
-                    main_flow = min(from_value, to_value)
-                    if main_flow > 0:
-                        from_time = from_meeting.split('(')[1].split(')')[0] if '(' in from_meeting else from_meeting
-                        to_time = to_meeting.split('(')[1].split(')')[0] if '(' in to_meeting else to_meeting
-                        source_node = f"{project_name}（{from_alias}：{from_time}）"
-                        target_node = f"{project_name}（{to_alias}：{to_time}）"
-                        edges.append({"source": source_node, "target": target_node, "value": main_flow})
-                    if from_value > to_value:
-                        excess = from_value - to_value
-                        if excess > 0:
-                            resource_pool = f"资源池{chinese_numerals[i] if i < len(chinese_numerals) else str(i+1)}"
-                            from_time = from_meeting.split('(')[1].split(')')[0] if '(' in from_meeting else from_meeting
-                            source_node = f"{project_name}（{from_alias}：{from_time}）"
-                            edges.append({"source": source_node, "target": resource_pool, "value": excess})
-                    elif to_value > from_value:
-                        deficit = to_value - from_value
-                        if deficit > 0:
-                            resource_pool = f"资源池{chinese_numerals[i] if i < len(chinese_numerals) else str(i+1)}"
-                            to_time = to_meeting.split('(')[1].split(')')[0] if '(' in to_meeting else to_meeting
-                            target_node = f"{project_name}（{to_alias}：{to_time}）"
-                            edges.append({"source": resource_pool, "target": target_node, "value": deficit})
-            edges_df = pd.DataFrame(edges)
+            edges_df = self.build_edges(budget_file_path)
             # 按预算文件名命名边表：{预算文件名}_edges.xlsx
-            budget_base = os.path.splitext(os.path.basename(budget_file_path))[0]
-            edges_file_path = os.path.join(self.watch_dir, f"{budget_base}_edges.xlsx")
+            edges_file_path = os.path.join(output_dir or self.watch_dir, f"{budget_name}_edges.xlsx")
             edges_df.to_excel(edges_file_path, index=False)
             self.logger.info("成功转换预算文件为边表: {}, 边数: {}".format(os.path.basename(edges_file_path), len(edges_df)))
             return edges_file_path
@@ -200,16 +557,20 @@ class SankeyService:
                 if 'edge' in name or ('source' in name and 'target' in name):
                     edges_file = p
                     break
+        edges = edges_file
         if budget_file and not edges_file:
+            # 预算文件直接在内存中生成边表，不再写 *_edges.xlsx 到监听目录
             self.logger.info("检测到预算文件，正在转换为边表...")
-            edges_file = self.convert_budget_to_edges(budget_file)
-            if not edges_file:
-                self.logger.error("预算文件转换失败")
+            try:
+                edges = self.build_edges(budget_file)
+            except Exception as e:
+                self.logger.error("预算文件转换失败: {}".format(e))
                 return False
-        if edges_file is None:
+        if edges is None:
             self.logger.error("目录中未找到边表文件或预算文件")
             return False
-        self.logger.info("检测到边表文件: {}".format(os.path.basename(edges_file)))
+        if edges_file:
+            self.logger.info("检测到边表文件: {}".format(os.path.basename(edges_file)))
         if budget_file:
             self.logger.info("检测到预算文件: {}".format(os.path.basename(budget_file)))
         if budget_file:
@@ -219,7 +580,7 @@ class SankeyService:
             base_name = os.path.splitext(os.path.basename(edges_file))[0]
             out_name = f"sankey_{base_name}.html"
         out_path = os.path.join(self.output_dir, out_name)
-        ok = self.generate_sankey_chart(edges_file, out_path, budget_file)
+        ok = self.generate_sankey_chart(edges, out_path, budget_file)
         return ok
 
     def extract_phases_from_nodes(self, nodes):
@@ -250,123 +611,81 @@ class SankeyService:
                         projects.add(project)
         return sorted(list(projects))
 
+    def node_descriptions(self, model):
+        """节点名称 -> 说明（仅有说明的节点）"""
+        has_desc = pd.notna(model.descriptions)
+        return dict(zip(model.node_names[has_desc].tolist(), model.descriptions[has_desc].tolist()))
+
+    def node_amounts(self, model):
+        """节点名称 -> 金额"""
+        return dict(zip(model.node_names.ravel().tolist(), model.amounts.ravel().tolist()))
+
+    def phase_totals(self, model):
+        """按sheet返回 (别名, sheet时间, 总预算) 列表，用于标题下方展示
+        时间列格式：sheet_name_phase，显示为sheet的时间
+        总预算保留8位小数，并与各项目列之和核对
+        """
+        phase_info = []  # [(alias, sheet_time, total), ...]
+        for i, meeting in enumerate(model.meetings):
+            meeting_str = str(meeting)
+            
+            # 提取sheet名称：时间列格式为 sheet_name_phase
+            # 例如：25年_25年预算 -> 只显示 25年（第一个下划线之前的部分）
+            if "_" in meeting_str:
+                # 格式：sheet_name_phase，只取第一个下划线之前的部分（sheet名称）
+                sheet_time = meeting_str.split("_", 1)[0]  # 只取第一个部分（sheet名称）
+            else:
+                sheet_time = meeting_str
+            
+            v = model.totals[i]
+            if pd.notnull(v):
+                try:
+                    # 总预算保留8位小数（预算金额要严谨）
+                    total_value = round(float(v), 8)
+                    
+                    # 验证：从项目列计算总预算，验证是否一致（逐项保留8位小数累加）
+                    if model.total_parts is None:
+                        raise ValueError(model.total_part_error)
+                    calculated_sum = 0.0
+                    for col_value in model.total_parts[i].tolist():
+                        if col_value == col_value:  # 跳过空值（NaN）
+                            calculated_sum = round(calculated_sum + round(col_value, 8), 8)
+                    
+                    # 验证总预算（允许浮点数误差）
+                    if abs(calculated_sum - total_value) > 0.00000001:
+                        self.logger.warning(f"总预算验证不一致: 时间列={meeting_str}, 总预算列={total_value}, 计算值={calculated_sum}")
+                    
+                    phase_info.append((None, sheet_time, total_value))  # 不使用alias
+                except Exception as e:
+                    self.logger.warning(f"处理总预算时出错: {meeting_str}, 错误: {e}")
+                    continue
+        return phase_info
+
     def load_project_descriptions(self, budget_file):
-        if not os.path.exists(budget_file):
+        if not self._has_budget(budget_file):
             return {}
         try:
-            budget_df = pd.read_excel(budget_file)
-            time_col = budget_df.columns[0]
-            data_cols = budget_df.columns[1:-1]
-            project_cols = []
-            description_cols = []
-            for i in range(0, len(data_cols), 2):
-                if i < len(data_cols):
-                    project_cols.append(data_cols[i])
-                if i + 1 < len(data_cols):
-                    description_cols.append(data_cols[i + 1])
-            meetings = budget_df[time_col].dropna().tolist()
-            meeting_mapping = {}
-            meeting_aliases = ["初始", "第一次", "第二次", "第三次", "第四次", "第五次"]
-            for i, meeting in enumerate(meetings):
-                meeting_mapping[meeting] = meeting_aliases[i] if i < len(meeting_aliases) else f"第{i+1}次"
-            node_descriptions = {}
-            for meeting in meetings:
-                simplified_meeting = meeting_mapping[meeting]
-                for i, project_col in enumerate(project_cols):
-                    project_name = project_col
-                    description = ""
-                    if i < len(description_cols):
-                        desc_col = description_cols[i]
-                        desc_value = budget_df[budget_df[time_col] == meeting][desc_col].iloc[0]
-                        if pd.notnull(desc_value):
-                            description = str(desc_value)
-                    if description:
-                        meeting_time = meeting.split('(')[1].split(')')[0] if '(' in meeting else meeting
-                        node_name = f"{project_name}（{simplified_meeting}：{meeting_time}）"
-                        node_descriptions[node_name] = description
-            return node_descriptions
+            return self.node_descriptions(self.load_budget(budget_file))
         except Exception as e:
             self.logger.error("读取预算文件时出错: {}".format(e))
             return {}
 
     def load_node_amounts(self, budget_file):
         """从预算文件加载每个节点的金额"""
-        if not os.path.exists(budget_file):
+        if not self._has_budget(budget_file):
             return {}
         try:
-            budget_df = pd.read_excel(budget_file)
-            time_col = budget_df.columns[0]
-            project_cols = [budget_df.columns[i] for i in range(1, len(budget_df.columns) - 1, 2)]
-            meetings = budget_df[time_col].dropna().tolist()
-            meeting_mapping = {}
-            meeting_aliases = ["初始", "第一次", "第二次", "第三次", "第四次", "第五次"]
-            for i, meeting in enumerate(meetings):
-                meeting_mapping[meeting] = meeting_aliases[i] if i < len(meeting_aliases) else f"第{i+1}次"
-            node_amounts = {}
-            for meeting in meetings:
-                simplified_meeting = meeting_mapping[meeting]
-                for project_col in project_cols:
-                    project_name = project_col
-                    value = budget_df[budget_df[time_col] == meeting][project_col].iloc[0]
-                    amount = value if pd.notnull(value) else 0
-                    meeting_time = meeting.split('(')[1].split(')')[0] if '(' in meeting else meeting
-                    node_name = f"{project_name}（{simplified_meeting}：{meeting_time}）"
-                    node_amounts[node_name] = float(amount)
-            return node_amounts
+            return self.node_amounts(self.load_budget(budget_file))
         except Exception as e:
             self.logger.error("读取节点金额时出错: {}".format(e))
             return {}
 
     def compute_phase_totals(self, budget_file):
-        """按sheet读取"总预算"(最后一列)，返回 (别名, sheet时间, 总预算) 列表，用于标题下方展示
-        时间列格式：sheet_name_phase，显示为sheet的时间
-        总预算保留8位小数，并进行验证
-        """
-        if not os.path.exists(budget_file):
+        """按sheet读取"总预算"(最后一列)，见 phase_totals"""
+        if not self._has_budget(budget_file):
             return []
         try:
-            budget_df = pd.read_excel(budget_file)
-            time_col = budget_df.columns[0]
-            total_col = budget_df.columns[-1]  # 最后一列：总预算
-
-            meetings = budget_df[time_col].dropna().tolist()
-            phase_info = []  # [(alias, sheet_time, total), ...]
-
-            for i, meeting in enumerate(meetings):
-                meeting_str = str(meeting)
-                
-                # 提取sheet名称：时间列格式为 sheet_name_phase
-                # 例如：25年_25年预算 -> 只显示 25年（第一个下划线之前的部分）
-                if "_" in meeting_str:
-                    # 格式：sheet_name_phase，只取第一个下划线之前的部分（sheet名称）
-                    sheet_time = meeting_str.split("_", 1)[0]  # 只取第一个部分（sheet名称）
-                else:
-                    sheet_time = meeting_str
-                
-                row = budget_df[budget_df[time_col] == meeting]
-                v = row[total_col].iloc[0]
-                if pd.notnull(v):
-                    try:
-                        # 总预算保留8位小数（预算金额要严谨）
-                        total_value = round(float(v), 8)
-                        
-                        # 验证：从项目列计算总预算，验证是否一致
-                        project_cols = [col for col in budget_df.columns[1:-1] if not col.endswith('_说明')]
-                        calculated_sum = 0.0
-                        for col in project_cols:
-                            col_value = row[col].iloc[0]
-                            if pd.notnull(col_value):
-                                calculated_sum = round(calculated_sum + round(float(col_value), 8), 8)
-                        
-                        # 验证总预算（允许浮点数误差）
-                        if abs(calculated_sum - total_value) > 0.00000001:
-                            self.logger.warning(f"总预算验证不一致: 时间列={meeting_str}, 总预算列={total_value}, 计算值={calculated_sum}")
-                        
-                        phase_info.append((None, sheet_time, total_value))  # 不使用alias
-                    except Exception as e:
-                        self.logger.warning(f"处理总预算时出错: {meeting_str}, 错误: {e}")
-                        continue
-            return phase_info
+            return self.phase_totals(self.load_budget(budget_file))
         except Exception as e:
             self.logger.error("读取会议总预算(最后一列)时出错: {}".format(e))
             return []
@@ -377,76 +696,9 @@ class SankeyService:
         1) 若 echarts_html 是完整 HTML（包含 <html>），直接在 </body> 前注入弹窗与脚本；
         2) 若是片段，则用外层模板包裹。
         """
-        import json
         desc_json = json.dumps(node_descriptions, ensure_ascii=False)
 
-        inject_html = """
-    <div id="descriptionModal" class="modal">
-        <div class="modal-content">
-            <span class="close">&times;</span>
-            <div class="modal-title" id="modalTitle">项目描述</div>
-            <div class="modal-description" id="modalDescription"></div>
-        </div>
-    </div>
-    <style>
-        #descriptionModal { display:none; position:fixed; z-index:1000; left:0; top:0; width:100%; height:100%; background:rgba(0,0,0,0.5); }
-        .modal-content { background:#fff; margin:5% auto; padding:20px; border-radius:8px; width:80%; max-width:600px; box-shadow:0 4px 20px rgba(0,0,0,.3); position:relative; }
-        .close { color:#aaa; position:absolute; right:15px; top:10px; font-size:28px; font-weight:bold; cursor:pointer; }
-        .close:hover{ color:#000; }
-        .modal-title { font-size:18px; font-weight:bold; margin-bottom:12px; color:#333; border-bottom:2px solid #4CAF50; padding-bottom:8px; }
-        .modal-description { font-size:14px; line-height:1.6; color:#555; white-space:pre-line; }
-        .no-description { color:#999; font-style:italic; }
-    </style>
-    <script>
-        (function() {
-            const NODE_DESCRIPTIONS = {DESC_JSON};
-            function bind() {
-                if (!window.echarts) return false;
-                const all = document.querySelectorAll('div, canvas');
-                let chart = null;
-                for (const el of all) {
-                    if (!el.id) continue;
-                    try {
-                        const inst = echarts.getInstanceByDom(el);
-                        if (inst) { chart = inst; break; }
-                    } catch(e) {}
-                }
-                if (!chart) return false;
-
-                const modal = document.getElementById('descriptionModal');
-                const title = document.getElementById('modalTitle');
-                const body  = document.getElementById('modalDescription');
-                const closeBtn = document.querySelector('#descriptionModal .close');
-
-                function show(name) {
-                    const desc = NODE_DESCRIPTIONS[name];
-                    title.textContent = name || '未知节点';
-                    if (desc) { body.textContent = desc; body.className = 'modal-description'; }
-                    else { body.textContent = '暂无节点描述信息'; body.className = 'modal-description no-description'; }
-                    modal.style.display = 'block';
-                }
-                function hide() { modal.style.display = 'none'; }
-
-                closeBtn.onclick = hide;
-                window.addEventListener('click', (e) => { if (e.target === modal) hide(); });
-                window.addEventListener('keydown', (e) => { if (e.key === 'Escape') hide(); });
-
-                chart.off('click');
-                chart.on('click', function(params) {
-                    if (params && params.componentType === 'series' && params.dataType === 'node') {
-                        show((params.data && (params.data.name || params.name)) || params.name);
-                    }
-                });
-                return true;
-            }
-            let tries = 0;
-            const timer = setInterval(function() {
-                tries += 1;
-                if (bind() || tries >= 10) clearInterval(timer);
-            }, 300);
-        })();
-    </script>
-""".replace("{DESC_JSON}", desc_json)
+        inject_html = POPUP_INJECT_HTML.replace("{DESC_JSON}", desc_json)
 
         lower = echarts_html.lower()
         if "<html" in lower and "</body>" in lower:
@@ -548,10 +800,8 @@ class SankeyService:
         )
 
     def create_node_with_style(self, node_name, node_descriptions=None, project_colors=None):
-        import re
         node = {"name": node_name}
-        pattern = r'^资源池[一二三四五六七八九十①②③④⑤⑥⑦⑧⑨⑩\d]+$'
-        if bool(re.match(pattern, str(node_name))):
+        if RESOURCE_POOL_RE.match(str(node_name)):
             node["itemStyle"] = {"color": "#B0B0B0"}
         elif project_colors:
             # 处理带金额的节点名称：项目名（会议：时间） 金额：xxx
@@ -566,12 +816,14 @@ class SankeyService:
             node["description"] = node_descriptions[node_name]
         return node
 
-    def get_chart_title(self, budget_path):
-        if budget_path and os.path.exists(budget_path):
-            base_name = os.path.splitext(os.path.basename(budget_path))[0]
+    def get_chart_title(self, budget_path, source_name=None):
+        """source_name：内存数据没有文件名时，传入与文件名同格式的名称（不含扩展名）"""
+        if source_name is None and isinstance(budget_path, str) and os.path.exists(budget_path):
+            source_name = os.path.splitext(os.path.basename(budget_path))[0]
+        if source_name:
+            base_name = source_name
             # 简化文件名：去掉时间戳和ID部分
             # 格式：文件名-ou_xxx-时间戳_宽格式 -> 文件名
-            import re
             # 提取第一个"-"之前的部分，或者提取到第一个时间戳（8位数字）之前
             # 例如：Untitled bitable-ou_xxx-20251212_155226_宽格式 -> Untitled bitable
             parts = base_name.split('-')
@@ -583,7 +835,7 @@ class SankeyService:
                     simple_name = first_part
                 else:
                     # 否则尝试提取到时间戳之前
-                    match = re.match(r'^([^-]+(?:-[^-]+)?)', base_name)
+                    match = TITLE_PREFIX_RE.match(base_name)
                     if match:
                         simple_name = match.group(1)
                     else:
@@ -640,12 +892,15 @@ class SankeyService:
         # 留空：由上层服务决定是否通知
         pass
 
-    def generate_sankey_chart(self, edges_path, output_html_path, budget_path=None):
+    def generate_sankey_chart(self, edges_path, output_html_path, budget_path=None, source_name=None):
+        """edges_path 可以是边表文件路径或内存边表（build_edges 的返回值）
+        budget_path 可以是预算文件路径、宽格式 DataFrame 或 BudgetModel；source_name 用于内存数据的图表标题
+        output_html_path 以 .json 结尾时只写出 option 与节点描述的数据文档，否则写出完整 HTML
+        """
         try:
-            edges_df = pd.read_excel(edges_path)
+            edges_df = edges_path if isinstance(edges_path, pd.DataFrame) else pd.read_excel(edges_path)
             value_col = None
-            possible_value_cols = ['value', 'Value', 'VALUE', '数值', '金额', '数量', '流量']
-            for col in possible_value_cols:
+            for col in VALUE_COLUMNS:
                 if col in edges_df.columns:
                     value_col = col
                     break
@@ -659,10 +914,16 @@ class SankeyService:
             node_descriptions = {}
             node_amounts = {}
             phase_totals = []  # 会议总预算列表
-            if budget_path and os.path.exists(budget_path):
-                node_descriptions = self.load_project_descriptions(budget_path)
-                node_amounts = self.load_node_amounts(budget_path)
-                phase_totals = self.compute_phase_totals(budget_path)  # 加载会议总预算
+            budget_model = None
+            if self._has_budget(budget_path):
+                try:
+                    budget_model = self.load_budget(budget_path)
+                except Exception as e:
+                    self.logger.error("读取预算文件时出错: {}".format(e))
+            if budget_model is not None:
+                node_descriptions = self.load_project_descriptions(budget_model)
+                node_amounts = self.load_node_amounts(budget_model)
+                phase_totals = self.compute_phase_totals(budget_model)  # 加载会议总预算
             
             # 创建节点名称到带金额的节点名称的映射
             node_name_mapping = {}
@@ -689,16 +950,7 @@ class SankeyService:
                             phase_alias = meeting_part.split('：')[0]  # 提取"第一次"
                         else:
                             phase_alias = meeting_part
-                        # 阶段别名到数字符号的映射（从①开始）
-                        phase_symbol_map = {
-                            "初始": "①",
-                            "第一次": "②",
-                            "第二次": "③",
-                            "第三次": "④",
-                            "第四次": "⑤",
-                            "第五次": "⑥"
-                        }
-                        symbol = phase_symbol_map.get(phase_alias, "①")  # 默认用①
+                        symbol = PHASE_SYMBOLS.get(phase_alias, "①")  # 默认用①
                         # 显示名称格式：符号项目名：金额数字（去掉"金额："文字）
                         display_name = f"{symbol}{project}：{amount_str}"
                     else:
@@ -729,21 +981,12 @@ class SankeyService:
             project_order = []
             meeting_order = []
             meeting_alias_map = {}
-            if budget_path and os.path.exists(budget_path):
-                try:
-                    budget_df = pd.read_excel(budget_path)
-                    time_col = budget_df.columns[0]
-                    # 项目列是索引 1, 3, 5...（与 load_node_amounts 保持一致）
-                    project_order = [budget_df.columns[i] for i in range(1, len(budget_df.columns) - 1, 2)]
-                    # 获取会议顺序
-                    meeting_order = budget_df[time_col].dropna().tolist()
-                    # 创建会议别名映射
-                    meeting_aliases = ["初始", "第一次", "第二次", "第三次", "第四次", "第五次"]
-                    for i, meeting in enumerate(meeting_order):
-                        meeting_alias_map[meeting] = meeting_aliases[i] if i < len(meeting_aliases) else f"第{i+1}次"
-                    self.logger.info(f"节点排序：项目顺序={project_order}, 会议顺序={meeting_order}")
-                except Exception as e:
-                    self.logger.warning("读取表格顺序失败: {}".format(e))
+            if budget_model is not None:
+                # 项目列是索引 1, 3, 5...（与 load_node_amounts 保持一致）
+                project_order = list(budget_model.project_cols)
+                meeting_order = list(budget_model.meetings)
+                meeting_alias_map = dict(budget_model.aliases)
+                self.logger.info(f"节点排序：项目顺序={project_order}, 会议顺序={meeting_order}")
             
             # 自定义排序函数：按照表格顺序排序
             def sort_nodes_by_table_order(node_name):
@@ -820,49 +1063,18 @@ class SankeyService:
                     if display_name:
                         display_name_to_description[display_name] = description
 
-            c = (
-                Sankey(init_opts=opts.InitOpts(width="100%", height="100vh", page_title="动态桑基图"))
-                .add(
-                    "预算流向分析",
-                    nodes=nodes,
-                    links=links,
-                    orient="horizontal",
-                    node_align="justify",
-                    node_gap=15,
-                    node_width=15,
-                    layout_iterations=0,  # 禁用自动布局优化，让节点按照links数组的顺序排列
-                    pos_top="8%",  # 为标题和副标题留出空间
-                    linestyle_opt=opts.LineStyleOpts(opacity=0.6, curve=0.5, color="source"),
-                    label_opts=opts.LabelOpts(position="right", formatter="{b}", font_size=9),
-                    itemstyle_opts=opts.ItemStyleOpts(border_width=1, border_color="#ccc", opacity=0.9)
-                )
-                .set_global_opts(
-                    title_opts=opts.TitleOpts(
-                        title=self.get_chart_title(budget_path), 
-                        pos_left="center", 
-                        title_textstyle_opts=opts.TextStyleOpts(font_size=18),
-                        subtitle=self._format_phase_totals_subtitle(phase_totals) if phase_totals else "",
-                        subtitle_textstyle_opts=opts.TextStyleOpts(
-                            font_size=self._calculate_subtitle_font_size(phase_totals)
-                        )
-                    ),
-                    tooltip_opts=opts.TooltipOpts(trigger="item", trigger_on="mousemove", formatter="{b}"),
-                    legend_opts=opts.LegendOpts(is_show=False)
-                )
+            # 页面模板每个进程只编译一次；option 直接由节点与连线生成，完整 HTML（含弹窗）一次写出
+            page = get_page_template()
+            option = page.options(
+                nodes, links,
+                title=self.get_chart_title(budget_path, source_name),
+                subtitle=self._format_phase_totals_subtitle(phase_totals) if phase_totals else "",
+                subtitle_font_size=self._calculate_subtitle_font_size(phase_totals),
             )
-            # 统一生成"完整 HTML 页面"，避免片段/完整混用导致的嵌套问题
-            c.render(output_html_path)
-            # 如存在节点描述，则在完整 HTML 中注入弹窗 DOM 与脚本
-            if display_name_to_description:
-                try:
-                    with open(output_html_path, 'r', encoding='utf-8') as f:
-                        generated_html = f.read()
-                    full_html = self.create_html_with_popup(generated_html, display_name_to_description)
-                    with open(output_html_path, 'w', encoding='utf-8') as f:
-                        f.write(full_html)
-                except Exception as inject_err:
-                    self.logger.error("在完整HTML中注入弹窗失败: {}".format(inject_err))
-                    return False
+            if str(output_html_path).endswith(".json"):
+                page.write_data(output_html_path, option, display_name_to_description)
+            else:
+                page.write(output_html_path, option, display_name_to_description)
             self.logger.info("桑基图已生成: {}".format(output_html_path))
             return True
         except Exception as e:
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本机 SQLite 存储的公共部分
+需要在同机所有 gunicorn worker 之间共享状态的存储都基于一个本机 SQLite 文件：
+每个线程一个连接，autocommit 模式，写事务用 BEGIN IMMEDIATE 串行化。
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Tuple
+
+
+class SQLiteStore:
+    """每线程一个连接的 SQLite 文件（WAL 日志：读写互不阻塞；WAL 依赖共享内存，只适用于本机文件系统）"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务：正常结束时提交，出现异常时回滚"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def evict_lru(conn: sqlite3.Connection, table: str, key_column: str,
+              max_entries: int, max_bytes: int) -> List[Tuple[Any, str]]:
+    """在当前写事务中按 last_used_at 淘汰超过条目数/总大小上限（0 表示不限）的条目
+    表需有 filename / size / last_used_at 列；返回被删除条目的 (键, 文件名)，由调用方删除文件
+    """
+    count, total = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {table}").fetchone()
+    victims: List[Tuple[Any, str]] = []
+    if not ((max_entries and count > max_entries) or (max_bytes and total > max_bytes)):
+        return victims
+    for key, filename, size in conn.execute(
+        f"SELECT {key_column}, filename, size FROM {table} ORDER BY last_used_at"
+    ).fetchall():
+        if not ((max_entries and count > max_entries) or (max_bytes and total > max_bytes)):
+            break
+        victims.append((key, filename))
+        count -= 1
+        total -= size
+    conn.executemany(f"DELETE FROM {table} WHERE {key_column} = ?", [(k,) for k, _ in victims])
+    return victims
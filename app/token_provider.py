@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tenant_access_token 提供者
+- 进程内缓存 + 本机共享缓存文件：同一台机器上的所有 gunicorn worker 共用一个 token
+- single-flight：进程内用线程锁、进程间用文件锁，同一时刻只有一个调用方请求鉴权接口，其余等待并复用结果
+- 后台线程在过期前主动刷新，请求路径上基本不会遇到过期
+"""
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class TenantTokenProvider:
+    def __init__(self, open_base: str, app_id: str, app_secret: str, cache_path: str,
+                 refresh_margin: int = 300, min_valid: int = 60,
+                 session: Optional[requests.Session] = None):
+        """
+        Args:
+            cache_path: 共享缓存文件路径（同机所有 worker 使用同一路径）
+            refresh_margin: 剩余有效期低于该值（秒）时后台刷新
+            min_valid: 剩余有效期低于该值（秒）时视为不可用，调用方同步等待刷新
+            session: 共享 HTTP 会话（为空时新建一个）
+        """
+        self.open_base = open_base
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.cache_path = cache_path
+        self.lock_path = cache_path + ".lock"
+        self.refresh_margin = refresh_margin
+        self.min_valid = min_valid
+        self.session = session or requests.Session()
+        self._token: Optional[str] = None
+        self._expire_at = 0.0
+        self._lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+        self._refresher_pid: Optional[int] = None
+
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # ---------- public ----------
+    def get_token(self) -> str:
+        self._ensure_refresher()
+        if self._token and self._expire_at - time.time() > self.min_valid:
+            return self._token
+        return self._refresh(margin=self.min_valid)
+
+    def invalidate(self, token: Optional[str] = None) -> None:
+        """鉴权失败（如 token 被吊销）时调用，下次 get_token 强制重新获取
+        指定 token 时只清除仍等于它的缓存：其他线程/进程可能已经换上了新 token
+        """
+        with self._lock:
+            if token is None or self._token == token:
+                self._token = None
+                self._expire_at = 0.0
+            with self._file_lock():
+                shared_token, _ = self._read_shared()
+                if token is None or shared_token == token:
+                    self._write_shared(None, 0.0)
+
+    def renew(self, rejected_token: str) -> str:
+        """OpenAPI 拒绝 rejected_token（无效/过期）时调用：作废后返回新 token，调用方用新 token 重发一次请求"""
+        self.invalidate(rejected_token)
+        return self.get_token()
+
+    # ---------- refresh ----------
+    def _refresh(self, margin: float) -> str:
+        """剩余有效期不足 margin 时刷新；已被其他线程/进程刷新则直接复用"""
+        with self._lock:
+            if self._token and self._expire_at - time.time() > margin:
+                return self._token
+            with self._file_lock():
+                token, expire_at = self._read_shared()
+                if not token or expire_at - time.time() <= margin:
+                    token, expire_at = self._fetch()
+                    self._write_shared(token, expire_at)
+                self._token, self._expire_at = token, expire_at
+            return token
+
+    def _fetch(self) -> tuple:
+        url = f"{self.open_base}/open-apis/auth/v3/tenant_access_token/internal"
+        resp = self.session.post(url, json={"app_id": self.app_id, "app_secret": self.app_secret}, timeout=5)
+        data = resp.json()
+        if data.get("code") != 0:
+            raise RuntimeError(f"get_tenant_access_token failed: {data}")
+        return data["tenant_access_token"], time.time() + float(data.get("expire", 7000))
+
+    def _ensure_refresher(self) -> None:
+        # 按 pid 判断：fork 出来的子进程需要重新启动自己的刷新线程
+        if self._refresher is not None and self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher is not None and self._refresher_pid == os.getpid():
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="tenant-token-refresher", daemon=True)
+            self._refresher_pid = os.getpid()
+            self._refresher.start()
+
+    def _refresh_loop(self) -> None:
+        while True:
+            remaining = self._expire_at - time.time()
+            sleep_for = remaining - self.refresh_margin if self._token else 0
+            if sleep_for > 0:
+                time.sleep(min(sleep_for, 60))
+                continue
+            try:
+                self._refresh(margin=self.refresh_margin)
+            except Exception as e:
+                logger.warning(f"[token] 后台刷新 tenant_access_token 失败: {e}")
+                time.sleep(10)
+
+    # ---------- shared cache file ----------
+    def _file_lock(self):
+        return _FileLock(self.lock_path)
+
+    def _read_shared(self) -> tuple:
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("app_id") != self.app_id:
+                return None, 0.0
+            return data.get("token"), float(data.get("expire_at", 0.0))
+        except (OSError, ValueError):
+            return None, 0.0
+
+    def _write_shared(self, token: Optional[str], expire_at: float) -> None:
+        # 先写临时文件再原子替换，避免其他进程读到半截内容
+        cache_dir = os.path.dirname(self.cache_path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tenant_token.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"app_id": self.app_id, "token": token, "expire_at": expire_at}, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class _FileLock:
+    """基于 fcntl.flock 的进程间互斥锁"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        return False
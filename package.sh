@@ -9,6 +9,18 @@ echo "=== 开始打包 feishu-bitable-receiver ==="
 # 删除旧压缩包
 [ -f feishu-bitable-receiver.tar.gz ] && rm feishu-bitable-receiver.tar.gz
 
+# 下载桑基图页面使用的固定版本 ECharts 一并打包（与 .env 中的 ECHARTS_VERSION 一致），服务器上不依赖外网 CDN
+ECHARTS_VERSION="${ECHARTS_VERSION:-6.0.0}"
+ECHARTS_FILE="feishu-bitable-receiver/app/static/echarts.min.js"
+echo "下载 echarts@$ECHARTS_VERSION ..."
+mkdir -p "$(dirname "$ECHARTS_FILE")"
+if ! curl -fsSL -o "$ECHARTS_FILE.part" "https://cdn.jsdelivr.net/npm/echarts@$ECHARTS_VERSION/dist/echarts.min.js"; then
+    rm -f "$ECHARTS_FILE.part"
+    echo "❌ 下载 ECharts 失败"
+    exit 1
+fi
+mv "$ECHARTS_FILE.part" "$ECHARTS_FILE"
+
 # 打包（排除不必要的文件）
 tar czf feishu-bitable-receiver.tar.gz \
   --exclude='.venv' \
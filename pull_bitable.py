@@ -14,11 +14,16 @@ You can also override via CLI args:
 """
 
 import argparse
+import itertools
 import json
 import os
+import queue
 import sys
+import threading
 import time
-from typing import Any, Dict, List, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
@@ -37,25 +42,54 @@ DEFAULT_VIEW_ID = "vew2BpQrSd"  # optional; can be empty
 # Save to user's Desktop by default
 DEFAULT_OUTFILE = os.path.join(os.getenv("OUTPUT_DIR", os.path.join(os.path.expanduser("~"), "Desktop")), f"bitable_{DEFAULT_TABLE_ID}.json")
 
+# HTTP 会话：默认使用一个 keep-alive Session；服务端通过 set_http_session 注入带连接池与重试的共享会话
+_http = requests.Session()
+
+
+def set_http_session(session: requests.Session) -> None:
+    """注入共享 HTTP 会话（所有 OpenAPI 调用都经由它发出）"""
+    global _http
+    _http = session
+
+
+# 元数据缓存：默认不缓存；服务端通过 set_metadata_cache 注入（见 app/metadata_cache.py）
+_metadata_cache: Any = None
+
+
+def set_metadata_cache(cache: Any) -> None:
+    """注入元数据缓存（提供 get_or_load / invalidate），缓存字段定义、视图列布局与 table 列表"""
+    global _metadata_cache
+    _metadata_cache = cache
+
+
+def _cached(kind: str, app_token: str, loader: Callable[[], Any], table_id: str = "", view_id: str = "") -> Any:
+    if _metadata_cache is None:
+        return loader()
+    return _metadata_cache.get_or_load(kind, app_token, loader, table_id=table_id, view_id=view_id)
+
 
 def get_tenant_access_token(open_base: str, app_id: str, app_secret: str) -> str:
     url = f"{open_base}/open-apis/auth/v3/tenant_access_token/internal"
-    resp = requests.post(url, json={"app_id": app_id, "app_secret": app_secret}, timeout=10)
+    resp = _http.post(url, json={"app_id": app_id, "app_secret": app_secret}, timeout=10)
     data = resp.json()
     if data.get("code") != 0:
         raise RuntimeError(f"get_tenant_access_token failed: {data}")
     return data["tenant_access_token"]
 
 
-def list_bitable_records(
+def iter_bitable_record_pages(
     open_base: str,
     app_token: str,
     table_id: str,
     tenant_token: str,
     view_id: Optional[str] = None,
     page_size: int = 500,
-) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
+    field_names: Optional[List[str]] = None,
+    filter_formula: Optional[str] = None,
+) -> Iterator[List[Dict[str, Any]]]:
+    """Yield records page by page as they arrive (one list per API page).
+    field_names: 只返回这些字段（服务端投影）；filter_formula: 服务端筛选公式，如 CurrentValue.[费用]>0
+    """
     page_token: Optional[str] = None
     headers = {"Authorization": f"Bearer {tenant_token}"}
 
@@ -66,18 +100,368 @@ def list_bitable_records(
             params["page_token"] = page_token
         if view_id:
             params["view_id"] = view_id
+        if field_names is not None:
+            params["field_names"] = json.dumps(field_names, ensure_ascii=False)
+        if filter_formula:
+            params["filter"] = filter_formula
 
-        r = requests.get(url, headers=headers, params=params, timeout=15)
+        r = _http.get(url, headers=headers, params=params, timeout=15)
         data = r.json()
         if data.get("code") != 0:
             raise RuntimeError(f"list_records failed: {data}")
-        items.extend(data["data"].get("items", []))
+        yield data["data"].get("items", []) or []
         if not data["data"].get("has_more"):
             break
         page_token = data["data"].get("page_token")
+
+
+def list_bitable_records(
+    open_base: str,
+    app_token: str,
+    table_id: str,
+    tenant_token: str,
+    view_id: Optional[str] = None,
+    page_size: int = 500,
+    field_names: Optional[List[str]] = None,
+    filter_formula: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    items: List[Dict[str, Any]] = []
+    for page in iter_bitable_record_pages(open_base, app_token, table_id, tenant_token, view_id, page_size,
+                                          field_names, filter_formula):
+        items.extend(page)
     return items
 
 
+# ===== Incremental sync (local snapshot + delta fetch) =====
+# 字段类型：最后更新时间
+FIELD_TYPE_MODIFIED_TIME = 1002
+# 取值会随其他记录/表变化、但不更新本记录修改时间的字段类型（单向关联、查找引用、公式、双向关联）：
+# 含这些字段的表无法可靠增量同步，始终全量拉取
+VOLATILE_FIELD_TYPES = frozenset({18, 19, 20, 21})
+# 日期筛选按天比较，增量起点向前多取一天，避免漏掉同一天内的修改
+_DELTA_LOOKBACK_MS = 24 * 3600 * 1000
+
+
+def search_bitable_records(
+    open_base: str,
+    app_token: str,
+    table_id: str,
+    tenant_token: str,
+    view_id: Optional[str] = None,
+    field_names: Optional[List[str]] = None,
+    filter_: Optional[Dict[str, Any]] = None,
+    page_size: int = 500,
+    max_pages: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """records/search 分页查询，返回 (记录, 符合条件的总数)。
+    field_names 只返回指定字段（用于只取 record_id 与修改时间的轻量扫描）。
+    """
+    headers = {"Authorization": f"Bearer {tenant_token}"}
+    url = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/records/search"
+    body: Dict[str, Any] = {}
+    if view_id:
+        body["view_id"] = view_id
+    if field_names is not None:
+        body["field_names"] = field_names
+    if filter_:
+        body["filter"] = filter_
+    items: List[Dict[str, Any]] = []
+    total = 0
+    page_token: Optional[str] = None
+    pages = 0
+    while True:
+        params: Dict[str, Any] = {"page_size": page_size}
+        if page_token:
+            params["page_token"] = page_token
+        r = _http.post(url, headers=headers, params=params, json=body, timeout=15).json()
+        if r.get("code") != 0:
+            raise RuntimeError(f"search_records failed: {r}")
+        data = r.get("data") or {}
+        items += data.get("items", []) or []
+        total = data.get("total", len(items))
+        pages += 1
+        if not data.get("has_more") or (max_pages is not None and pages >= max_pages):
+            break
+        page_token = data.get("page_token")
+    return items, total
+
+
+def get_bitable_record(
+    open_base: str,
+    app_token: str,
+    table_id: str,
+    tenant_token: str,
+    record_id: str,
+) -> Dict[str, Any]:
+    """读取单条记录（返回结构与 list_bitable_records 中的记录一致）"""
+    headers = {"Authorization": f"Bearer {tenant_token}"}
+    url = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/records/{record_id}"
+    r = _http.get(url, headers=headers, timeout=15).json()
+    if r.get("code") != 0:
+        raise RuntimeError(f"get_record failed: {r}")
+    return r["data"]["record"]
+
+
+def sync_bitable_records(
+    open_base: str,
+    app_token: str,
+    table_id: str,
+    tenant_token: str,
+    view_id: Optional[str],
+    fields: List[Dict[str, Any]],
+    snapshot_store: Any,
+    min_records: int = 500,
+    max_fetch: int = 50,
+    field_names: Optional[List[str]] = None,
+) -> List[Dict[str, Any]]:
+    """基于本地快照增量同步，返回与 list_bitable_records 相同的记录列表（视图顺序）。
+
+    1. 表中没有"最后更新时间"字段，或含公式/查找引用/关联字段：直接全量拉取
+    2. 无快照、字段结构变化、快照记录数少于 min_records（全量只需一两页）：全量拉取并写入快照
+    3. 否则用 records/search 按修改时间筛选出上次同步后修改过的记录，再用一次 page_size=1 的查询
+       取当前记录总数；无修改且总数与快照一致时直接返回快照
+    4. 有变化时做一次只取修改时间字段的 ID 扫描，得到当前顺序、删除的记录和新增/修改的记录；
+       新增/修改的记录逐条读取（超过 max_fetch 条时改为全量拉取），合并进快照
+
+    snapshot_store: 提供 load / replace / merge / mark_unchanged 的快照存储（见 app/bitable_snapshot.py）
+    field_names: 只同步这些字段（投影变化时视为字段结构变化，重新全量拉取）
+    """
+    modified_field = next(
+        (f.get("field_name") for f in fields if f.get("type") == FIELD_TYPE_MODIFIED_TIME), None
+    )
+    if modified_field is None or any(f.get("type") in VOLATILE_FIELD_TYPES for f in fields):
+        return list_bitable_records(open_base, app_token, table_id, tenant_token, view_id=view_id,
+                                    field_names=field_names)
+
+    table_key = f"{app_token}/{table_id}/{view_id or ''}"
+    schema = json.dumps([[[f.get("field_id"), f.get("field_name"), f.get("type")] for f in fields], field_names],
+                        ensure_ascii=False)
+    # 快照中的记录也带上修改时间字段，用于与增量扫描结果比较
+    list_names = None if field_names is None else list(dict.fromkeys(field_names + [modified_field]))
+
+    def modified_of(item: Dict[str, Any]) -> Any:
+        return (item.get("fields") or {}).get(modified_field)
+
+    def project(item: Dict[str, Any]) -> Dict[str, Any]:
+        # 单条读取接口不支持字段投影：只保留需要的字段，与列表接口返回的结构一致
+        if list_names is None:
+            return item
+        values = item.get("fields") or {}
+        return dict(item, fields={k: values[k] for k in list_names if k in values})
+
+    def full_sync() -> List[Dict[str, Any]]:
+        items = list_bitable_records(open_base, app_token, table_id, tenant_token, view_id=view_id,
+                                     field_names=list_names)
+        snapshot_store.replace(table_key, schema, [(it["record_id"], modified_of(it), it) for it in items])
+        return items
+
+    snapshot = snapshot_store.load(table_key)
+    if snapshot is None or snapshot["schema"] != schema or len(snapshot["order"]) < min_records:
+        return full_sync()
+    known = snapshot["records"]
+
+    # 上次同步后修改过的记录（只取修改时间字段）
+    since = int(snapshot["max_modified"] or 0) - _DELTA_LOOKBACK_MS
+    delta_filter = {
+        "conjunction": "and",
+        "conditions": [{
+            "field_name": modified_field,
+            "operator": "isGreater",
+            "value": ["ExactDate", str(max(since, 0))],
+        }],
+    }
+    delta, _ = search_bitable_records(open_base, app_token, table_id, tenant_token, view_id,
+                                      field_names=[modified_field], filter_=delta_filter)
+    changed = [it["record_id"] for it in delta
+               if it["record_id"] not in known or known[it["record_id"]][0] != modified_of(it)]
+    _, total = search_bitable_records(open_base, app_token, table_id, tenant_token, view_id,
+                                      field_names=[modified_field], page_size=1, max_pages=1)
+    if not changed and total == len(known):
+        snapshot_store.mark_unchanged(table_key)
+        return [known[record_id][1] for record_id in snapshot["order"]]
+
+    # 有变化：ID 扫描取当前顺序，找出删除的记录与所有新增/修改的记录
+    current, _ = search_bitable_records(open_base, app_token, table_id, tenant_token, view_id,
+                                        field_names=[modified_field])
+    order = [it["record_id"] for it in current]
+    current_modified = {it["record_id"]: modified_of(it) for it in current}
+    to_fetch = [record_id for record_id in order
+                if record_id not in known or known[record_id][0] != current_modified[record_id]]
+    if len(to_fetch) > max_fetch:
+        return full_sync()
+    fetched = {
+        record_id: project(get_bitable_record(open_base, app_token, table_id, tenant_token, record_id))
+        for record_id in to_fetch
+    }
+    deleted = [record_id for record_id in known if record_id not in current_modified]
+    snapshot_store.merge(
+        table_key,
+        [(record_id, modified_of(item), item) for record_id, item in fetched.items()],
+        deleted,
+        order,
+    )
+    return [fetched[record_id] if record_id in fetched else known[record_id][1] for record_id in order]
+
+
+def prefetch_pages(pages: Iterable[List[Dict[str, Any]]], depth: int = 2) -> Iterator[List[Dict[str, Any]]]:
+    """在后台线程中提前拉取后续页面（最多缓冲 depth 页），使网络请求与写入重叠。
+    生产者抛出的异常会在消费端原样抛出。
+    """
+    buf: "queue.Queue" = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(done)
+        except BaseException as e:  # 交给消费端抛出
+            put(e)
+
+    t = threading.Thread(target=produce, name="bitable-prefetch", daemon=True)
+    t.start()
+    try:
+        while True:
+            page = buf.get()
+            if page is done:
+                return
+            if isinstance(page, BaseException):
+                raise page
+            yield page
+    finally:
+        # 消费端提前退出（如写入失败）时通知生产者停止
+        stop.set()
+
+
+# ===== Cell normalization (field-type driven) =====
+# 复用同一个编码器：json.dumps 带参数调用时每次都会新建 JSONEncoder
+_encode_json = json.JSONEncoder(ensure_ascii=False).encode
+_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+
+def _flatten_cell(v: Any) -> Any:
+    """list 以分号拼接（dict 元素转紧凑 JSON），dict 转 JSON，其余原样返回"""
+    if isinstance(v, (list, dict)):
+        return (
+            "; ".join([_encode_json(x) if isinstance(x, dict) else str(x) for x in v])
+            if isinstance(v, list)
+            else _encode_json(v)
+        )
+    return v
+
+
+# 以下按字段类型特化的转换函数与 _flatten_cell 结果完全一致：先按该类型的常见取值走快速路径，
+# 取值形态不符时（如文本字段返回纯字符串）回退到 _flatten_cell
+def _scalar_cell(v: Any) -> Any:
+    """数字、单选、日期、复选框、电话、自动编号等：原样返回"""
+    return v if type(v) in _SCALAR_TYPES else _flatten_cell(v)
+
+
+def _str_list_cell(v: Any) -> Any:
+    """多选：字符串列表直接以分号拼接"""
+    if type(v) is list:
+        try:
+            return "; ".join(v)
+        except TypeError:
+            pass
+    return _flatten_cell(v)
+
+
+def _object_list_cell(v: Any) -> Any:
+    """多行文本片段、人员、附件、群组等：对象列表逐个转 JSON 后以分号拼接"""
+    if type(v) is list:
+        return "; ".join([_encode_json(x) if type(x) is dict else str(x) for x in v])
+    return _flatten_cell(v)
+
+
+def _object_cell(v: Any) -> Any:
+    """超链接、地理位置等：对象转 JSON"""
+    return _encode_json(v) if type(v) is dict else _flatten_cell(v)
+
+
+# 字段类型 -> 单元格转换函数；未列出的类型（公式、查找引用、关联等取值形态不固定）使用 _flatten_cell
+FIELD_CELL_CONVERTERS: Dict[int, Callable[[Any], Any]] = {
+    1: _object_list_cell,     # 多行文本（富文本片段列表）
+    2: _scalar_cell,          # 数字
+    3: _scalar_cell,          # 单选
+    4: _str_list_cell,        # 多选
+    5: _scalar_cell,          # 日期
+    7: _scalar_cell,          # 复选框
+    11: _object_list_cell,    # 人员
+    13: _scalar_cell,         # 电话号码
+    15: _object_cell,         # 超链接
+    17: _object_list_cell,    # 附件
+    22: _object_cell,         # 地理位置
+    23: _object_list_cell,    # 群组
+    1001: _scalar_cell,       # 创建时间
+    1002: _scalar_cell,       # 最后更新时间
+    1003: _object_list_cell,  # 创建人
+    1004: _object_list_cell,  # 修改人
+    1005: _scalar_cell,       # 自动编号
+}
+
+
+def compile_page_converter(
+    ordered_field_names: List[str], fields: Optional[List[Dict[str, Any]]] = None
+) -> Callable[[List[Dict[str, Any]]], List[List[Any]]]:
+    """按字段类型为每一列选定转换函数（每个表只构建一次），返回 page -> 按列转换后的单元格列表。
+    返回值为列的列表（与 ordered_field_names 一一对应）；fields 为空时所有列使用 _flatten_cell。
+    """
+    types = {f.get("field_name"): f.get("type") for f in fields or []}
+    converters = [FIELD_CELL_CONVERTERS.get(types.get(name), _flatten_cell) for name in ordered_field_names]
+
+    def convert(page: List[Dict[str, Any]]) -> List[List[Any]]:
+        records = [it.get("fields", {}) or {} for it in page]
+        return [
+            list(map(conv, [r.get(name) for r in records]))
+            for name, conv in zip(ordered_field_names, converters)
+        ]
+
+    return convert
+
+
+def _rows(columns: List[List[Any]], n: int) -> List[Any]:
+    """列转行（没有任何列时仍返回 n 个空行）"""
+    return list(zip(*columns)) if columns else [()] * n
+
+
+def write_pages_to_xlsx(
+    sheets: Iterable[Tuple[str, List[str], Iterable[List[Dict[str, Any]]], Optional[List[Dict[str, Any]]]]],
+    outfile_xlsx: str,
+) -> int:
+    """流式写 Excel：每个 sheet 为 (标题, 字段顺序, 记录分页迭代器, 字段定义)。
+    使用 openpyxl 只写模式逐行落盘，并在写当前页时预取下一页，
+    峰值内存取决于分页大小而非表大小。返回写入的记录总数。
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    total = 0
+    for title, ordered_field_names, pages, fields in sheets:
+        ws = wb.create_sheet(title=title)
+        ws.append(ordered_field_names)
+        convert = compile_page_converter(ordered_field_names, fields)
+        for page in prefetch_pages(pages):
+            for row in _rows(convert(page), len(page)):
+                ws.append(row)
+            total += len(page)
+
+    os.makedirs(os.path.dirname(outfile_xlsx), exist_ok=True)
+    wb.save(outfile_xlsx)
+    return total
+
+
 def save_json(items: List[Dict[str, Any]], outfile: str) -> str:
     os.makedirs(os.path.dirname(outfile), exist_ok=True)
     with open(outfile, "w", encoding="utf-8") as f:
@@ -86,18 +470,19 @@ def save_json(items: List[Dict[str, Any]], outfile: str) -> str:
 
 
 # ===== Strict view order helpers =====
-def list_fields(
+def list_table_fields(
     open_base: str,
     app_token: str,
     table_id: str,
     tenant_token: str,
-    view_id: Optional[str],
-) -> List[str]:
-    """Return ordered field names according to view's visible order.
-    Fallback to table field order if view layout API not available.
-    """
+) -> List[Dict[str, Any]]:
+    """Return raw field definitions (field_id / field_name / type ...) in table order."""
+    return _cached("fields", app_token, lambda: _fetch_table_fields(open_base, app_token, table_id, tenant_token),
+                   table_id=table_id)
+
+
+def _fetch_table_fields(open_base: str, app_token: str, table_id: str, tenant_token: str) -> List[Dict[str, Any]]:
     headers = {"Authorization": f"Bearer {tenant_token}"}
-    # 1) table fields
     url_fields = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/fields"
     fields: List[Dict[str, Any]] = []
     page_token: Optional[str] = None
@@ -105,66 +490,90 @@ def list_fields(
         params = {"page_size": 500}
         if page_token:
             params["page_token"] = page_token
-        r = requests.get(url_fields, headers=headers, params=params, timeout=10).json()
+        r = _http.get(url_fields, headers=headers, params=params, timeout=10).json()
         if r.get("code") != 0:
             raise RuntimeError(f"list_fields failed: {r}")
         fields += r["data"].get("items", [])
         if not r["data"].get("has_more"):
             break
         page_token = r["data"].get("page_token")
+    return fields
+
+
+def list_fields(
+    open_base: str,
+    app_token: str,
+    table_id: str,
+    tenant_token: str,
+    view_id: Optional[str],
+    fields: Optional[List[Dict[str, Any]]] = None,
+) -> List[str]:
+    """Return ordered field names according to view's visible order.
+    Fallback to table field order if view layout API not available.
+    fields: 已通过 list_table_fields 取得的字段定义（为空时在此拉取）
+    """
+    # 1) table fields
+    if fields is None:
+        fields = list_table_fields(open_base, app_token, table_id, tenant_token)
 
     field_id_order = [f["field_id"] for f in fields]
     id_to_name = {f["field_id"]: f["field_name"] for f in fields}
 
     # 2) try view columns order (best effort, not all envs support)
-    try:
-        if view_id:
-            url_view = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/views/{view_id}"
-            rv = requests.get(url_view, headers=headers, timeout=10).json()
-            data = rv.get("data", {})
-            view = data.get("view", data)
-            cols = view.get("columns")
-            if isinstance(cols, list) and cols:
-                vis = [c.get("field_id") for c in cols if c.get("is_visible", True)]
-                rest = [fid for fid in field_id_order if fid not in vis]
-                field_id_order = vis + rest
-    except Exception:
-        pass
+    if view_id:
+        vis = _cached("view_columns", app_token,
+                      lambda: _fetch_view_columns(open_base, app_token, table_id, tenant_token, view_id),
+                      table_id=table_id, view_id=view_id)
+        if vis:
+            rest = [fid for fid in field_id_order if fid not in vis]
+            field_id_order = vis + rest
 
     ordered_names = [id_to_name[fid] for fid in field_id_order if fid in id_to_name]
     return ordered_names
 
 
+def _fetch_view_columns(
+    open_base: str, app_token: str, table_id: str, tenant_token: str, view_id: str
+) -> Optional[List[str]]:
+    """视图中可见列的 field_id（按视图顺序）；视图不返回列布局时为空列表，请求失败时为 None"""
+    headers = {"Authorization": f"Bearer {tenant_token}"}
+    url_view = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/views/{view_id}"
+    try:
+        rv = _http.get(url_view, headers=headers, timeout=10).json()
+        if rv.get("code") != 0:
+            return None
+        data = rv.get("data", {})
+        view = data.get("view", data)
+        cols = view.get("columns")
+        if not isinstance(cols, list):
+            return []
+        return [c.get("field_id") for c in cols if c.get("is_visible", True)]
+    except Exception:
+        return None
+
+
 def save_csv_with_order(
-    items: List[Dict[str, Any]], ordered_field_names: List[str], outfile_csv: str
+    items: List[Dict[str, Any]], ordered_field_names: List[str], outfile_csv: str,
+    fields: Optional[List[Dict[str, Any]]] = None,
 ) -> str:
+    """fields: 字段定义（list_table_fields），用于按字段类型选择单元格转换函数"""
     import csv
 
-    rows = [it.get("fields", {}) or {} for it in items]
+    # Join lists by semicolon for readability; dict as compact JSON
+    columns = compile_page_converter(ordered_field_names, fields)(items)
     os.makedirs(os.path.dirname(outfile_csv), exist_ok=True)
     with open(outfile_csv, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=ordered_field_names)
-        w.writeheader()
-        for r in rows:
-            row_out: Dict[str, Any] = {}
-            for k in ordered_field_names:
-                v = r.get(k)
-                if isinstance(v, (list, dict)):
-                    # Join lists by semicolon for readability; dict as compact JSON
-                    row_out[k] = (
-                        "; ".join([json.dumps(x, ensure_ascii=False) if isinstance(x, dict) else str(x) for x in v])
-                        if isinstance(v, list)
-                        else json.dumps(v, ensure_ascii=False)
-                    )
-                else:
-                    row_out[k] = v
-            w.writerow(row_out)
+        w = csv.writer(f)
+        w.writerow(ordered_field_names)
+        w.writerows(_rows(columns, len(items)))
     return outfile_csv
 
 
 def save_xlsx_with_order(
-    items: List[Dict[str, Any]], ordered_field_names: List[str], outfile_xlsx: str
+    items: List[Dict[str, Any]], ordered_field_names: List[str], outfile_xlsx: str,
+    fields: Optional[List[Dict[str, Any]]] = None,
 ) -> str:
+    """fields: 字段定义（list_table_fields），用于按字段类型选择单元格转换函数"""
     from openpyxl import Workbook
 
     wb = Workbook()
@@ -175,20 +584,7 @@ def save_xlsx_with_order(
     ws.append(ordered_field_names)
 
     # rows
-    for it in items:
-        r = it.get("fields", {}) or {}
-        row = []
-        for k in ordered_field_names:
-            v = r.get(k)
-            if isinstance(v, (list, dict)):
-                cell = (
-                    "; ".join([json.dumps(x, ensure_ascii=False) if isinstance(x, dict) else str(x) for x in v])
-                    if isinstance(v, list)
-                    else json.dumps(v, ensure_ascii=False)
-                )
-            else:
-                cell = v
-            row.append(cell)
+    for row in _rows(compile_page_converter(ordered_field_names, fields)(items), len(items)):
         ws.append(row)
 
     os.makedirs(os.path.dirname(outfile_xlsx), exist_ok=True)
@@ -201,14 +597,199 @@ def list_all_tables(
     app_token: str,
     tenant_token: str,
 ) -> List[Dict[str, Any]]:
-    """获取多维表格中的所有table列表"""
+    """获取多维表格中的所有table列表（分页拉全，保持接口返回顺序）"""
+    return _cached("tables", app_token, lambda: _fetch_all_tables(open_base, app_token, tenant_token))
+
+
+def _fetch_all_tables(open_base: str, app_token: str, tenant_token: str) -> List[Dict[str, Any]]:
     headers = {"Authorization": f"Bearer {tenant_token}"}
     url_tables = f"{open_base}/open-apis/bitable/v1/apps/{app_token}/tables"
-    params = {"page_size": 200}
-    r = requests.get(url_tables, headers=headers, params=params, timeout=10).json()
-    if r.get("code") != 0:
-        raise RuntimeError(f"list_tables failed: {r}")
-    return r["data"].get("items", [])
+    tables: List[Dict[str, Any]] = []
+    page_token: Optional[str] = None
+    while True:
+        params: Dict[str, Any] = {"page_size": 100}
+        if page_token:
+            params["page_token"] = page_token
+        r = _http.get(url_tables, headers=headers, params=params, timeout=10).json()
+        if r.get("code") != 0:
+            raise RuntimeError(f"list_tables failed: {r}")
+        tables += r["data"].get("items", []) or []
+        if not r["data"].get("has_more"):
+            break
+        page_token = r["data"].get("page_token")
+    return tables
+
+
+def project_field_names(ordered_field_names: List[str], field_names: Optional[List[str]]) -> Optional[List[str]]:
+    """字段投影：表中包含 field_names 的全部字段时，返回按视图顺序排列的这些字段；
+    否则（或未指定 field_names）返回 None，表示拉取全部字段（如宽格式表需要所有列）"""
+    if not field_names:
+        return None
+    wanted = set(field_names)
+    if not wanted.issubset(ordered_field_names):
+        return None
+    return [name for name in ordered_field_names if name in wanted]
+
+
+def _table_fields_and_pages(
+    open_base: str,
+    app_token: str,
+    table_id: str,
+    tenant_token: str,
+    view_id: Optional[str],
+    snapshot_store: Any = None,
+    field_names: Optional[List[str]] = None,
+    record_filter: Optional[str] = None,
+) -> Tuple[List[str], Iterable[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """返回 (字段顺序, 记录分页, 字段定义)；配置了快照存储时通过 sync_bitable_records 增量同步
+    field_names: 需要的字段（见 project_field_names）；record_filter: 服务端筛选公式（配置后不走增量同步）
+    """
+    fields = list_table_fields(open_base, app_token, table_id, tenant_token)
+    ordered_field_names = list_fields(open_base, app_token, table_id, tenant_token, view_id, fields=fields)
+    projection = project_field_names(ordered_field_names, field_names)
+    if projection is not None:
+        ordered_field_names = projection
+    if snapshot_store is None or record_filter:
+        pages: Iterable[List[Dict[str, Any]]] = iter_bitable_record_pages(
+            open_base, app_token, table_id, tenant_token, view_id=view_id,
+            field_names=projection, filter_formula=record_filter,
+        )
+    else:
+        pages = [sync_bitable_records(
+            open_base, app_token, table_id, tenant_token, view_id, fields, snapshot_store,
+            min_records=getattr(snapshot_store, "min_records", 500),
+            max_fetch=getattr(snapshot_store, "max_fetch", 50),
+            field_names=projection,
+        )]
+    if _metadata_cache is not None and projection is None:
+        # 字段定义可能来自缓存：首页记录中出现未知字段说明表结构已变更（新增/重命名字段），
+        # 失效该表的缓存并重新获取字段（拉取的是全部字段，记录本身无需重拉）
+        pages = iter(pages)
+        first = next(pages, None)
+        if first is None:
+            return ordered_field_names, [], fields
+        known = {f.get("field_name") for f in fields}
+        if any(name not in known for it in first for name in (it.get("fields") or {})):
+            _metadata_cache.invalidate(app_token, table_id)
+            fields = list_table_fields(open_base, app_token, table_id, tenant_token)
+            ordered_field_names = list_fields(open_base, app_token, table_id, tenant_token, view_id, fields=fields)
+        pages = itertools.chain([first], pages)
+    return ordered_field_names, pages, fields
+
+
+def _fetch_table(
+    open_base: str,
+    app_token: str,
+    table: Dict[str, Any],
+    tenant_token: str,
+    view_id: Optional[str],
+    snapshot_store: Any = None,
+    field_names: Optional[List[str]] = None,
+    record_filter: Optional[str] = None,
+) -> Tuple[str, List[str], List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """拉取单个table的字段顺序与全部记录，返回 (sheet标题, 字段顺序, 记录, 字段定义)"""
+    table_id = table.get("table_id")
+    table_name = table.get("name", f"Table_{table_id}")
+    ordered_field_names, pages, fields = _table_fields_and_pages(
+        open_base, app_token, table_id, tenant_token, view_id, snapshot_store,
+        field_names=field_names, record_filter=record_filter,
+    )
+    items = [it for page in pages for it in page]
+    # Excel sheet名称最长31字符
+    return table_name[:31], ordered_field_names, items, fields
+
+
+def iter_table_sheets(
+    open_base: str,
+    app_token: str,
+    table_id: Optional[str],
+    view_id: Optional[str],
+    tenant_token: str,
+    table_concurrency: int = 4,
+    snapshot_store: Any = None,
+    field_names: Optional[List[str]] = None,
+    record_filter: Optional[str] = None,
+) -> Iterator[Tuple[str, List[str], Iterable[List[Dict[str, Any]]], List[Dict[str, Any]]]]:
+    """按输出顺序产出 (sheet标题, 字段顺序, 记录分页, 字段定义)，供 Excel / DataFrame 等 sink 共用；
+    sink 按字段定义中的类型构建单元格转换函数（compile_page_converter）。
+    table_id 为 None 时拉取所有table；多个table时最多 table_concurrency 个并发拉取，
+    产出顺序始终与table顺序一致。
+    snapshot_store: 记录快照存储，配置后按 sync_bitable_records 增量同步
+    field_names: 只拉取这些字段（表中包含全部这些字段时生效，否则拉取全部字段）
+    record_filter: 服务端筛选公式（列表接口的 filter 参数）
+    """
+    if table_id is not None:
+        # 只拉取指定的table：先取字段顺序，再边拉取边写入
+        ordered_field_names, pages, fields = _table_fields_and_pages(
+            open_base, app_token, table_id, tenant_token, view_id, snapshot_store,
+            field_names=field_names, record_filter=record_filter,
+        )
+        yield "BitableExport", ordered_field_names, pages, fields
+        return
+
+    all_tables = list_all_tables(open_base, app_token, tenant_token)
+
+    if table_concurrency <= 1 or len(all_tables) <= 1:
+        for table in all_tables:
+            table_id_current = table.get("table_id")
+            table_name = table.get("name", f"Table_{table_id_current}")
+            ordered_field_names, pages, fields = _table_fields_and_pages(
+                open_base, app_token, table_id_current, tenant_token, view_id, snapshot_store,
+                field_names=field_names, record_filter=record_filter,
+            )
+            # Excel sheet名称最长31字符
+            yield table_name[:31], ordered_field_names, pages, fields
+        return
+
+    # 多个table并发拉取，按原始table顺序产出。滑动窗口：已提交未产出的table（含正在产出的）最多
+    # table_concurrency 个，前面的table较慢时后面的table不会全部拉取到内存中等待
+    window = min(table_concurrency, len(all_tables))
+    pool = ThreadPoolExecutor(max_workers=window, thread_name_prefix="bitable-table")
+    pending_tables = iter(all_tables)
+    futures: Deque[Future] = deque()
+
+    def submit_next() -> None:
+        table = next(pending_tables, None)
+        if table is not None:
+            futures.append(pool.submit(_fetch_table, open_base, app_token, table, tenant_token, view_id,
+                                       snapshot_store, field_names, record_filter))
+
+    try:
+        for _ in range(window):
+            submit_next()
+        while futures:
+            title, ordered_field_names, items, fields = futures.popleft().result()
+            yield title, ordered_field_names, [items], fields
+            # 上一个table已由调用方处理完，再补充一个
+            del items
+            submit_next()
+    finally:
+        # 出错时取消尚未开始的table
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def pages_to_frames(
+    sheets: Iterable[Tuple[str, List[str], Iterable[List[Dict[str, Any]]], Optional[List[Dict[str, Any]]]]]
+) -> Tuple["Dict[str, Any]", int]:
+    """把 (标题, 字段顺序, 记录分页, 字段定义) 转为 {sheet标题: DataFrame}，单元格与写入 Excel 的内容一致。
+    重名标题按 openpyxl 的规则追加数字，保证与 Excel 输出的 sheet 名一致。返回 (frames, 记录总数)。
+    """
+    import pandas as pd
+
+    frames: Dict[str, Any] = {}
+    total = 0
+    for title, ordered_field_names, pages, fields in sheets:
+        convert = compile_page_converter(ordered_field_names, fields)
+        rows = []
+        for page in prefetch_pages(pages):
+            rows.extend(_rows(convert(page), len(page)))
+        total += len(rows)
+        unique_title, i = title, 0
+        while unique_title in frames:
+            i += 1
+            unique_title = f"{title}{i}"
+        frames[unique_title] = pd.DataFrame(rows, columns=ordered_field_names).infer_objects()
+    return frames, total
 
 
 def pull_to_files(
@@ -219,69 +800,48 @@ def pull_to_files(
     table_id: Optional[str],  # 改为Optional，如果为None则拉取所有table
     view_id: Optional[str],
     outfile: str,  # 应该是完整的 .xlsx 路径
+    tenant_token: Optional[str] = None,
+    table_concurrency: int = 4,
+    snapshot_store: Any = None,
+    field_names: Optional[List[str]] = None,
+    record_filter: Optional[str] = None,
 ) -> Dict[str, Any]:
     """End-to-end: fetch token, list records, save Excel only.
     支持多table：如果table_id为None，则拉取所有table作为多个sheet。
+    tenant_token: 调用方已持有的 token（服务端由共享缓存提供）；为空时自行获取。
+    table_concurrency: 多table时同时拉取的table数上限；sheet顺序始终与table顺序一致。
+    snapshot_store: 记录快照存储（可选），配置后按 sync_bitable_records 增量同步。
+    field_names: 只拉取这些字段（表中包含全部这些字段时生效）；record_filter: 服务端筛选公式。
     Returns dict with count and Excel file path.
     """
-    token = get_tenant_access_token(open_base, app_id, app_secret)
-    
-    # 如果table_id为None，拉取所有table
-    if table_id is None:
-        from openpyxl import Workbook
-        wb = Workbook()
-        # 删除默认sheet
-        wb.remove(wb.active)
-        
-        all_tables = list_all_tables(open_base, app_token, token)
-        total_count = 0
-        
-        for table in all_tables:
-            table_id_current = table.get("table_id")
-            table_name = table.get("name", f"Table_{table_id_current}")
-            
-            # 拉取该table的数据
-            items = list_bitable_records(open_base, app_token, table_id_current, token, view_id=view_id)
-            ordered_field_names = list_fields(open_base, app_token, table_id_current, token, view_id)
-            
-            # 创建sheet
-            safe_sheet_name = table_name[:31]  # Excel sheet名称最长31字符
-            ws = wb.create_sheet(title=safe_sheet_name)
-            
-            # 写入表头
-            ws.append(ordered_field_names)
-            
-            # 写入数据
-            for it in items:
-                r = it.get("fields", {}) or {}
-                row = []
-                for k in ordered_field_names:
-                    v = r.get(k)
-                    if isinstance(v, (list, dict)):
-                        cell = (
-                            "; ".join([json.dumps(x, ensure_ascii=False) if isinstance(x, dict) else str(x) for x in v])
-                            if isinstance(v, list)
-                            else json.dumps(v, ensure_ascii=False)
-                        )
-                    else:
-                        cell = v
-                    row.append(cell)
-                ws.append(row)
-            
-            total_count += len(items)
-        
-        # 保存Excel
-        os.makedirs(os.path.dirname(outfile), exist_ok=True)
-        wb.save(outfile)
-        
-        return {"count": total_count, "xlsx": outfile}
-    else:
-        # 原有逻辑：只拉取指定的table
-        items = list_bitable_records(open_base, app_token, table_id, token, view_id=view_id)
-        ordered_field_names = list_fields(open_base, app_token, table_id, token, view_id)
-        out: Dict[str, Any] = {"count": len(items)}
-        out["xlsx"] = save_xlsx_with_order(items, ordered_field_names, outfile)
-        return out
+    token = tenant_token or get_tenant_access_token(open_base, app_id, app_secret)
+    sheets = iter_table_sheets(open_base, app_token, table_id, view_id, token, table_concurrency, snapshot_store,
+                               field_names=field_names, record_filter=record_filter)
+    count = write_pages_to_xlsx(sheets, outfile)
+    return {"count": count, "xlsx": outfile}
+
+
+def pull_to_frames(
+    open_base: str,
+    app_id: str,
+    app_secret: str,
+    app_token: str,
+    table_id: Optional[str],
+    view_id: Optional[str],
+    tenant_token: Optional[str] = None,
+    table_concurrency: int = 4,
+    snapshot_store: Any = None,
+    field_names: Optional[List[str]] = None,
+    record_filter: Optional[str] = None,
+) -> Dict[str, Any]:
+    """与 pull_to_files 相同的拉取逻辑，但直接在内存中构建 DataFrame（不经过 xlsx）。
+    Returns dict with count and frames（{sheet标题: DataFrame}，顺序与 Excel 中的 sheet 一致）。
+    """
+    token = tenant_token or get_tenant_access_token(open_base, app_id, app_secret)
+    sheets = iter_table_sheets(open_base, app_token, table_id, view_id, token, table_concurrency, snapshot_store,
+                               field_names=field_names, record_filter=record_filter)
+    frames, count = pages_to_frames(sheets)
+    return {"count": count, "frames": frames}
 
 
 def main(argv: Optional[List[str]] = None) -> int:
@@ -319,8 +879,9 @@ def main(argv: Optional[List[str]] = None) -> int:
         print(f"[OK] fetched {len(items)} records in {dt:.2f}s")
 
         print("[STEP] fetching field order …")
+        fields = list_table_fields(args.open_base, args.app_token, args.table_id, token)
         ordered_field_names = list_fields(
-            args.open_base, args.app_token, args.table_id, token, args.view_id
+            args.open_base, args.app_token, args.table_id, token, args.view_id, fields=fields
         )
 
         print(f"[STEP] saving JSON to {args.outfile} …")
@@ -330,13 +891,13 @@ def main(argv: Optional[List[str]] = None) -> int:
         if args.csv:
             csv_out = os.path.splitext(args.outfile)[0] + ".csv"
             print(f"[STEP] saving CSV (strict column order) to {csv_out} …")
-            save_csv_with_order(items, ordered_field_names, csv_out)
+            save_csv_with_order(items, ordered_field_names, csv_out, fields)
             print(f"[DONE] CSV saved: {csv_out}")
 
         if args.xlsx:
             xlsx_out = os.path.splitext(args.outfile)[0] + ".xlsx"
             print(f"[STEP] saving Excel (strict column order) to {xlsx_out} …")
-            save_xlsx_with_order(items, ordered_field_names, xlsx_out)
+            save_xlsx_with_order(items, ordered_field_names, xlsx_out, fields)
             print(f"[DONE] Excel saved: {xlsx_out}")
         return 0
     except Exception as e:
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共部分：本地飞书 OpenAPI 桩服务（多维表格字段、记录列表、记录搜索、单条记录）
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pull_bitable  # noqa: E402
+from app.http_client import create_session  # noqa: E402
+
+
+class OpenAPIStub:
+    """多维表格接口桩：tables[table_id] = {"fields": [字段定义], "records": [记录]}；requests 记录每次调用的接口"""
+
+    def __init__(self):
+        self.tables = {}
+        self.requests = []
+        self.page_size = 2
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def calls(self, kind):
+        return sum(1 for k, _ in self.requests if k == kind)
+
+    def _page(self, items, query):
+        start = int(query.get("page_token", ["0"])[0] or 0)
+        size = min(int(query.get("page_size", [self.page_size])[0]), self.page_size)
+        more = start + size < len(items)
+        return {"code": 0, "data": {"items": items[start:start + size], "has_more": more,
+                                    "page_token": str(start + size) if more else None, "total": len(items)}}
+
+    @staticmethod
+    def _project(records, names):
+        if names is None:
+            return records
+        return [{"record_id": r["record_id"], "fields": {k: v for k, v in r["fields"].items() if k in names}}
+                for r in records]
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, obj, code=200):
+                body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                m = re.match(r"/open-apis/bitable/v1/apps/\w+/tables/(\w+)/(fields|records)(?:/(\w+))?$", url.path)
+                if not m:
+                    return self._send({"code": 404, "msg": "not found"}, 404)
+                table = stub.tables[m.group(1)]
+                if m.group(2) == "fields":
+                    stub.requests.append(("fields", None))
+                    return self._send(stub._page(table["fields"], query))
+                if m.group(3):
+                    stub.requests.append(("get", m.group(3)))
+                    record = next((r for r in table["records"] if r["record_id"] == m.group(3)), None)
+                    if record is None:
+                        return self._send({"code": 1254043, "msg": "RecordIdNotFound"})
+                    return self._send({"code": 0, "data": {"record": record}})
+                stub.requests.append(("list", query.get("page_token", [None])[0]))
+                names = json.loads(query["field_names"][0]) if "field_names" in query else None
+                return self._send(stub._page(stub._project(table["records"], names), query))
+
+            def do_POST(self):
+                url = urllib.parse.urlparse(self.path)
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                m = re.match(r"/open-apis/bitable/v1/apps/\w+/tables/(\w+)/records/search$", url.path)
+                if not m:
+                    return self._send({"code": 404, "msg": "not found"}, 404)
+                stub.requests.append(("search", body.get("filter") is not None))
+                records = stub.tables[m.group(1)]["records"]
+                if body.get("filter"):
+                    cond = body["filter"]["conditions"][0]
+                    since = int(cond["value"][1])
+                    records = [r for r in records if (r["fields"].get(cond["field_name"]) or 0) > since]
+                records = stub._project(records, body.get("field_names"))
+                return self._send(stub._page(records, urllib.parse.parse_qs(url.query)))
+
+        return Handler
+
+
+@pytest.fixture
+def openapi_stub():
+    stub = OpenAPIStub()
+    previous = pull_bitable._http
+    pull_bitable.set_http_session(create_session(max_retries=0))
+    try:
+        yield stub
+    finally:
+        pull_bitable.set_http_session(previous)
+        stub.close()
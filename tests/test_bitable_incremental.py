@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""多维表格增量同步（pull_bitable.sync_bitable_records + BitableSnapshotStore）"""
+
+import pytest
+
+import pull_bitable
+from app.bitable_snapshot import BitableSnapshotStore
+
+DAY_MS = 24 * 3600 * 1000
+BASE_MS = 1700000000000
+
+FIELDS = [
+    {"field_id": "f1", "field_name": "阶段", "type": 1},
+    {"field_id": "f2", "field_name": "项目名称", "type": 1},
+    {"field_id": "f3", "field_name": "费用", "type": 2},
+    {"field_id": "f4", "field_name": "更新时间", "type": 1002},
+]
+
+
+def _record(i, fee):
+    return {"record_id": f"rec{i}",
+            "fields": {"阶段": "25年预算", "项目名称": f"项目{i}", "费用": fee, "更新时间": BASE_MS + i * 2 * DAY_MS}}
+
+
+@pytest.fixture
+def table(openapi_stub):
+    openapi_stub.tables["tbl1"] = {"fields": list(FIELDS), "records": [_record(i, 100 + i) for i in range(6)]}
+    return openapi_stub.tables["tbl1"]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BitableSnapshotStore(str(tmp_path / "snapshot.db"))
+
+
+def _sync(stub, store, fields=FIELDS, max_fetch=3, min_records=1):
+    stub.requests.clear()
+    return pull_bitable.sync_bitable_records(stub.base, "app1", "tbl1", "tok", None, fields, store,
+                                             min_records=min_records, max_fetch=max_fetch)
+
+
+def _touch(record, **values):
+    record["fields"].update(values)
+    record["fields"]["更新时间"] += 30 * DAY_MS
+
+
+def test_first_sync_is_full_and_stores_snapshot(openapi_stub, table, store):
+    assert _sync(openapi_stub, store) == table["records"]
+    assert openapi_stub.calls("list") == 3
+    assert openapi_stub.calls("search") == 0
+    stats = store.stats()
+    assert (stats["tables"], stats["records"], stats["full_syncs"]) == (1, 6, 1)
+
+
+def test_unchanged_table_is_served_from_snapshot(openapi_stub, table, store):
+    _sync(openapi_stub, store)
+    assert _sync(openapi_stub, store) == table["records"]
+    # 一次增量筛选 + 一次记录总数探测，不再列出记录
+    assert openapi_stub.calls("list") == 0
+    assert openapi_stub.calls("search") == 2
+    assert store.stats()["unchanged"] == 1
+
+
+def test_modified_record_is_fetched_and_merged(openapi_stub, table, store):
+    _sync(openapi_stub, store)
+    _touch(table["records"][1], 费用=999)
+    assert _sync(openapi_stub, store) == table["records"]
+    assert [r for r in openapi_stub.requests if r[0] == "get"] == [("get", "rec1")]
+    assert openapi_stub.calls("list") == 0
+    assert store.stats()["incremental_syncs"] == 1
+    # 合并后的快照与远端一致：再次同步无变化
+    assert _sync(openapi_stub, store) == table["records"]
+    assert store.stats()["unchanged"] == 1
+
+
+def test_deleted_record_is_detected(openapi_stub, table, store):
+    _sync(openapi_stub, store)
+    del table["records"][2]
+    assert _sync(openapi_stub, store) == table["records"]
+    assert openapi_stub.calls("get") == 0
+    assert openapi_stub.calls("list") == 0
+    assert store.stats()["records"] == 5
+
+
+def test_added_record_keeps_view_order(openapi_stub, table, store):
+    _sync(openapi_stub, store)
+    table["records"].insert(0, _record(9, 50))
+    assert _sync(openapi_stub, store) == table["records"]
+    assert [r for r in openapi_stub.requests if r[0] == "get"] == [("get", "rec9")]
+    assert store.load("app1/tbl1/")["order"][0] == "rec9"
+
+
+def test_many_changes_fall_back_to_full_pull(openapi_stub, table, store):
+    _sync(openapi_stub, store)
+    for record in table["records"][:4]:
+        _touch(record, 费用=1)
+    assert _sync(openapi_stub, store, max_fetch=3) == table["records"]
+    assert openapi_stub.calls("get") == 0
+    assert openapi_stub.calls("list") == 3
+    assert store.stats()["full_syncs"] == 2
+
+
+def test_schema_change_falls_back_to_full_pull(openapi_stub, table, store):
+    _sync(openapi_stub, store)
+    fields = FIELDS + [{"field_id": "f5", "field_name": "说明", "type": 1}]
+    table["fields"] = fields
+    assert _sync(openapi_stub, store, fields=fields) == table["records"]
+    assert openapi_stub.calls("search") == 0
+    assert openapi_stub.calls("list") == 3
+
+
+def test_small_snapshot_is_always_pulled_in_full(openapi_stub, table, store):
+    _sync(openapi_stub, store, min_records=10)
+    _sync(openapi_stub, store, min_records=10)
+    assert openapi_stub.calls("search") == 0
+    assert store.stats()["full_syncs"] == 2
+
+
+@pytest.mark.parametrize("fields", [
+    [f for f in FIELDS if f["type"] != 1002],                           # 没有"最后更新时间"字段
+    FIELDS + [{"field_id": "f9", "field_name": "汇总", "type": 20}],     # 含公式字段
+])
+def test_tables_without_reliable_modified_time_are_not_snapshotted(openapi_stub, table, store, fields):
+    for _ in range(2):
+        assert _sync(openapi_stub, store, fields=fields) == table["records"]
+        assert openapi_stub.calls("list") == 3
+        assert openapi_stub.calls("search") == 0
+    assert store.stats()["tables"] == 0
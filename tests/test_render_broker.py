@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""渲染任务代理（app.render_broker.SQLiteBroker）与渲染 worker 的心跳续租"""
+
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from app import render_worker
+from app.render_broker import RenderBroker, SQLiteBroker, create_broker
+
+
+@pytest.fixture
+def broker(tmp_path):
+    return SQLiteBroker(str(tmp_path / "broker.db"), lease_seconds=60, max_attempts=2)
+
+
+def _expire_lease(broker, job_id):
+    broker._conn().execute("UPDATE render_jobs SET lease_until = ? WHERE job_id = ?", (time.time() - 1, job_id))
+
+
+def test_submit_claim_complete_and_fetch_artifact(broker):
+    job_id = broker.submit({"kind": "excel", "source_name": "预算"}, b"xlsx")
+    assert broker.status(job_id)["status"] == "queued"
+
+    assert broker.claim("w1") == (job_id, {"kind": "excel", "source_name": "预算"}, b"xlsx")
+    record = broker.status(job_id)
+    assert (record["status"], record["worker"], record["attempts"]) == ("running", "w1", 1)
+    assert broker.claim("w2") is None
+
+    assert broker.complete(job_id, "w1", True, "http://x/预算_桑基图.html", "预算_桑基图.json", b"{}")
+    record = broker.status(job_id)
+    assert (record["status"], record["success"], record["html_filename"]) == ("done", True, "预算_桑基图.json")
+    assert broker.fetch_artifact(job_id) == ("预算_桑基图.json", b"{}")
+    assert broker.wait(job_id, timeout=1)["status"] == "done"
+
+
+def test_jobs_are_claimed_in_submit_order(broker):
+    first = broker.submit({"kind": "a"})
+    second = broker.submit({"kind": "b"})
+    assert broker.claim("w1")[0] == first
+    assert broker.claim("w2")[0] == second
+    assert broker.claim("w3") is None
+
+
+def test_failed_job_has_no_artifact(broker):
+    job_id = broker.submit({"kind": "excel"})
+    broker.claim("w1")
+    assert broker.complete(job_id, "w1", False, "format_error", error="bad", error_type="ValueError")
+    record = broker.status(job_id)
+    assert (record["status"], record["success"], record["result"], record["error_type"]) == \
+        ("failed", False, "format_error", "ValueError")
+    assert broker.fetch_artifact(job_id) is None
+
+
+def test_expired_lease_is_reclaimed_and_stale_result_rejected(broker):
+    job_id = broker.submit({"kind": "excel"})
+    broker.claim("w1")
+    _expire_lease(broker, job_id)
+
+    assert broker.claim("w2")[0] == job_id
+    assert broker.status(job_id)["attempts"] == 2
+    # 失联后恢复的 w1 不能覆盖 w2 的结果
+    assert not broker.complete(job_id, "w1", True, "url")
+    assert not broker.heartbeat(job_id, "w1")
+    assert broker.complete(job_id, "w2", True, "url")
+
+
+def test_job_fails_as_worker_lost_after_max_attempts(broker):
+    job_id = broker.submit({"kind": "excel"}, b"xlsx")
+    for worker_id in ("w1", "w2"):
+        assert broker.claim(worker_id)[0] == job_id
+        _expire_lease(broker, job_id)
+    assert broker.claim("w3") is None
+    record = broker.status(job_id)
+    assert (record["status"], record["result"]) == ("failed", "worker_lost")
+
+
+def test_heartbeat_extends_lease(broker):
+    job_id = broker.submit({"kind": "excel"})
+    broker.claim("w1")
+    _expire_lease(broker, job_id)
+    assert broker.heartbeat(job_id, "w1")
+    assert broker.claim("w2") is None
+    assert broker.complete(job_id, "w1", True, "url")
+    assert not broker.heartbeat(job_id, "w1")
+
+
+def test_cancelled_job_is_not_claimed_or_completed(broker):
+    job_id = broker.submit({"kind": "excel"})
+    assert broker.cancel(job_id)
+    assert broker.claim("w1") is None
+    assert broker.status(job_id)["status"] == "cancelled"
+
+    running = broker.submit({"kind": "excel"})
+    broker.claim("w1")
+    assert broker.cancel(running)
+    assert not broker.complete(running, "w1", True, "url")
+    assert not broker.cancel(running)
+
+
+def test_wait_times_out_for_unfinished_job(broker):
+    job_id = broker.submit({"kind": "excel"})
+    assert broker.wait(job_id, timeout=0.2, poll_interval=0.05) is None
+    assert broker.status("missing") is None
+
+
+def test_purge_removes_finished_jobs_after_retention(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"), retention_seconds=0)
+    finished = broker.submit({"kind": "excel"})
+    broker.cancel(finished)
+    queued = broker.submit({"kind": "excel"})
+    time.sleep(0.01)
+    assert broker.purge() == 1
+    assert broker.status(finished) is None
+    assert broker.status(queued)["status"] == "queued"
+
+
+def test_worker_heartbeat_keeps_long_job(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"), lease_seconds=1.5)
+    output_dir = tmp_path / "sankey"
+    output_dir.mkdir()
+    (output_dir / "预算_桑基图.json").write_bytes(b"{}")
+
+    def run_render_job(job, content):
+        time.sleep(3)
+        return True, "http://x/预算_桑基图.html"
+
+    service = types.SimpleNamespace(run_render_job=run_render_job, SANKEY_OUTPUT_DIR=str(output_dir),
+                                    sankey_artifact_filename=lambda url: "预算_桑基图.json")
+    job_id = broker.submit({"kind": "excel"})
+    worker = threading.Thread(target=render_worker.process_one, args=(service, broker, "w1"))
+    worker.start()
+    time.sleep(2.2)
+    # 已超过最初的租约，但 worker 仍在续租：任务不会被重复领取
+    assert broker.claim("w2") is None
+    worker.join()
+    record = broker.status(job_id)
+    assert (record["status"], record["worker"], record["attempts"]) == ("done", "w1", 1)
+    assert broker.fetch_artifact(job_id) == ("预算_桑基图.json", b"{}")
+
+
+def test_create_broker(tmp_path, monkeypatch):
+    path = str(tmp_path / "broker.db")
+    broker = create_broker("sqlite://" + path, lease_seconds=30, max_attempts=3)
+    assert isinstance(broker, SQLiteBroker)
+    assert (broker.db_path, broker.lease_seconds, broker.max_attempts) == (path, 30, 3)
+    assert os.path.exists(path)
+
+    module = types.ModuleType("custom_broker")
+    module.CustomBroker = _CustomBroker
+    monkeypatch.setitem(sys.modules, "custom_broker", module)
+    assert isinstance(create_broker("custom_broker:CustomBroker"), _CustomBroker)
+    with pytest.raises(ValueError):
+        create_broker("render_broker.db")
+    with pytest.raises(TypeError):
+        create_broker("types:SimpleNamespace")
+
+
+class _CustomBroker(RenderBroker):
+    submit = claim = complete = status = fetch_artifact = cancel = None